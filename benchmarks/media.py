@@ -0,0 +1,187 @@
+"""Throughput of video, range and HLS segment downloads under gunicorn.
+
+    python benchmarks/media.py --concurrency 8 --seconds 10
+    python benchmarks/media.py --baseline HEAD~1 --json media.json
+
+The script writes a scratch videos folder (one large video and a set of
+HLS segments), starts gunicorn with gunicorn.conf.py on it and drives
+each workload from --concurrency client threads over keep-alive
+connections:
+
+  video_full     whole-file GETs of the video
+  video_range    random --range-size byte ranges of the video, the way
+                 players seek
+  hls_segments   whole GETs of segments, a few of them hot
+
+printing requests/s, MB/s and latency percentiles per workload. With
+--baseline the same runs are repeated against that git revision of the
+repository (exported to a temporary folder), for a before/after table.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from routes import app_env, free_port, peak_rss_kib, percentile  # noqa: E402
+
+HLS_VIDEO_ID = 1
+
+
+def make_media(workdir, args):
+    rnd = random.Random(args.seed)
+    videos = os.path.join(workdir, 'videos')
+    hls = os.path.join(videos, 'hls', str(HLS_VIDEO_ID), '0')
+    os.makedirs(hls, exist_ok=True)
+    with open(os.path.join(videos, 'bench.mp4'), 'wb') as f:
+        for _ in range(args.video_mb):
+            f.write(rnd.randbytes(1024 ** 2))
+    for i in range(args.segments):
+        with open(os.path.join(hls, f'seg_{i:05d}.ts'), 'wb') as f:
+            f.write(rnd.randbytes(args.segment_kb * 1024))
+
+
+def workloads(args):
+    size = args.video_mb * 1024 ** 2
+    hot = max(1, args.segments // 10)
+
+    def video_full(rnd):
+        return '/videos/bench.mp4', {}
+
+    def video_range(rnd):
+        start = rnd.randrange(0, size - args.range_size)
+        return '/videos/bench.mp4', {'Range': f'bytes={start}-{start + args.range_size - 1}'}
+
+    def hls_segments(rnd):
+        # Most players watch the same few segments (the start of a video)
+        i = rnd.randrange(hot) if rnd.random() < 0.8 else rnd.randrange(args.segments)
+        return f'/hls/{HLS_VIDEO_ID}/0/seg_{i:05d}.ts', {}
+
+    return {'video_full': video_full, 'video_range': video_range, 'hls_segments': hls_segments}
+
+
+def run_server(repo, workdir, args):
+    port = free_port()
+    env = dict(os.environ, **app_env(workdir, os.path.join(workdir, 'bench.db')),
+               HKINGDOM_BIND=f'127.0.0.1:{port}', HKINGDOM_VIDEO_FOLDER=os.path.join(workdir, 'videos'),
+               WEB_CONCURRENCY=str(args.workers), PYTHONPATH=repo)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(repo, 'gunicorn.conf.py'),
+                               'streaming_service2:create_app()'], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, port
+        except OSError:
+            if time.time() > deadline or server.poll() is not None:
+                server.terminate()
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.2)
+
+
+def drive(port, request, args):
+    lock = threading.Lock()
+    latencies, sizes, errors = [], [0], [0]
+    deadline = time.perf_counter() + args.seconds
+
+    def client(seed):
+        rnd = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local, received, failed = [], 0, 0
+        while time.perf_counter() < deadline:
+            path, headers = request(rnd)
+            start = time.perf_counter()
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            local.append(time.perf_counter() - start)
+            received += len(body)
+            if resp.status not in (200, 206):
+                failed += 1
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            sizes[0] += received
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(args.seed + i,)) for i in range(args.concurrency)]
+    wall = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall
+    return {
+        'requests_per_sec': round(len(latencies) / wall, 1),
+        'mb_per_sec': round(sizes[0] / wall / 1024 ** 2, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'errors': errors[0],
+    }
+
+
+def run(label, repo, workdir, args):
+    server, port = run_server(repo, workdir, args)
+    results = {}
+    try:
+        for name, request in workloads(args).items():
+            if args.workloads and name not in args.workloads:
+                continue
+            drive(port, request, argparse.Namespace(**dict(vars(args), seconds=1)))  # warm up
+            row = results[name] = drive(port, request, args)
+            print(f"{label:<9} {name:<13} {row['requests_per_sec']:>9} {row['mb_per_sec']:>8} "
+                  f"{row['p50_ms']:>8} {row['p99_ms']:>8} {row['errors']:>6}", flush=True)
+        results['_peak_rss_kib'] = peak_rss_kib(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def export_revision(rev):
+    folder = tempfile.mkdtemp(prefix='hk-media-base-')
+    archive = subprocess.run(['git', '-C', REPO, 'archive', rev], check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', folder], input=archive, check=True)
+    return folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--video-mb', type=int, default=64)
+    parser.add_argument('--range-size', type=int, default=1024 ** 2)
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--segment-kb', type=int, default=512)
+    parser.add_argument('--workloads', nargs='+', choices=list(workloads(argparse.Namespace(
+        video_mb=1, segments=1, range_size=1))))
+    parser.add_argument('--baseline', help='git revision to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hk-media-bench-')
+    make_media(workdir, args)
+    print(f"{'runner':<9} {'workload':<13} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    output = {'args': vars(args)}
+    if args.baseline:
+        output['baseline'] = run('baseline', export_revision(args.baseline), workdir, args)
+    output['current'] = run('current', REPO, workdir, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+"""Latency and throughput of every route against a seeded scratch database.
+
+    python benchmarks/routes.py --volume small --json results.json
+    python benchmarks/routes.py --volume large --db /tmp/hk-large.db --gunicorn
+    python benchmarks/routes.py --compare before.json after.json
+
+The script fills a scratch database with generated channels, videos,
+likes and comments (VOLUMES, each count can be overridden). Popularity
+follows a long tail, so a few videos carry most of the likes and comments.
+Passing --db reuses that file if it already exists, so large seeds only
+have to be built once.
+
+Every route in ROUTES is then driven through the Flask test client, one
+request at a time, recording per route:
+
+  requests/s, p50/p95/p99 latency (ms), SQL statements per request and the
+  peak Python allocation of a request (tracemalloc, measured in a separate
+  short pass so it doesn't slow the timed one)
+
+Most requests for the same page hit the page cache, so the routes in
+CACHED_ROUTES are first run once more with the cache turned off (reported
+as 'uncached'), which measures what rendering them costs.
+
+With --gunicorn the same routes are also driven over HTTP against a local
+gunicorn started with gunicorn.conf.py, from --concurrency client threads,
+recording requests/s, latency percentiles and the peak RSS of the workers.
+
+Write routes run after all reads, so reads see the seeded data. Results
+are written as JSON (--json) and --compare prints the per-route change
+between two result files.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VOLUMES = {
+    'small': {'channels': 200, 'users': 1000, 'videos': 5000, 'likes': 50000, 'comments': 50000},
+    'medium': {'channels': 2000, 'users': 20000, 'videos': 100000, 'likes': 1000000, 'comments': 1000000},
+    'large': {'channels': 5000, 'users': 100000, 'videos': 300000, 'likes': 3000000, 'comments': 3000000},
+}
+
+WORDS = ('music cooking travel guitar piano soccer tennis coding python river mountain city night '
+         'morning recipe bread coffee garden rain sunset review tutorial live cover remix trailer '
+         'episode season finale funny cats dogs birds ocean space rocket science history art paint '
+         'dance drums game speedrun build repair bike car train winter summer').split()
+
+# name: (method, path(state), form(state) or None, needs login)
+ROUTES = {
+    'index': ('GET', lambda s: '/', None, False),
+    'index_page_2': ('GET', lambda s: f'/?before={s.feed_cursor}', None, False),
+    'list_channels': ('GET', lambda s: f'/channels?after={s.rnd.randrange(s.channels)}', None, False),
+    'channel_page': ('GET', lambda s: f'/channel/{s.channel()}', None, False),
+    'channel_page_logged_in': ('GET', lambda s: f'/channel/{s.channel()}', None, True),
+    'video_comments': ('GET', lambda s: f'/video/{s.video()}/comments', None, False),
+    'search': ('GET', lambda s: f'/search?q={s.rnd.choice(WORDS)}', None, False),
+    'search_prefix': ('GET', lambda s: f'/search?q={s.rnd.choice(WORDS)[:3]}', None, False),
+    'login_form': ('GET', lambda s: '/login', None, False),
+    'api_feed': ('GET', lambda s: '/api/feed', None, False),
+    'api_channels': ('GET', lambda s: f'/api/channels?after={s.rnd.randrange(s.channels)}', None, False),
+    'api_channel_videos': ('GET', lambda s: f'/api/channel/{s.channel()}/videos', None, False),
+    'api_video_stats': ('GET', lambda s: f'/api/video/{s.video()}/stats', None, False),
+    'api_video_comments': ('GET', lambda s: f'/api/video/{s.video()}/comments', None, False),
+    # writes
+    'like': ('GET', lambda s: f'/video/{s.video()}/like', None, True),
+    'react_api': ('POST', lambda s: f'/api/video/{s.video()}/reaction',
+                  lambda s: {'value': s.rnd.choice((1, -1))}, True),
+    'comment': ('POST', lambda s: f'/video/{s.video()}/comment',
+                lambda s: {'content': s.sentence()}, True),
+    'edit_comment': ('POST', lambda s: f'/comment/{s.rnd.choice(s.editable)}/edit',
+                     lambda s: {'content': s.sentence()}, True),
+    'delete_comment': ('POST', lambda s: f'/comment/{s.deletable.pop()}/delete', None, True),
+}
+
+# Routes served from the page cache (see cached_page)
+CACHED_ROUTES = ('index', 'index_page_2', 'list_channels', 'channel_page', 'channel_page_logged_in',
+                 'video_comments')
+
+
+def app_env(workdir, db_path):
+    # Keep the database and the app's runtime files in the scratch folder
+    return {
+        'HKINGDOM_SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path,
+        'HKINGDOM_REACTION_LOG_FOLDER': os.path.join(workdir, 'reactions'),
+        'HKINGDOM_METRICS_FOLDER': os.path.join(workdir, 'metrics'),
+        'HKINGDOM_TEMPLATE_CACHE_FOLDER': os.path.join(workdir, 'templates'),
+        # One client drives every write route, so the per-user limits and
+        # concurrency caps would turn most of the run into 429s and 503s
+        'HKINGDOM_RATE_LIMITS': '{}',
+        'HKINGDOM_CONCURRENCY_LIMITS_PER_WORKER': '{}',
+    }
+
+
+def import_app(workdir, db_path):
+    os.environ.update(app_env(workdir, db_path))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    import streaming_service2
+    app = streaming_service2.create_app()
+    with app.app_context():
+        streaming_service2.init_db()
+    return streaming_service2, app
+
+
+def long_tail(rnd, n, total, cap):
+    # Split `total` over n items with Pareto weights, at most `cap` each
+    weights = [rnd.paretovariate(1.2) for _ in range(n)]
+    scale = total / sum(weights)
+    return [min(cap, int(w * scale)) for w in weights]
+
+
+def timestamp(dt):
+    # The format SQLAlchemy stores DateTime columns in, so keyset
+    # comparisons against seeded rows order correctly
+    return dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def seed(db_path, volume, rnd):
+    conn = sqlite3.connect(db_path)
+    users, channels, videos = volume['users'], volume['channels'], volume['videos']
+    start = datetime.datetime(2024, 1, 1)
+    conn.executemany("INSERT INTO user (id, email, password) VALUES (?, ?, 'x')",
+                     ((i, f'user{i}@example.com') for i in range(1, users + 1)))
+    conn.executemany("INSERT INTO channel (id, name, user_id) VALUES (?, ?, ?)",
+                     ((i, f'{rnd.choice(WORDS)} {rnd.choice(WORDS)} {i}', i) for i in range(1, channels + 1)))
+    channel_sizes = long_tail(rnd, channels, videos, videos)
+    owners = [c for c, size in enumerate(channel_sizes, 1) for _ in range(size)]
+    owners += [rnd.randint(1, channels) for _ in range(videos - len(owners))]
+    rnd.shuffle(owners)
+    conn.executemany("INSERT INTO video (id, title, filename, channel_id, uploaded_at) VALUES (?, ?, 'x.mp4', ?, ?)",
+                     ((v, ' '.join(rnd.choices(WORDS, k=4)), owners[v - 1],
+                       timestamp(start + datetime.timedelta(seconds=v * 60)))
+                      for v in range(1, videos + 1)))
+
+    def likes():
+        for video_id, count in enumerate(long_tail(rnd, videos, volume['likes'], users), 1):
+            for user_id in rnd.sample(range(1, users + 1), count):
+                yield user_id, video_id, 1 if rnd.random() < 0.9 else -1
+    conn.executemany("INSERT INTO like_dislike (user_id, video_id, value) VALUES (?, ?, ?)", likes())
+
+    def comments():
+        for video_id, count in enumerate(long_tail(rnd, videos, volume['comments'], volume['comments']), 1):
+            for i in range(count):
+                # user 1 (the benchmark's login) writes one comment in ten
+                user_id = 1 if rnd.random() < 0.1 else rnd.randint(1, users)
+                yield (' '.join(rnd.choices(WORDS, k=rnd.randint(3, 20))), user_id, video_id,
+                       timestamp(start + datetime.timedelta(seconds=video_id * 60 + i)))
+    conn.executemany("INSERT INTO comment (content, user_id, video_id, created_at) VALUES (?, ?, ?, ?)",
+                     comments())
+    conn.commit()
+    for (fts,) in conn.execute("SELECT name FROM sqlite_master WHERE sql LIKE 'CREATE VIRTUAL TABLE%'"):
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+
+
+class State:
+    """Ids and random choices the route table draws from."""
+
+    def __init__(self, db_path, rnd):
+        conn = sqlite3.connect(db_path)
+        self.rnd = rnd
+        self.channels = conn.execute("SELECT max(id) FROM channel").fetchone()[0]
+        self.videos = conn.execute("SELECT max(id) FROM video").fetchone()[0]
+        own = [cid for (cid,) in conn.execute("SELECT id FROM comment WHERE user_id = 1 ORDER BY id")]
+        half = len(own) // 2
+        self.editable, self.deletable = own[:half], own[half:]
+        row = conn.execute("SELECT uploaded_at, id FROM video ORDER BY uploaded_at DESC, id DESC "
+                           "LIMIT 1 OFFSET 49").fetchone()
+        ts = datetime.datetime.fromisoformat(row[0])
+        self.feed_cursor = f"{ts.strftime('%Y%m%d%H%M%S%f')}-{row[1]}"
+        conn.close()
+
+    def channel(self):
+        return self.rnd.randint(1, self.channels)
+
+    def video(self):
+        return self.rnd.randint(1, self.videos)
+
+    def sentence(self):
+        return ' '.join(self.rnd.choices(WORDS, k=8))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(latencies, wall):
+    return {
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def run_test_client(hk, app, state, routes, args, runner='client'):
+    from sqlalchemy import event
+
+    statements = [0]
+    with app.app_context():
+        event.listen(hk.db.engine, 'before_cursor_execute', lambda *a: statements.__setitem__(0, statements[0] + 1))
+    anon, member = app.test_client(), app.test_client()
+    with member.session_transaction() as sess:
+        sess['user_id'] = 1
+
+    def call(name):
+        method, path, form, login = ROUTES[name]
+        client = member if login else anon
+        resp = client.open(path(state), method=method, data=form(state) if form else None)
+        resp.get_data()
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{name}: {method} {path} returned {resp.status_code}")
+
+    results = {}
+    for name in routes:
+        for _ in range(args.warmup):
+            call(name)
+        statements[0] = 0
+        latencies = []
+        wall = time.perf_counter()
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            call(name)
+            latencies.append(time.perf_counter() - start)
+        wall = time.perf_counter() - wall
+        row = summarize(latencies, wall)
+        row['sql_per_request'] = round(statements[0] / args.requests, 2)
+
+        tracemalloc.start()
+        peak = 0
+        for _ in range(args.memory_requests):
+            tracemalloc.reset_peak()
+            call(name)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        row['peak_alloc_kib'] = round(peak / 1024, 1)
+        results[name] = row
+        print_row(runner, name, row)
+    with app.app_context():
+        hk.reactions.flush()
+    return results
+
+
+def run_uncached(hk, app, state, routes, args):
+    # A cache of no entries misses every time; the stats are reset so the
+    # cached pass reports its own hit rate
+    hk.page_cache.max_entries = 0
+    try:
+        return run_test_client(hk, app, state, routes, args, runner='uncached')
+    finally:
+        hk.page_cache.max_entries = app.config['PAGE_CACHE_MAX_ENTRIES']
+        hk.page_cache.stats = dict.fromkeys(hk.page_cache.stats, 0)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_kib(pid):
+    # VmHWM of the gunicorn master and its workers (Linux only)
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if int(entry) != pid and ppid != pid:
+                continue
+            with open(f'/proc/{entry}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def run_gunicorn(workdir, db_path, state, routes, args):
+    port = free_port()
+    env = dict(os.environ, **app_env(workdir, db_path), HKINGDOM_BIND=f'127.0.0.1:{port}',
+               WEB_CONCURRENCY=str(args.gunicorn_workers), PYTHONPATH=REPO)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'),
+                               'streaming_service2:create_app()'], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.2)
+
+        def connect():
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            body = urllib.parse.urlencode({'email': 'user1@example.com', 'password': 'x'})
+            conn.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            resp = conn.getresponse()
+            resp.read()
+            return conn, resp.getheader('Set-Cookie', '').split(';')[0]
+
+        lock = threading.Lock()
+        results = {}
+        for name in routes:
+            method, path, form, login = ROUTES[name]
+            latencies, errors = [], [0]
+            remaining = [args.requests * args.concurrency]
+
+            def client():
+                conn, cookie = connect()
+                local = []
+                while True:
+                    with lock:
+                        if remaining[0] <= 0:
+                            break
+                        remaining[0] -= 1
+                        url = path(state)
+                        body = urllib.parse.urlencode(form(state)) if form else None
+                    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+                    if login:
+                        headers['Cookie'] = cookie
+                    start = time.perf_counter()
+                    conn.request(method, url, body, headers)
+                    resp = conn.getresponse()
+                    resp.read()
+                    local.append(time.perf_counter() - start)
+                    if resp.status >= 400:
+                        errors[0] += 1
+                conn.close()
+                with lock:
+                    latencies.extend(local)
+
+            threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+            wall = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - wall
+            row = summarize(latencies, wall)
+            row['errors'] = errors[0]
+            results[name] = row
+            print_row('gunicorn', name, row)
+        results['_peak_rss_kib'] = peak_rss_kib(server.pid)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_row(runner, name, row):
+    extra = f" sql={row['sql_per_request']:<6} peak={row['peak_alloc_kib']}KiB" if 'sql_per_request' in row else ''
+    print(f"{runner:<9} {name:<24} {row['requests_per_sec']:>8}/s p50={row['p50_ms']:<7} "
+          f"p95={row['p95_ms']:<7} p99={row['p99_ms']:<7}{extra}", flush=True)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    for runner in ('uncached', 'client', 'gunicorn'):
+        for name, row in after.get(runner, {}).items():
+            old = before.get(runner, {}).get(name)
+            if not isinstance(row, dict) or not isinstance(old, dict):
+                continue
+            changes = []
+            for key in ('p50_ms', 'p99_ms', 'requests_per_sec', 'sql_per_request', 'peak_alloc_kib'):
+                if key in row and old.get(key):
+                    changes.append(f"{key} {old[key]} -> {row[key]} ({(row[key] - old[key]) / old[key]:+.0%})")
+            print(f"{runner:<9} {name:<24} " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--volume', choices=list(VOLUMES), default='small')
+    for key in VOLUMES['small']:
+        parser.add_argument(f'--{key}', type=int, help=f'override the number of {key}')
+    parser.add_argument('--db', help='seeded database to create or reuse (default: a scratch file)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for data and request choices')
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route (per thread over HTTP)')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--memory-requests', type=int, default=20)
+    parser.add_argument('--gunicorn', action='store_true', help='also drive a local gunicorn over HTTP')
+    parser.add_argument('--gunicorn-workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8, help='HTTP client threads')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    volume = dict(VOLUMES[args.volume])
+    volume.update({key: getattr(args, key) for key in volume if getattr(args, key) is not None})
+    volume['users'] = max(volume['users'], volume['channels'])
+    workdir = tempfile.mkdtemp(prefix='hk-route-bench-')
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, 'bench.db')
+    fresh = not os.path.exists(db_path)
+    hk, app = import_app(workdir, db_path)
+    if fresh:
+        started = time.perf_counter()
+        seed(db_path, volume, random.Random(args.seed))
+        print(f"seeded {volume} in {time.perf_counter() - started:.1f}s", flush=True)
+
+    routes = [name for name in ROUTES if name in args.routes]
+    output = {
+        'meta': {
+            'volume': volume,
+            'reused_db': not fresh,
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                     capture_output=True, text=True).stdout.strip(),
+            'args': {k: v for k, v in vars(args).items() if k != 'compare'},
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        },
+    }
+    uncached = [name for name in routes if name in CACHED_ROUTES]
+    if uncached:
+        output['uncached'] = run_uncached(hk, app, State(db_path, random.Random(args.seed)), uncached, args)
+    output['client'] = run_test_client(hk, app, State(db_path, random.Random(args.seed)), routes, args)
+    output['client']['_page_cache'] = hk.page_cache.info()
+    if args.gunicorn:
+        output['gunicorn'] = run_gunicorn(workdir, db_path, State(db_path, random.Random(args.seed)), routes, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Read/write throughput of the SQLite storage settings across worker processes.
+
+    python benchmarks/sqlite_concurrency.py --workers 1 2 4 8 --seconds 5
+
+Every worker process imports the app against one scratch database, the way
+a gunicorn worker would, and runs threads that mix channel-page reads
+(grouped reaction counts plus the comment preview query) with comment
+writes. Each worker count is run twice:
+
+  baseline  rollback journal, synchronous=FULL, inline commits
+            (the settings the app had before SQLITE_PRAGMAS existed)
+  tuned     the app's SQLITE_PRAGMAS and write queue
+
+and the script prints operations per second, latency percentiles and how
+many operations failed with "database is locked".
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'baseline': {'HKINGDOM_SQLITE_PRAGMAS': '{"synchronous": "FULL"}',
+                 'HKINGDOM_SQLITE_WRITE_QUEUE': 'false'},
+    'tuned': {},
+}
+JOURNAL_MODES = {'baseline': 'DELETE', 'tuned': 'WAL'}
+
+
+def import_app(workdir, db_path, mode):
+    os.environ['HKINGDOM_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    os.environ.update(MODES[mode])
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    import streaming_service2
+    app = streaming_service2.create_app()
+    with app.app_context():
+        streaming_service2.init_db()
+    return streaming_service2, app
+
+
+def seed(workdir, db_path, channels, videos_per_channel, comments_per_video):
+    import_app(workdir, db_path, 'tuned')
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO user (id, email, password) VALUES (?, ?, 'x')",
+                     ((i, f'user{i}@example.com') for i in range(1, channels + 1)))
+    conn.executemany("INSERT INTO channel (id, name, user_id) VALUES (?, ?, ?)",
+                     ((i, f'channel {i}', i) for i in range(1, channels + 1)))
+    conn.executemany("INSERT INTO video (title, filename, channel_id, uploaded_at) "
+                     "VALUES (?, 'x.mp4', ?, datetime('now'))",
+                     ((f'video {c}.{v}', c) for c in range(1, channels + 1)
+                      for v in range(videos_per_channel)))
+    video_count = channels * videos_per_channel
+    conn.executemany("INSERT INTO comment (content, user_id, video_id, created_at) "
+                     "VALUES ('seed comment', ?, ?, datetime('now'))",
+                     ((random.randint(1, channels), v) for v in range(1, video_count + 1)
+                      for _ in range(comments_per_video)))
+    conn.executemany("INSERT INTO like_dislike (user_id, video_id, value) VALUES (?, ?, ?)",
+                     ((u, v, random.choice((1, -1))) for v in range(1, video_count + 1)
+                      for u in random.sample(range(1, channels + 1), min(5, channels))))
+    conn.commit()
+    conn.close()
+
+
+def worker(workdir, db_path, mode, seconds, threads, write_ratio, results):
+    import threading
+    from sqlalchemy.exc import OperationalError
+
+    hk, app = import_app(workdir, db_path, mode)
+    with app.app_context():
+        hk.db.engine.dispose()
+        channels = hk.db.session.query(hk.Channel.id).count()
+        pages = {}
+        for video_id, channel_id in hk.db.session.query(hk.Video.id, hk.Video.channel_id):
+            pages.setdefault(channel_id, []).append(video_id)
+    pages = [ids[:10] for ids in pages.values()]
+    stats = {'read': [], 'write': [], 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def run():
+        rnd = random.Random()
+        local = {'read': [], 'write': [], 'locked': 0}
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                page = rnd.choice(pages)
+                kind = 'write' if rnd.random() < write_ratio else 'read'
+                start = time.perf_counter()
+                try:
+                    if kind == 'write':
+                        hk.run_write(hk.insert_row, hk.Comment(content='bench', video_id=rnd.choice(page),
+                                                               user_id=rnd.randint(1, channels)))
+                    else:
+                        hk.channel_reaction_counts(page)
+                        hk.channel_comments(page, 5)
+                except OperationalError:
+                    hk.db.session.rollback()
+                    local['locked'] += 1
+                    continue
+                finally:
+                    hk.db.session.remove()
+                local[kind].append(time.perf_counter() - start)
+        with lock:
+            stats['read'] += local['read']
+            stats['write'] += local['write']
+            stats['locked'] += local['locked']
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put(stats)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_case(workdir, db_path, mode, workers, args):
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'PRAGMA journal_mode={JOURNAL_MODES[mode]}')
+    conn.close()
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(workdir, db_path, mode, args.seconds, args.threads,
+                                              args.write_ratio, results))
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+    merged = {'read': [], 'write': [], 'locked': 0}
+    for _ in procs:
+        stats = results.get()
+        merged['read'] += stats['read']
+        merged['write'] += stats['write']
+        merged['locked'] += stats['locked']
+    for p in procs:
+        p.join()
+    row = {'mode': mode, 'workers': workers, 'locked_errors': merged['locked']}
+    for kind in ('read', 'write'):
+        row[f'{kind}s_per_sec'] = round(len(merged[kind]) / args.seconds, 1)
+        row[f'{kind}_p50_ms'] = round(percentile(merged[kind], 50) * 1000, 2)
+        row[f'{kind}_p99_ms'] = round(percentile(merged[kind], 99) * 1000, 2)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--channels', type=int, default=200)
+    parser.add_argument('--videos-per-channel', type=int, default=20)
+    parser.add_argument('--comments-per-video', type=int, default=10)
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hk-sqlite-bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    ctx = multiprocessing.get_context('spawn')
+    p = ctx.Process(target=seed, args=(workdir, db_path, args.channels, args.videos_per_channel,
+                                       args.comments_per_video))
+    p.start()
+    p.join()
+
+    rows = []
+    header = f"{'mode':<9} {'workers':>7} {'reads/s':>9} {'r p50':>7} {'r p99':>7} " \
+             f"{'writes/s':>9} {'w p50':>7} {'w p99':>8} {'locked':>7}"
+    print(header)
+    for workers in args.workers:
+        for mode in args.modes:
+            row = run_case(workdir, db_path, mode, workers, args)
+            rows.append(row)
+            print(f"{mode:<9} {workers:>7} {row['reads_per_sec']:>9} {row['read_p50_ms']:>7} "
+                  f"{row['read_p99_ms']:>7} {row['writes_per_sec']:>9} {row['write_p50_ms']:>7} "
+                  f"{row['write_p99_ms']:>8} {row['locked_errors']:>7}", flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
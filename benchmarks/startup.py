@@ -0,0 +1,120 @@
+"""Cold start time and memory of one app process, the way a gunicorn worker boots.
+
+    python benchmarks/startup.py --runs 10
+    python benchmarks/startup.py --repo /path/to/other/checkout
+    python benchmarks/startup.py --preload
+
+The schema is created once up front (flask init-db). Each run then starts
+a fresh interpreter that imports streaming_service2, builds the app
+(create_app(), or the module level app of older trees) and serves one
+request through the test client, recording:
+
+  import, app and first request time (ms), the number of loaded modules,
+  the peak RSS of the process (VmHWM) and how much of its memory is its
+  own rather than shared with another process (private_kib)
+
+and the script prints the median of every column over --runs runs.
+
+With --preload one interpreter imports and builds the app and every run
+is a fork of it, the way gunicorn.conf.py (preload_app) starts workers:
+import and app time are then paid once, in the master, and total_ms is
+the time from fork to the first response.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = r'''
+import json, os, sys, time
+
+def memory():
+    with open('/proc/self/status') as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    with open('/proc/self/smaps_rollup') as f:
+        private = sum(int(line.split()[1]) for line in f if line.startswith('Private_'))
+    return rss, private
+'''
+
+CHILD = MEASURE + r'''
+start = time.perf_counter()
+import streaming_service2
+imported = time.perf_counter()
+app = streaming_service2.create_app() if hasattr(streaming_service2, 'create_app') else streaming_service2.app
+created = time.perf_counter()
+status = app.test_client().get(sys.argv[1]).status_code
+served = time.perf_counter()
+rss, private = memory()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000, 'total_ms': (served - start) * 1000,
+                  'modules': len(sys.modules), 'peak_rss_kib': rss, 'private_kib': private, 'status': status}))
+'''
+
+PRELOADED = MEASURE + r'''
+import streaming_service2
+app = streaming_service2.create_app()
+for _ in range(int(sys.argv[2])):
+    read, write = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        status = app.test_client().get(sys.argv[1]).status_code
+        served = time.perf_counter()
+        rss, private = memory()
+        os.write(write, json.dumps({
+            'import_ms': 0.0, 'app_ms': 0.0, 'first_request_ms': (served - start) * 1000,
+            'total_ms': (served - start) * 1000, 'modules': len(sys.modules), 'peak_rss_kib': rss,
+            'private_kib': private, 'status': status}).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        print(f.read())
+    os.waitpid(pid, 0)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repo', default=REPO, help='checkout to measure (default: this one)')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/login', help='route served as the first request')
+    parser.add_argument('--preload', action='store_true', help='fork each run from one preloaded app')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hk-startup-bench-')
+    env = dict(os.environ, PYTHONPATH=args.repo,
+               HKINGDOM_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(workdir, 'bench.db'),
+               HKINGDOM_REACTION_LOG_FOLDER=os.path.join(workdir, 'reactions'),
+               HKINGDOM_METRICS_FOLDER=os.path.join(workdir, 'metrics'),
+               HKINGDOM_TEMPLATE_CACHE_FOLDER=os.path.join(workdir, 'templates'))
+    if os.path.exists(os.path.join(args.repo, 'streaming_service2.py')):
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'streaming_service2:create_app', 'init-db'],
+                       cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    if args.preload:
+        out = subprocess.run([sys.executable, '-c', PRELOADED, args.path, str(args.runs)], cwd=workdir,
+                             env=env, capture_output=True, text=True, check=True).stdout
+        runs = [json.loads(line) for line in out.strip().splitlines()[-args.runs:]]
+    else:
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, '-c', CHILD, args.path], cwd=workdir, env=env,
+                                 capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+    result = {key: round(statistics.median(run[key] for run in runs), 1) for key in runs[0]}
+    for key, value in result.items():
+        print(f'{key:<18} {value:>10}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'runs': runs, 'median': result}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
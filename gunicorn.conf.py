@@ -0,0 +1,37 @@
+# gunicorn -c gunicorn.conf.py 'streaming_service2:create_app()'
+import os
+
+bind = os.environ.get('HKINGDOM_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+# Several workers share rendered pages and their invalidations through
+# <instance>/page_cache.db, so a write shows on the next request whichever
+# worker takes it
+if workers > 1:
+    os.environ.setdefault('HKINGDOM_PAGE_CACHE_BACKEND', 'sqlite')
+# Threads share their worker's connection pool and write queue
+worker_class = 'gthread'
+threads = int(os.environ.get('HKINGDOM_THREADS', 4))
+# Import and build the app once in the master: a worker is then a fork
+# that serves at once and shares the imported modules' memory with the
+# master, instead of spending ~0.5 s and its own ~50 MB importing them
+preload_app = True
+
+
+def on_starting(server):
+    # Create the app folders and upgrade the schema once, in the master,
+    # before any worker starts (workers never do it themselves)
+    from streaming_service2 import init_db
+    with server.app.wsgi().app_context():
+        init_db()
+
+
+def post_fork(server, worker):
+    # The app (and its engine) is built in the master, by preload_app or
+    # on_starting; give each worker its own connections instead of
+    # inheriting those init_db opened
+    from streaming_service2 import db, reactions
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+    # The reaction flusher starts by replaying logs of dead workers, which
+    # shouldn't wait for this worker's first reaction
+    reactions.start()
@@ -1,25 +1,274 @@
-from flask import Flask, request, redirect, session, render_template_string, url_for, send_from_directory, abort
+from flask import Blueprint, Flask, Response, current_app, g, has_app_context, request, redirect, session, render_template, url_for, send_from_directory, abort, make_response, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import DictLoader, FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from sqlalchemy import event, func, insert, or_, select, text, tuple_, union_all
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-import os
-from PIL import Image
+from werkzeug.wsgi import wrap_file
+import click
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+import atexit
+import base64
+import contextlib
 import datetime
+import fcntl
+import glob
+import hashlib
+import itertools
+import json
+import math
+import mimetypes
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
 
 # === Setup ===
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'supersecret'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['UPLOAD_FOLDER'] = 'uploads'
-db = SQLAlchemy(app)
+class Config:
+    """Default settings. create_app() layers its `config` argument and then
+    HKINGDOM_* environment variables on top, e.g.
+    HKINGDOM_SQLALCHEMY_DATABASE_URI=sqlite:////srv/hk/app.db or
+    HKINGDOM_SQLITE_PRAGMAS__synchronous=FULL (values are parsed as JSON).
+    Folders left as None are derived from UPLOAD_FOLDER, VIDEO_FOLDER and
+    the instance folder."""
+
+    SECRET_KEY = 'supersecret'
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///app.db'
+    UPLOAD_FOLDER = 'uploads'
+    VIDEO_FOLDER = 'videos'
+    # Uploaded videos and channel icons are stored by content (see
+    # store_blob), e.g. VIDEO_FOLDER/3f/a2/3fa2…e9.mp4, once however many
+    # rows use them. Their URLs always mean the same bytes, so browsers may
+    # cache them for BLOB_MAX_AGE without revalidating. `flask gc-blobs`
+    # deletes blobs no row has used for BLOB_GC_GRACE seconds.
+    BLOB_MAX_AGE = 365 * 86400
+    BLOB_GC_GRACE = 86400
+
+    # SQLite storage settings, applied to every new connection. WAL lets reads
+    # run alongside a writer, busy_timeout makes a blocked writer wait instead of
+    # failing with "database is locked", and the page cache / mmap keep hot
+    # pages in memory. Each gunicorn worker gets its own connection pool.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # durable at checkpoints; safe with WAL
+        'busy_timeout': 5000,  # ms
+        'cache_size': -64 * 1024,  # negative means KiB
+        'mmap_size': 256 * 1024 ** 2,
+        'temp_store': 'MEMORY',
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 8, 'max_overflow': 16, 'pool_timeout': 10}
+    # Send write transactions through one writer thread per worker (see WriteQueue)
+    SQLITE_WRITE_QUEUE = True
+    SQLITE_WRITE_BATCH = 64
+
+    # Page sizes for the keyset-paginated listings
+    FEED_PAGE_SIZE = 50
+    CHANNELS_PAGE_SIZE = 50
+    CHANNEL_VIDEOS_PAGE_SIZE = 10
+    COMMENTS_PREVIEW_SIZE = 5
+    COMMENTS_PAGE_SIZE = 50
+    SEARCH_PAGE_SIZE = 20
+    SEARCH_MAX_PAGE = 50
+    # Every match of a query is ranked. Set a number to rank only the newest
+    # this-many matches instead: that bounds the cost of broad terms and
+    # short prefixes, but older matches can then never show up.
+    SEARCH_RANK_WINDOW = None
+
+    # Compiled templates, shared by workers so they don't each compile them
+    # again at boot (`flask init-db` creates the folder and fills it)
+    TEMPLATE_CACHE_FOLDER = None  # <instance>/templates
+
+    # Media metadata (duration, resolution, codec, bitrate) and a poster
+    # frame are extracted from every upload in the background. Posters are
+    # POSTER_HEIGHT pixels tall, in POSTER_FORMAT ('jpg' or 'webp').
+    POSTER_FOLDER = None  # VIDEO_FOLDER/posters
+    POSTER_FORMAT = 'jpg'
+    POSTER_HEIGHT = 360
+    MEDIA_PROBE_WORKERS = 1
+
+    # Trending feed (see refresh_trending). Engagement is the weighted sum
+    # of a video's likes, dislikes and comments, and halves in weight every
+    # TRENDING_HALF_LIFE_HOURS of the video's age. Each worker refreshes
+    # the changed videos every TRENDING_REFRESH_INTERVAL seconds (None to
+    # leave it to `flask refresh-trending` from cron).
+    TRENDING_WEIGHTS = {'like': 1.0, 'dislike': -0.5, 'comment': 2.0}
+    TRENDING_HALF_LIFE_HOURS = 48.0
+    TRENDING_REFRESH_INTERVAL = 60.0
+    TRENDING_HOME_SIZE = 10
+    TRENDING_PAGE_SIZE = 50
+    TRENDING_MAX_PAGE = 20
+
+    # View counting (see ViewCounter). Views are counted in memory, spread
+    # over VIEW_SHARDS locks, and written every VIEW_FLUSH_INTERVAL seconds
+    # as per-video, per-hour rollups. Unique viewers are a HyperLogLog
+    # sketch of 2^VIEW_HLL_PRECISION one-byte registers (about
+    # 1.04 / sqrt(2^p) relative error: 3% at p=10). Cached pages showing
+    # the flushed videos are re-rendered, but at most every
+    # VIEW_PAGE_REFRESH seconds per worker, so steady traffic doesn't keep
+    # emptying the page cache. A re-render reads this worker's counts
+    # exactly and other workers' up to VIEW_MAX_STALENESS seconds late.
+    # With a 'memory' PAGE_CACHE_BACKEND, other workers' cached pages keep
+    # older counts for up to PAGE_CACHE_TTL seconds.
+    VIEW_SHARDS = 8
+    VIEW_FLUSH_INTERVAL = 5.0
+    VIEW_PAGE_REFRESH = 60.0
+    VIEW_HLL_PRECISION = 10
+    VIEW_MAX_STALENESS = 30.0
+    VIEW_TOTALS_MAX = 100000
+
+    # Per-worker cache of channel names, icons and owners (see Directory).
+    # A rename shows up in other workers within DIRECTORY_TTL seconds.
+    DIRECTORY_MAX_ENTRIES = 50000
+    DIRECTORY_TTL = 60.0
+
+    # Media files (videos, HLS segments, posters); see send_media().
+    # MEDIA_OFFLOAD hands the transfer to the front proxy: 'x-accel' (nginx,
+    # which needs an internal location per entry of MEDIA_ACCEL_LOCATIONS,
+    # e.g. location /_media/videos/ { internal; alias /srv/hk/videos/; })
+    # or 'x-sendfile' (Apache, lighttpd). With None the app sends the file
+    # itself, with sendfile under gunicorn. Set MEDIA_SENDFILE to False when
+    # the server can't sendfile (gunicorn terminating TLS or run with
+    # --no-sendfile, other servers); files asked for MEDIA_HOT_HITS times
+    # are then memory-mapped, up to MEDIA_HOT_CACHE_BYTES in total and
+    # MEDIA_HOT_FILE_MAX each, instead of being read per request.
+    MEDIA_OFFLOAD = None
+    MEDIA_SENDFILE = True
+    MEDIA_ACCEL_LOCATIONS = {'VIDEO_FOLDER': '/_media/videos', 'HLS_FOLDER': '/_media/hls',
+                             'POSTER_FOLDER': '/_media/posters', 'UPLOAD_FOLDER': '/_media/uploads'}
+    VIDEO_MAX_AGE = 7 * 86400
+    MEDIA_HOT_HITS = 8
+    MEDIA_HOT_CACHE_BYTES = 256 * 1024 ** 2
+    MEDIA_HOT_FILE_MAX = 32 * 1024 ** 2
 
-# Ensure upload folders exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+    # HLS packaging: renditions go to HLS_FOLDER/<media key>/ (see media_key)
+    HLS_FOLDER = None  # VIDEO_FOLDER/hls
+    HLS_WORKERS = 2
+    HLS_SEGMENT_SECONDS = 6
 
-VIDEO_FOLDER = 'videos'
-if not os.path.exists(VIDEO_FOLDER):
-    os.makedirs(VIDEO_FOLDER)
-app.config['VIDEO_FOLDER'] = VIDEO_FOLDER
+    # Bulk ingest (`flask ingest`): INGEST_WORKERS processes (None for one
+    # per CPU) hash, copy and probe the files, and Video rows are inserted
+    # INGEST_BATCH per transaction. Each source gets a resume journal in
+    # INGEST_JOURNAL_FOLDER.
+    INGEST_WORKERS = None
+    INGEST_BATCH = 1000
+    INGEST_JOURNAL_FOLDER = None  # <instance>/ingest
+
+    # Resumable uploads: chunks are appended to PARTIAL_UPLOAD_FOLDER/<upload id>
+    PARTIAL_UPLOAD_FOLDER = None  # VIDEO_FOLDER/partial
+    RESUMABLE_MAX_SIZE = 8 * 1024 ** 3
+    RESUMABLE_MAX_CHUNK = 64 * 1024 ** 2
+    # Uploads not finished within this many seconds are dropped by
+    # `flask purge-uploads` and forgotten by the workers
+    RESUMABLE_EXPIRY = 86400
+
+    # Channel icons: fixed sizes are rendered into ICON_FOLDER at upload time,
+    # other sizes on demand into a bounded ICON_CACHE_FOLDER
+    ICON_SIZES = (48, 100, 150, 200, 300)
+    ICON_MAX_SIZE = 512
+    ICON_FOLDER = None  # UPLOAD_FOLDER/icons
+    ICON_CACHE_FOLDER = None  # UPLOAD_FOLDER/cache
+    ICON_CACHE_MAX_BYTES = 64 * 1024 ** 2
+    ICON_WORKERS = 2
+
+    # Admission control (see RateLimiter). RATE_LIMITS maps a bucket name
+    # to the endpoints drawing from it ('endpoint' or 'endpoint:METHOD')
+    # and its limits as (requests, seconds), per logged-in user and per
+    # client IP; a request needs a token from each. 'memory' keeps the
+    # buckets per worker, 'sqlite:<path>' shares them between workers on
+    # one host. CONCURRENCY_LIMITS_PER_WORKER caps the requests of an
+    # endpoint each worker process runs at once, so the host runs up to
+    # workers x limit of them; size it with WEB_CONCURRENCY in mind. A
+    # request waits CONCURRENCY_WAIT seconds for a slot, then gets a 503.
+    # Cached pages only take a slot to render a miss; hits are always
+    # served. Behind a proxy, make request.remote_addr the client's
+    # address (werkzeug's ProxyFix) so IP limits apply per client.
+    RATE_LIMITS = {
+        'reactions': (('like_video', 'dislike_video', 'react_api'), {'user': (60, 60), 'ip': (300, 60)}),
+        'comments': (('comment_video', 'edit_comment:POST', 'delete_comment'), {'user': (10, 60), 'ip': (60, 60)}),
+        'uploads': (('upload_video:POST', 'create_resumable_upload'), {'user': (20, 3600), 'ip': (60, 3600)}),
+        'accounts': (('create_account:POST', 'login:POST', 'create_channel:POST'), {'ip': (20, 60)}),
+    }
+    RATE_LIMIT_BACKEND = 'memory'
+    RATE_LIMIT_MAX_KEYS = 100000
+    CONCURRENCY_LIMITS_PER_WORKER = {'upload_video:POST': 2, 'append_resumable_upload': 2, 'channel_page': 3, 'search': 2}
+    CONCURRENCY_WAIT = 0.5
+
+    # Rendered-page cache. 'memory' keeps entries per process and suits a
+    # single worker only: a write invalidates pages in the worker that took
+    # it, and the others keep serving the old page for up to PAGE_CACHE_TTL.
+    # 'sqlite:<path>' ('sqlite' alone: <instance>/page_cache.db) shares
+    # entries and invalidations between the workers on one host, and is what
+    # gunicorn.conf.py picks when it runs more than one. The JSON API only
+    # answers conditional requests (ETag, 304) with a shared backend.
+    PAGE_CACHE_BACKEND = 'memory'
+    PAGE_CACHE_MAX_ENTRIES = 2048
+    PAGE_CACHE_TTL = 300
+
+    # Likes/dislikes are buffered in memory and written in batches
+    # (see ReactionBuffer). The reacting worker shows a reaction at once.
+    # Other workers see it after it is flushed (REACTION_FLUSH_INTERVAL)
+    # and they reload the counts (REACTION_MAX_STALENESS). They only see
+    # the page invalidations with a shared PAGE_CACHE_BACKEND; with
+    # 'memory' their cached pages keep older counts for up to PAGE_CACHE_TTL.
+    REACTION_FLUSH_INTERVAL = 2.0
+    REACTION_MAX_STALENESS = 10.0
+    REACTION_LOG_FOLDER = None  # <instance>/reactions
+    REACTION_LOG_FSYNC = False
+    REACTION_COUNTS_MAX = 100000
+
+    # Request metrics for /metrics. Each worker keeps its own and writes a
+    # snapshot to METRICS_FOLDER every METRICS_FLUSH_INTERVAL seconds, so a
+    # scrape that lands on any worker reports the sum over all of them.
+    METRICS_FOLDER = None  # <instance>/metrics
+    METRICS_FLUSH_INTERVAL = 5.0
+    # Requests slower than this are logged with their SQL (None to disable)
+    SLOW_REQUEST_SECONDS = 1.0
+    SLOW_REQUEST_MAX_QUERIES = 100
+    # Sampling profiler: off unless enabled here. Then requests with
+    # ?_profile=1 (plus a PROFILE_SAMPLE_RATE fraction of all requests) are
+    # sampled every PROFILE_INTERVAL seconds and their folded stacks (the
+    # flamegraph.pl / speedscope input format) written to PROFILE_FOLDER.
+    PROFILE_REQUESTS = False
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_INTERVAL = 0.005
+    PROFILE_FOLDER = None  # <instance>/profiles
+
+def derived_folders(app):
+    return {
+        'HLS_FOLDER': os.path.join(app.config['VIDEO_FOLDER'], 'hls'),
+        'POSTER_FOLDER': os.path.join(app.config['VIDEO_FOLDER'], 'posters'),
+        'PARTIAL_UPLOAD_FOLDER': os.path.join(app.config['VIDEO_FOLDER'], 'partial'),
+        'ICON_FOLDER': os.path.join(app.config['UPLOAD_FOLDER'], 'icons'),
+        'ICON_CACHE_FOLDER': os.path.join(app.config['UPLOAD_FOLDER'], 'cache'),
+        'REACTION_LOG_FOLDER': os.path.join(app.instance_path, 'reactions'),
+        'METRICS_FOLDER': os.path.join(app.instance_path, 'metrics'),
+        'PROFILE_FOLDER': os.path.join(app.instance_path, 'profiles'),
+        'TEMPLATE_CACHE_FOLDER': os.path.join(app.instance_path, 'templates'),
+        'INGEST_JOURNAL_FOLDER': os.path.join(app.instance_path, 'ingest'),
+    }
+
+# Folders `flask init-db` creates; the rest are created when first used
+INIT_FOLDERS = ('UPLOAD_FOLDER', 'VIDEO_FOLDER', 'PARTIAL_UPLOAD_FOLDER', 'POSTER_FOLDER', 'ICON_FOLDER',
+                'ICON_CACHE_FOLDER', 'TEMPLATE_CACHE_FOLDER')
+
+db = SQLAlchemy()
+# Every route, hook and CLI command lives on this blueprint; create_app()
+# registers it (CLI commands at the top level: `flask init-db`)
+bp = Blueprint('hk', __name__, cli_group=None)
 
 # === Models ===
 class User(db.Model):
@@ -33,6 +282,9 @@ class Channel(db.Model):
     name = db.Column(db.String(80), nullable=False)
     icon = db.Column(db.String(200), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    __table_args__ = (
+        db.Index('ix_channel_user', 'user_id'),
+    )
 
 class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,6 +292,23 @@ class Video(db.Model):
     filename = db.Column(db.String(200), nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    hls_status = db.Column(db.String(20), nullable=True)  # None, 'pending', 'ready' or 'failed'
+    # Filled in by extract_media(); media_status works like hls_status
+    media_status = db.Column(db.String(20), nullable=True)
+    duration = db.Column(db.Float, nullable=True)  # seconds
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    video_codec = db.Column(db.String(20), nullable=True)
+    bitrate = db.Column(db.Integer, nullable=True)  # kbit/s, all streams
+    poster = db.Column(db.String(200), nullable=True)  # file name in POSTER_FOLDER
+    __table_args__ = (
+        # SQLite appends the rowid (id) to every index, so these also serve
+        # the (uploaded_at, id) keyset ordering used for pagination
+        db.Index('ix_video_uploaded', 'uploaded_at'),
+        db.Index('ix_video_channel_uploaded', 'channel_id', 'uploaded_at'),
+        # /videos/<filename> looks the video up to count the view
+        db.Index('ix_video_filename', 'filename'),
+    )
 
 Channel.videos = db.relationship('Video', backref='channel', lazy=True)
 
@@ -48,6 +317,66 @@ class LikeDislike(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
     value = db.Column(db.Integer, nullable=False)  # 1 = like, -1 = dislike
+    # Unix time of the reaction stored in `value`, so a late write of an
+    # older reaction (see apply_reactions) leaves a newer one alone
+    reacted_at = db.Column(db.Float, nullable=True)
+    __table_args__ = (
+        db.Index('ix_like_dislike_video_value', 'video_id', 'value'),
+        db.Index('ix_like_dislike_user_video', 'user_id', 'video_id'),
+    )
+
+class UploadSession(db.Model):
+    # An in-progress resumable upload; the Video row is only created once
+    # `received` reaches `length`
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    length = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+class Blob(db.Model):
+    # A content-addressed file (see store_blob). `refs` counts the rows
+    # naming it and is kept up to date by BLOB_TRIGGERS; touched_at is when
+    # it was last stored or lost a reference.
+    folder = db.Column(db.String(20), primary_key=True)  # config key: VIDEO_FOLDER or UPLOAD_FOLDER
+    name = db.Column(db.String(200), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+    touched_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_blob_unreferenced', 'touched_at', sqlite_where=text('refs <= 0')),
+    )
+
+class TrendingScore(db.Model):
+    # The materialized trending ranking, highest score first. Only videos
+    # with positive engagement have a row; see refresh_trending().
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        db.Index('ix_trending_score_score', 'score'),
+    )
+
+class TrendingDirty(db.Model):
+    # Videos whose likes or comments changed since the last refresh,
+    # recorded by triggers (see TRENDING_TRIGGERS)
+    video_id = db.Column(db.Integer, primary_key=True)
+
+class VideoViews(db.Model):
+    # Hourly view rollup of one video, written by ViewCounter.flush().
+    # `viewers` is a HyperLogLog sketch (see hll_add).
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)  # hours since the Unix epoch
+    views = db.Column(db.Integer, nullable=False)
+    viewers = db.Column(db.LargeBinary, nullable=False)
+
+class VideoViewTotal(db.Model):
+    # All-time views of one video, so pages read one row instead of
+    # merging every hourly sketch
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    views = db.Column(db.Integer, nullable=False)
+    viewers = db.Column(db.LargeBinary, nullable=False)
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -56,9 +385,826 @@ class Comment(db.Model):
     video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        db.Index('ix_comment_video_created', 'video_id', 'created_at'),
+    )
+
+# --- Full-text search index ---
+# External-content FTS5 tables: the text lives only in the regular tables,
+# and triggers keep the index in step with every insert, update and
+# delete, whichever code path (or raw SQL) makes the change.
+SEARCH_INDEXES = {
+    # fts table: (content table, indexed column)
+    'video_fts': ('video', 'title'),
+    'channel_fts': ('channel', 'name'),
+    'comment_fts': ('comment', 'content'),
+}
+
+def search_index_ddl(fts, table, column):
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+    ]
 
-with app.app_context():
+def create_search_index(rebuild=False):
+    # A newly created index is filled from the existing rows
+    with db.engine.begin() as conn:
+        for fts, (table, column) in SEARCH_INDEXES.items():
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': fts}).first()
+            for statement in search_index_ddl(fts, table, column):
+                conn.execute(text(statement))
+            if rebuild or not exists:
+                conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+def upgrade_schema():
     db.create_all()
+    # create_all skips tables that already exist, so add any columns and
+    # indexes declared after the table was first created. New columns must
+    # be nullable for ALTER TABLE ADD COLUMN to work on existing rows.
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(db.engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    create_search_index()
+    with db.engine.begin() as conn:
+        for statement in TRENDING_TRIGGERS + BLOB_TRIGGERS:
+            conn.execute(text(statement))
+
+# Bump when upgrade_schema() learns something new; `flask init-db` runs it
+# for databases whose PRAGMA user_version is older
+SCHEMA_VERSION = 6
+
+def init_db():
+    # Create the app's folders, fill the template cache and bring the schema
+    # up to SCHEMA_VERSION. Returns the version the database had before.
+    for key in INIT_FOLDERS:
+        os.makedirs(current_app.config[key], exist_ok=True)
+    current_app.jinja_env.bytecode_cache = FileSystemBytecodeCache(current_app.config['TEMPLATE_CACHE_FOLDER'])
+    # create_app() already compiled them; compile again to write the cache
+    current_app.jinja_env.cache.clear()
+    for name in TEMPLATES:
+        current_app.jinja_env.get_template(name)
+    with db.engine.connect() as conn:
+        version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+    if version < SCHEMA_VERSION:
+        upgrade_schema()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return version
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create the app's folders and create or upgrade the database schema."""
+    version = init_db()
+    if version < SCHEMA_VERSION:
+        print(f"Upgraded schema from version {version} to {SCHEMA_VERSION}")
+    else:
+        print(f"Schema is up to date (version {version})")
+
+def sqlite_pragma_listener(pragmas):
+    def apply_sqlite_pragmas(dbapi_conn, _record):
+        if not isinstance(dbapi_conn, sqlite3.Connection):
+            return
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return apply_sqlite_pragmas
+
+def register_sqlite_functions(dbapi_conn, _record):
+    # SQL functions the app's queries use
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    dbapi_conn.create_function('hll_merge', 2, hll_merge, deterministic=True)
+
+# === Storage ===
+class WriteQueue:
+    """Funnels write transactions through a single thread per worker.
+
+    A job is a function that makes its changes on db.session without
+    committing and returns plain values (ids, counts), never ORM objects.
+    The writer runs every job that is waiting when it wakes up inside one
+    transaction and commits once (group commit), so a burst of likes and
+    comments costs one fsync instead of one each and threads in this worker
+    never fight over SQLite's write lock. If a batch fails it is rolled back
+    and its jobs are retried one by one, so one bad job only fails itself.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.max_batch = 1
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        # A running writer moves on to the new app with its next batch
+        self.app = app
+        self.max_batch = app.config['SQLITE_WRITE_BATCH']
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+                self.thread.start()
+        future = Future()
+        self.jobs.put((future, fn, args))
+        return future
+
+    def in_writer(self):
+        return threading.current_thread() is self.thread
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                self.commit(batch)
+
+    def commit(self, batch):
+        try:
+            results = [fn(*args) for _, fn, args in batch]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0][0].set_exception(e)
+            else:
+                for job in batch:
+                    self.commit([job])
+            return
+        for (future, _, _), result in zip(batch, results):
+            future.set_result(result)
+
+write_queue = WriteQueue()
+
+def run_write(fn, *args):
+    # Run a write job (see WriteQueue) and return its result once committed
+    if current_app.config['SQLITE_WRITE_QUEUE'] and not write_queue.in_writer():
+        return write_queue.submit(fn, *args).result()
+    result = fn(*args)
+    db.session.commit()
+    return result
+
+def insert_row(obj):
+    # `obj` must be a new object with only column values (no relationships
+    # to objects loaded in another session)
+    db.session.add(obj)
+    db.session.flush()
+    return obj.id
+
+# === Blob storage ===
+# Files are named by the sha256 of their content, sharded over two levels
+# of 256 folders so no folder grows huge. Identical uploads share one file;
+# the blob table counts the rows using each one.
+BLOB_NAME = re.compile(r'[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[a-z0-9]{1,10})?')
+
+# Row columns holding blob names: (table, column) -> blob folder
+BLOB_REFERENCES = {
+    ('video', 'filename'): 'VIDEO_FOLDER',
+    ('channel', 'icon'): 'UPLOAD_FOLDER',
+}
+
+def blob_ref_sql(folder, row, column, delta):
+    return (f"UPDATE blob SET refs = refs {delta}, touched_at = datetime('now') "
+            f"WHERE folder = '{folder}' AND name = {row}.{column};")
+
+BLOB_TRIGGERS = [
+    statement
+    for (table, column), folder in BLOB_REFERENCES.items()
+    for statement in (
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_insert AFTER INSERT ON {table} BEGIN "
+        f"{blob_ref_sql(folder, 'new', column, '+ 1')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_delete AFTER DELETE ON {table} BEGIN "
+        f"{blob_ref_sql(folder, 'old', column, '- 1')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_blob_update AFTER UPDATE OF {column} ON {table} "
+        f"WHEN old.{column} IS NOT new.{column} BEGIN "
+        f"{blob_ref_sql(folder, 'old', column, '- 1')} {blob_ref_sql(folder, 'new', column, '+ 1')} END",
+    )
+]
+
+def blob_name(sha256, filename):
+    # The original extension is kept so the file is served with its type
+    ext = os.path.splitext(filename)[1].lower()
+    if not re.fullmatch(r'\.[a-z0-9]{1,10}', ext):
+        ext = ''
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+def is_blob_name(name):
+    return BLOB_NAME.fullmatch(name) is not None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(1024 ** 2):
+            digest.update(block)
+    return digest.hexdigest()
+
+def spool_stream(stream, folder):
+    # Copy an upload stream to a scratch file in `folder`, hashing it on the way
+    digest = hashlib.sha256()
+    path = os.path.join(folder, uuid.uuid4().hex)
+    with open(path, 'wb') as f:
+        while block := stream.read(COPY_BUFFER_SIZE):
+            digest.update(block)
+            f.write(block)
+    return path, digest.hexdigest()
+
+def touch_blobs(folder_key, blobs):
+    # Part of a write job: add (name, size) blobs or mark them used now,
+    # which keeps gc_blobs() off them for another BLOB_GC_GRACE seconds
+    db.session.execute(text(
+        "INSERT INTO blob (folder, name, size, refs, touched_at) VALUES (:folder, :name, :size, 0, :now) "
+        "ON CONFLICT (folder, name) DO UPDATE SET touched_at = excluded.touched_at"),
+        [{'folder': folder_key, 'name': name, 'size': size, 'now': datetime.datetime.utcnow()}
+         for name, size in blobs])
+
+def place_blob(folder_key, name, src, move=True):
+    # Put `src` in place as blob `name` unless the blob file exists already.
+    # Must follow touch_blobs() in the same write job: gc_blobs() deletes
+    # files inside its own write transaction, so it can't remove the file
+    # between this check and the commit.
+    dest = os.path.join(current_app.config[folder_key], name)
+    if os.path.exists(dest):
+        if move and os.path.exists(src):
+            os.remove(src)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if move:
+        os.replace(src, dest)
+    else:
+        tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+
+def save_blob(folder_key, name, size, src):
+    touch_blobs(folder_key, [(name, size)])
+    place_blob(folder_key, name, src)
+    return name
+
+def store_blob(folder_key, src, filename, sha256=None):
+    # Move the file at `src` into blob storage and return its blob name,
+    # for a row to reference within BLOB_GC_GRACE seconds
+    name = blob_name(sha256 or file_sha256(src), filename)
+    return run_write(save_blob, folder_key, name, os.path.getsize(src), src)
+
+def delete_unreferenced_blobs(cutoff, limit):
+    # Write job for `flask gc-blobs`. The files are removed before the
+    # transaction commits, so a concurrent save_blob() either finds the row
+    # gone and writes the file again, or touched it first and kept it.
+    rows = db.session.execute(text(
+        "DELETE FROM blob WHERE rowid IN (SELECT rowid FROM blob WHERE refs <= 0 AND touched_at < :cutoff "
+        "LIMIT :limit) RETURNING folder, name, size"), {'cutoff': cutoff, 'limit': limit}).all()
+    for folder_key, name, _ in rows:
+        paths = [os.path.join(current_app.config[folder_key], name)]
+        if folder_key == 'UPLOAD_FOLDER':
+            # Rendered icon sizes of a channel icon
+            paths += glob.glob(glob.escape(os.path.join(current_app.config['ICON_FOLDER'], name)) + '.*')
+        else:
+            # The video's poster and HLS ladder (see media_key)
+            key = os.path.splitext(name)[0]
+            paths += glob.glob(glob.escape(os.path.join(current_app.config['POSTER_FOLDER'], key)) + '.*')
+            shutil.rmtree(os.path.join(current_app.config['HLS_FOLDER'], key), ignore_errors=True)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return [tuple(row) for row in rows]
+
+@bp.cli.command('gc-blobs')
+@click.option('--grace', type=float, help='Seconds a blob must have been unused (default: BLOB_GC_GRACE).')
+@click.option('--dry-run', is_flag=True, help='Only count what would be deleted.')
+def gc_blobs_command(grace, dry_run):
+    """Delete stored videos and icons that no row references."""
+    grace = current_app.config['BLOB_GC_GRACE'] if grace is None else grace
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace)
+    if dry_run:
+        count, size = db.session.query(func.count(), func.coalesce(func.sum(Blob.size), 0)).filter(
+            Blob.refs <= 0, Blob.touched_at < cutoff).one()
+        print(f"Would delete {count} blobs ({size / 1024 ** 2:.1f} MiB)")
+        return
+    count = size = 0
+    while True:
+        rows = run_write(delete_unreferenced_blobs, cutoff, 1000)
+        count += len(rows)
+        size += sum(row[2] for row in rows)
+        if len(rows) < 1000:
+            break
+    print(f"Deleted {count} blobs ({size / 1024 ** 2:.1f} MiB)")
+
+def adopt_legacy_file(folder_key, table, column, old, name, size, path):
+    # Write job for `flask migrate-blobs`: store the file and point every
+    # row naming it at the blob
+    save_blob(folder_key, name, size, path)
+    db.session.execute(text(f"UPDATE {table} SET {column} = :name WHERE {column} = :old"),
+                       {'name': name, 'old': old})
+
+def adopt_legacy_media(video_ids, key):
+    # The ladders and posters migrated videos had per video move to the
+    # blob's media key, keeping one copy per blob
+    hls, posters = current_app.config['HLS_FOLDER'], current_app.config['POSTER_FOLDER']
+    for video_id, poster in db.session.query(Video.id, Video.poster).filter(Video.id.in_(video_ids)):
+        old_dir, new_dir = os.path.join(hls, str(video_id)), os.path.join(hls, key)
+        if os.path.isdir(old_dir):
+            if os.path.exists(new_dir):
+                shutil.rmtree(old_dir)
+            else:
+                os.makedirs(os.path.dirname(new_dir), exist_ok=True)
+                os.replace(old_dir, new_dir)
+        if poster and poster.startswith(f'{video_id}.'):
+            new_poster = key + os.path.splitext(poster)[1]
+            old_path, new_path = os.path.join(posters, poster), os.path.join(posters, new_poster)
+            if os.path.exists(new_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(old_path)
+            elif os.path.exists(old_path):
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.replace(old_path, new_path)
+            else:
+                continue
+            run_write(set_media_info, video_id, {'poster': new_poster})
+
+@bp.cli.command('migrate-blobs')
+def migrate_blobs_command():
+    """Move videos and icons stored under their upload names into blob storage."""
+    for (table, column), folder_key in BLOB_REFERENCES.items():
+        names = {name for (name,) in db.session.execute(
+            text(f"SELECT DISTINCT {column} FROM {table} WHERE {column} IS NOT NULL")) if not is_blob_name(name)}
+        moved = missing = 0
+        for old in sorted(names):
+            path = os.path.join(current_app.config[folder_key], old)
+            if not os.path.isfile(path):
+                missing += 1
+                continue
+            name = blob_name(file_sha256(path), old)
+            if folder_key == 'VIDEO_FOLDER':
+                video_ids = [vid for (vid,) in db.session.query(Video.id).filter_by(filename=old)]
+            run_write(adopt_legacy_file, folder_key, table, column, old, name, os.path.getsize(path), path)
+            if folder_key == 'VIDEO_FOLDER':
+                adopt_legacy_media(video_ids, os.path.splitext(name)[0])
+            elif folder_key == 'UPLOAD_FOLDER':
+                for variant in glob.glob(glob.escape(os.path.join(current_app.config['ICON_FOLDER'], old)) + '.*'):
+                    os.remove(variant)
+                queue_icon_variants(name)
+            moved += 1
+        print(f"{table}.{column}: moved {moved} files, {missing} missing")
+    invalidate_pages('feed', 'channels')
+
+# === Instrumentation ===
+class Histogram:
+    """A Prometheus histogram (or, without buckets, a counter) with labels."""
+
+    def __init__(self, name, doc, labels, buckets=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> bucket counts + [sum, count], or [total]
+        self.lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [0] * (len(self.buckets) + 2 if self.buckets else 1)
+            if self.buckets is None:
+                series[0] += amount
+                return
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[i] += 1
+            series[-2] += amount
+            series[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {json.dumps(values): list(series) for values, series in self.series.items()}
+
+    def exposition(self, snapshot):
+        kind = 'histogram' if self.buckets else 'counter'
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {kind}"]
+        for key, series in sorted(snapshot.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, json.loads(key)))
+            if not self.buckets:
+                lines.append(f"{self.name}{{{labels}}} {series[0]}")
+                continue
+            sep = "," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+METRICS = {
+    metric.name: metric for metric in [
+        Histogram('hk_request_duration_seconds',
+                  "Wall time from request start to the last byte of the body (for files, to handing it to the server).",
+                  ('endpoint', 'method', 'status'),
+                  (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+        Histogram('hk_request_sql_statements', "SQL statements executed per request.",
+                  ('endpoint',), (0, 1, 2, 5, 10, 20, 50, 100, 200)),
+        Histogram('hk_request_sql_seconds', "Time spent in SQL per request.",
+                  ('endpoint',), (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)),
+        Histogram('hk_response_bytes', "Response body size.",
+                  ('endpoint',), (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)),
+        Histogram('hk_file_bytes_served_total', "Bytes of files sent from the media folders.", ('folder',)),
+    ]
+}
+
+# File-serving endpoints and the folder their bytes count against
+FILE_ENDPOINTS = {
+    'uploaded_file': 'uploads',
+    'channel_icon': 'uploads',
+    'uploaded_video': 'videos',
+    'hls_file': 'videos',
+    'video_poster': 'videos',
+}
+
+def metrics_snapshot():
+    return {name: metric.snapshot() for name, metric in METRICS.items()}
+
+def metrics_path(pid):
+    return os.path.join(current_app.config['METRICS_FOLDER'], f'metrics-{pid}.json')
+
+def write_metrics_snapshot():
+    os.makedirs(current_app.config['METRICS_FOLDER'], exist_ok=True)
+    tmp = metrics_path(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(metrics_snapshot(), f)
+    os.replace(tmp, metrics_path(os.getpid()))
+
+def metrics_writer(app):
+    while True:
+        time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+        try:
+            with app.app_context():
+                write_metrics_snapshot()
+        except OSError as e:
+            app.logger.warning("Writing metrics snapshot failed: %s", e)
+
+metrics_thread = None
+
+def start_metrics_writer():
+    # Started on the first request, so it runs in the worker, not in a
+    # gunicorn master that imported the app with --preload
+    global metrics_thread
+    if metrics_thread is None or not metrics_thread.is_alive():
+        metrics_thread = threading.Thread(target=metrics_writer, args=(current_app._get_current_object(),),
+                                          name='metrics-writer', daemon=True)
+        metrics_thread.start()
+
+def merged_metrics():
+    # This process's live metrics plus the last snapshot of every other
+    # running worker. A restarted worker starts again from zero, which
+    # Prometheus treats as a counter reset.
+    merged = metrics_snapshot()
+    for path in glob.glob(os.path.join(current_app.config['METRICS_FOLDER'], 'metrics-*.json')):
+        pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+        if pid == os.getpid():
+            continue
+        if not pid_alive(pid):
+            # A scrape on another worker may have removed it already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in other.items():
+            target = merged.setdefault(name, {})
+            for key, values in series.items():
+                if key in target:
+                    target[key] = [a + b for a, b in zip(target[key], values)]
+                else:
+                    target[key] = values
+    return merged
+
+class SamplingProfiler:
+    """Samples one thread's stack at a fixed interval into folded stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+# Per-thread state of the request being served. Response bodies are
+# iterated on the same thread after the view returns, so this outlives
+# the request context; SQL run by the write queue's thread isn't counted.
+request_stats = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats = getattr(request_stats, 'current', None)
+    if stats is not None:
+        stats['sql_count'] += 1
+        stats['sql_seconds'] += elapsed
+        if len(stats['queries']) < stats['max_queries']:
+            stats['queries'].append((elapsed, statement))
+
+def sql_failed(context):
+    # A statement that raised never reaches after_cursor_execute, so drop
+    # its start time here or every later statement pops the wrong one.
+    # Registered per engine in create_app() (SQLAlchemy 2 only dispatches
+    # handle_error to engine or dialect listeners).
+    starts = context.connection.info.get('query_start') if context.connection is not None else None
+    if starts and context.statement is not None:
+        starts.pop()
+
+@bp.before_app_request
+def start_request_stats():
+    start_metrics_writer()
+    stats = {'start': time.perf_counter(), 'sql_count': 0, 'sql_seconds': 0.0, 'queries': [], 'profiler': None,
+             'max_queries': current_app.config['SLOW_REQUEST_MAX_QUERIES']}
+    if current_app.config['PROFILE_REQUESTS'] and (request.args.get('_profile')
+                                           or random.random() < current_app.config['PROFILE_SAMPLE_RATE']):
+        stats['profiler'] = SamplingProfiler(threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+    request_stats.current = stats
+
+@bp.after_app_request
+def finish_request_stats(response):
+    stats = getattr(request_stats, 'current', None)
+    if stats is None:
+        return response
+    app = current_app._get_current_object()  # record() runs after the app context is gone
+    endpoint = (request.endpoint or 'unmatched').rpartition('.')[2]
+    method, path = request.method, request.full_path
+    stats['bytes'] = 0
+    if response.is_streamed and not response.direct_passthrough:
+        # Count the body as it is sent; the page generators run here
+        body = response.response
+
+        def counted():
+            for chunk in body:
+                stats['bytes'] += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+        response.response = counted()
+    else:
+        stats['bytes'] = response.content_length or 0
+
+    def record():
+        request_stats.current = None
+        elapsed = time.perf_counter() - stats['start']
+        METRICS['hk_request_duration_seconds'].observe((endpoint, method, str(response.status_code)), elapsed)
+        METRICS['hk_request_sql_statements'].observe((endpoint,), stats['sql_count'])
+        METRICS['hk_request_sql_seconds'].observe((endpoint,), stats['sql_seconds'])
+        METRICS['hk_response_bytes'].observe((endpoint,), stats['bytes'])
+        if endpoint in FILE_ENDPOINTS:
+            METRICS['hk_file_bytes_served_total'].observe((FILE_ENDPOINTS[endpoint],), stats['bytes'])
+        slow = app.config['SLOW_REQUEST_SECONDS']
+        if slow is not None and elapsed >= slow:
+            queries = "".join(f"\n  {seconds * 1000:8.2f} ms  {' '.join(statement.split())}"
+                              for seconds, statement in stats['queries'])
+            app.logger.warning("Slow request: %s %s took %.3fs (%d SQL statements, %.3fs in SQL)%s",
+                               method, path, elapsed, stats['sql_count'], stats['sql_seconds'], queries)
+        if stats['profiler'] is not None:
+            os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+            out = os.path.join(app.config['PROFILE_FOLDER'], f"{endpoint}-{time.time():.3f}.folded")
+            with open(out, 'w') as f:
+                f.write(stats['profiler'].stop())
+            app.logger.info("Profile of %s %s written to %s", method, path, out)
+    if response.direct_passthrough:
+        # Files go to the server as-is (so it can use sendfile) and
+        # close hooks don't run for them
+        record()
+    else:
+        response.call_on_close(record)
+    return response
+
+@bp.route('/metrics')
+def metrics():
+    snapshot = merged_metrics()
+    lines = []
+    for name, metric in METRICS.items():
+        lines += metric.exposition(snapshot.get(name, {}))
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+# === Admission control ===
+# Writes and expensive pages are admitted through token buckets (per user
+# and per client IP, refilled continuously) and per-endpoint concurrency
+# slots, so one busy client gets 429s instead of queueing everyone else's
+# requests behind its commits.
+def take_tokens(state, buckets, now):
+    # One token-bucket step, shared by the backends. `state` maps bucket
+    # keys to (tokens, updated); `buckets` are (key, capacity, seconds)
+    # and refill to capacity in `seconds`. Takes a token from every bucket,
+    # or from none if one is empty. Returns (seconds until that bucket has
+    # a token again or 0.0 when admitted, new state).
+    refilled = {}
+    wait = 0.0
+    for key, capacity, seconds in buckets:
+        rate = capacity / seconds
+        tokens, updated = state.get(key, (capacity, now))
+        refilled[key] = tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+    if wait:
+        return wait, {}
+    return 0.0, {key: (tokens - 1, now) for key, tokens in refilled.items()}
+
+class MemoryRateBackend:
+    """Buckets of this worker, least recently used dropped past max_keys."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> (tokens, updated)
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self.lock:
+            state = {key: self.buckets[key] for key, _, _ in buckets if key in self.buckets}
+            wait, state = take_tokens(state, buckets, now)
+            for key, value in state.items():
+                self.buckets[key] = value
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+class SQLiteRateBackend:
+    """Buckets in a local SQLite file shared by all workers."""
+
+    def __init__(self, path, max_seconds):
+        self.path = path
+        self.max_seconds = max_seconds
+        self.local = threading.local()
+        self.takes = 0
+        self.conn().execute('CREATE TABLE IF NOT EXISTS rate_bucket ('
+                            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.conn = conn
+        return conn
+
+    def take(self, buckets):
+        # Wall-clock time, since the workers have to agree on it
+        now = time.time()
+        keys = [key for key, _, _ in buckets]
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            state = {key: (tokens, updated) for key, tokens, updated in conn.execute(
+                f"SELECT key, tokens, updated FROM rate_bucket WHERE key IN ({','.join('?' * len(keys))})", keys)}
+            wait, state = take_tokens(state, buckets, now)
+            conn.executemany("INSERT OR REPLACE INTO rate_bucket (key, tokens, updated) VALUES (?, ?, ?)",
+                             [(key, tokens, updated) for key, (tokens, updated) in state.items()])
+            self.takes += 1
+            if self.takes % 1000 == 0:
+                # Buckets untouched for the longest period are full again
+                conn.execute("DELETE FROM rate_bucket WHERE updated < ?", (now - self.max_seconds,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+def make_rate_backend(config):
+    backend = config['RATE_LIMIT_BACKEND']
+    if backend.startswith('sqlite:'):
+        periods = [seconds for _, limits in config['RATE_LIMITS'].values() for _, seconds in limits.values()]
+        return SQLiteRateBackend(backend[len('sqlite:'):], max(periods, default=0))
+    return MemoryRateBackend(config['RATE_LIMIT_MAX_KEYS'])
+
+class RateLimiter:
+    """Token buckets and concurrency slots per endpoint (see RATE_LIMITS)."""
+
+    def __init__(self):
+        self.rules = {}  # 'endpoint' or 'endpoint:METHOD' -> (bucket, limits)
+        self.slots = {}  # 'endpoint' or 'endpoint:METHOD' -> semaphore of this worker
+        self.backend = None
+        self.wait = 0.0
+
+    def init_app(self, app):
+        self.rules = {endpoint: (bucket, limits)
+                      for bucket, (endpoints, limits) in app.config['RATE_LIMITS'].items()
+                      for endpoint in endpoints}
+        self.slots = {endpoint: threading.BoundedSemaphore(limit)
+                      for endpoint, limit in app.config['CONCURRENCY_LIMITS_PER_WORKER'].items()}
+        self.wait = app.config['CONCURRENCY_WAIT']
+        self.backend = make_rate_backend(app.config) if self.rules else None
+
+    @staticmethod
+    def lookup(table, endpoint, method):
+        return table.get(f'{endpoint}:{method}') or table.get(endpoint)
+
+    def check(self, endpoint, method, user_id, ip):
+        # Seconds to wait before retrying, or 0.0 if the request may go ahead
+        rule = self.lookup(self.rules, endpoint, method)
+        if rule is None:
+            return 0.0
+        bucket, limits = rule
+        clients = {'user': user_id, 'ip': ip}
+        buckets = [(f'{bucket}|{kind}:{clients[kind]}', capacity, seconds)
+                   for kind, (capacity, seconds) in limits.items() if clients.get(kind) is not None]
+        return self.backend.take(buckets) if buckets else 0.0
+
+    def acquire(self, endpoint, method):
+        # The slot to release when the request ends, None if the endpoint
+        # is not capped, or False if no slot freed up in time
+        slot = self.lookup(self.slots, endpoint, method)
+        if slot is None:
+            return None
+        return slot if slot.acquire(timeout=self.wait) else False
+
+rate_limiter = RateLimiter()
+
+def overloaded(status, message, retry_after):
+    seconds = max(1, math.ceil(retry_after))
+    if request.path.startswith('/api/'):
+        resp = jsonify(error=message, retry_after=seconds)
+        resp.status_code = status
+    else:
+        resp = make_response(f"{message} Please try again in {seconds} seconds.", status)
+    resp.headers['Retry-After'] = str(seconds)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+def take_admission_slot():
+    # Holds a concurrency slot for the rest of the request, or returns the
+    # 503 to send if none freed up in time
+    slot = rate_limiter.acquire((request.endpoint or '').rpartition('.')[2], request.method)
+    if slot is False:
+        return overloaded(503, "The server is busy.", 1)
+    g.admission_slot = slot
+    return None
+
+@bp.before_app_request
+def admit_request():
+    endpoint = (request.endpoint or '').rpartition('.')[2]
+    wait = rate_limiter.check(endpoint, request.method, session.get('user_id'), request.remote_addr)
+    if wait:
+        return overloaded(429, "Too many requests.", wait)
+    # Cached pages take their slot on a cache miss (see cached_page)
+    if not getattr(current_app.view_functions.get(request.endpoint), 'page_cached', False):
+        return take_admission_slot()
+
+@bp.after_app_request
+def hold_admission_slot(response):
+    # Pages are streamed, so keep the slot until the server closes the body
+    slot = g.pop('admission_slot', None)
+    if slot is not None:
+        response.call_on_close(slot.release)
+    return response
+
+@bp.teardown_app_request
+def release_admission_slot(exc):
+    # The view failed before a response could take the slot
+    slot = g.pop('admission_slot', None)
+    if slot is not None:
+        slot.release()
 
 # === Helpers ===
 THEME_CSS = {
@@ -98,56 +1244,1635 @@ def current_theme():
         t = 'light'
     return t
 
+THEME_CSS_TEMPLATE = """
+:root {{
+  --bg: {bg};
+  --fg: {fg};
+  --muted: {muted};
+  --panel: {panel};
+  --accent: {accent};
+}}
+body {{ background: var(--bg); color: var(--fg); font-family: Arial, sans-serif; margin: 0; padding: 20px; }}
+a {{ color: var(--accent); text-decoration: none; }}
+.topbar {{ display:flex; gap:10px; align-items:center; margin-bottom:12px; }}
+.btn {{ background:var(--panel); border:1px solid var(--muted); padding:6px 10px; border-radius:6px; cursor:pointer; }}
+.panel {{ background: var(--panel); padding:12px; border-radius:8px; border:1px solid var(--muted); }}
+textarea {{ width:100%; }}
+"""
+
+# Each theme's stylesheet is built once and served from a URL carrying a
+# hash of its contents, so browsers can cache it for a year and pick up a
+# new URL whenever the CSS changes.
+THEME_STYLESHEETS = {}
+for _name, _colors in THEME_CSS.items():
+    _css = THEME_CSS_TEMPLATE.format(**_colors)
+    _fingerprint = hashlib.sha256(_css.encode()).hexdigest()[:12]
+    THEME_STYLESHEETS[_name] = (_css, _fingerprint,
+                                f"<link rel='stylesheet' href='/theme/{_name}.{_fingerprint}.css'>")
+
 def theme_style_block():
-    t = THEME_CSS[current_theme()]
-    return f"""
-    <style>
-      :root {{
-        --bg: {t['bg']};
-        --fg: {t['fg']};
-        --muted: {t['muted']};
-        --panel: {t['panel']};
-        --accent: {t['accent']};
-      }}
-      body {{ background: var(--bg); color: var(--fg); font-family: Arial, sans-serif; margin: 0; padding: 20px; }}
-      a {{ color: var(--accent); text-decoration: none; }}
-      .topbar {{ display:flex; gap:10px; align-items:center; margin-bottom:12px; }}
-      .btn {{ background:var(--panel); border:1px solid var(--muted); padding:6px 10px; border-radius:6px; cursor:pointer; }}
-      .panel {{ background: var(--panel); padding:12px; border-radius:8px; border:1px solid var(--muted); }}
-      textarea {{ width:100%; }}
-    </style>
+    return THEME_STYLESHEETS[current_theme()][2]
+
+# === Templates ===
+# Page templates live here and are compiled once at startup; render_template
+# then reuses the compiled version on every request.
+TEMPLATES = {
+    'topbar.html': '''
+        <div class='topbar'>
+          <strong>H Kingdom</strong>
+          <form action='/search' style='margin:0'>
+            <input type='search' name='q' value='{{ q or "" }}' placeholder='Search'>
+          </form>
+          <div style='margin-left:auto'>
+            <a class='btn' href='/set_theme/light'>Light</a>
+            <a class='btn' href='/set_theme/dark'>Dark</a>
+            <a class='btn' href='/set_theme/gold'>Gold</a>
+            <a class='btn' href='/set_theme/cyan'>Cyan</a>
+          </div>
+        </div>
+    ''',
+    'search.html': '''
+        {% include 'topbar.html' %}
+        <h1>Search</h1>
+        {% if not q %}<p>Type something to search videos, channels and comments.</p>{% endif %}
+        {% for kind, (rows, more) in results.items() %}
+        <div class='panel' style='margin-bottom:12px;'>
+          <h2>{{ kind|capitalize }}</h2>
+          {% for r in rows %}
+            {% if kind == 'videos' %}
+              <p><a href='/channel/{{ r.channel_id }}'>{{ r.snippet }}</a>
+                 <small style='color:var(--muted)'>by {{ r.channel_name }}</small></p>
+            {% elif kind == 'channels' %}
+              <p><a href='/channel/{{ r.id }}'>{{ r.snippet }}</a></p>
+            {% else %}
+              <p>“{{ r.snippet }}” <small style='color:var(--muted)'>on
+                 <a href='/video/{{ r.video_id }}/comments'>{{ r.video_title }}</a></small></p>
+            {% endif %}
+          {% else %}
+            <p>No {{ kind }} found.</p>
+          {% endfor %}
+          {% if more %}
+            <a class='btn' href='{{ url_for(".search", q=q, type=kind, page=page + 1) }}'>More {{ kind }} →</a>
+          {% endif %}
+        </div>
+        {% endfor %}
+    ''',
+    'create_account.html': '''
+        {% include 'topbar.html' %}
+        <div class='panel'>
+        <h2>Create Account</h2>
+        <form method="post">
+            Email: <input type="email" name="email" required><br><br>
+            Password: <input type="password" name="password" required><br><br>
+            <input class='btn' type="submit" value="Create Account">
+        </form>
+        <br>
+        Already have an account? <a href="/login">Login here</a>
+        </div>
+    ''',
+    'login.html': '''
+        {% include 'topbar.html' %}
+        <div class='panel'>
+        <h2>Login</h2>
+        <form method="post">
+            Email: <input type="email" name="email" required><br><br>
+            Password: <input type="password" name="password" required><br><br>
+            <input class='btn' type="submit" value="Login">
+        </form>
+        <br>
+        Don't have an account? <a href="/create_account">Create one here</a>
+        </div>
+    ''',
+    'create_channel.html': '''
+        {% include 'topbar.html' %}
+        <div class='panel'>
+        <h2>Create Channel</h2>
+        <form method="post" enctype="multipart/form-data">
+            Channel Name: <input type="text" name="name" required><br><br>
+            Channel Icon: <input type="file" name="icon" accept=".png,.jpg,.jpeg,.bmp,.tiff,.gif"><br><br>
+            <input class='btn' type="submit" value="Create Channel">
+        </form>
+        </div>
+    ''',
+    'upload_video.html': '''
+        {% include 'topbar.html' %}
+        <div class='panel'>
+        <h2>Upload Video to Your Channel</h2>
+        <form method="post" enctype="multipart/form-data">
+            Title: <input type="text" name="title" required><br><br>
+            Video File: <input type="file" name="video" accept="video/*" required><br><br>
+            <input class='btn' type="submit" value="Upload Video">
+            <progress id="upload-progress" value="0" max="1" style="display:none"></progress>
+        </form>
+        </div>
+        <script>
+        // Send the file in chunks to the resumable endpoint; if the page is
+        // reloaded or the connection drops, picking the same file again
+        // continues from the last chunk the server stored.
+        (function () {
+          var form = document.querySelector('form');
+          if (!window.fetch || !window.Blob || !Blob.prototype.slice) return;
+          var CHUNK = 8 * 1024 * 1024;
+          function b64(s) { return btoa(unescape(encodeURIComponent(s))); }
+          form.addEventListener('submit', async function (e) {
+            e.preventDefault();
+            var file = form.video.files[0], title = form.title.value;
+            var key = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+            var url = localStorage.getItem(key), offset = 0;
+            if (url) {
+              var head = await fetch(url, {method: 'HEAD'});
+              if (head.ok) offset = parseInt(head.headers.get('Upload-Offset'), 10);
+              else url = null;
+            }
+            if (!url) {
+              var created = await fetch('/upload_video/resumable', {method: 'POST', headers: {
+                'Tus-Resumable': '1.0.0', 'Upload-Length': String(file.size),
+                'Upload-Metadata': 'filename ' + b64(file.name) + ',title ' + b64(title)}});
+              if (!created.ok) { alert(await created.text()); return; }
+              url = created.headers.get('Location');
+              localStorage.setItem(key, url);
+            }
+            var progress = document.getElementById('upload-progress'), resp;
+            progress.style.display = '';
+            while (offset < file.size) {
+              resp = await fetch(url, {method: 'PATCH', body: file.slice(offset, offset + CHUNK), headers: {
+                'Tus-Resumable': '1.0.0', 'Upload-Offset': String(offset),
+                'Content-Type': 'application/offset+octet-stream'}});
+              if (!resp.ok) { alert('Upload interrupted, choose the file again to resume.'); return; }
+              offset = parseInt(resp.headers.get('Upload-Offset'), 10);
+              progress.value = offset / file.size;
+            }
+            localStorage.removeItem(key);
+            window.location = (resp && resp.headers.get('Content-Location')) || '/';
+          });
+        })();
+        </script>
+    ''',
+    'edit_comment.html': '''
+        {% include 'topbar.html' %}
+        <div class='panel'>
+          <h3>Edit Comment</h3>
+          <form method="post">
+            <textarea name="content" rows="4" required>{{content}}</textarea><br>
+            <input class='btn' type="submit" value="Save">
+          </form>
+        </div>
+    ''',
+}
+
+# === Directory cache ===
+ChannelInfo = namedtuple('ChannelInfo', 'id name icon user_id')
+
+class Directory:
+    """Cached channel facts: user id -> channel and channel id -> owner.
+
+    Two layers: a per-request dict on `g`, so a page asks the shared cache
+    at most once per key, over a per-worker LRU of up to `max_entries`
+    entries that expire after `ttl` seconds. Only existing channels are
+    cached. "This user has no channel yet" is always asked of the
+    database, so a channel created in another worker is seen at once;
+    renames are seen within `ttl` (or at once here, via invalidate()).
     """
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ('user' | 'channel', id) -> (ChannelInfo, loaded_at)
+
+    def init_app(self, app):
+        self.max_entries = app.config['DIRECTORY_MAX_ENTRIES']
+        self.ttl = app.config['DIRECTORY_TTL']
+
+    def request_layer(self):
+        if not has_app_context():
+            return {}
+        if 'directory' not in g:
+            g.directory = {}
+        return g.directory
+
+    def channel(self, channel_id):
+        """The ChannelInfo of `channel_id`, or None if there is no such channel."""
+        return self.prefetch(channel_ids=[channel_id]).get(('channel', channel_id))
+
+    def channel_for_user(self, user_id):
+        """The ChannelInfo of `user_id`'s channel, or None if they have none."""
+        return self.prefetch(user_ids=[user_id]).get(('user', user_id))
+
+    def prefetch(self, channel_ids=(), user_ids=()):
+        """Load many channels at once, by channel id and/or owner id.
+
+        Returns the request layer; a list page calls this with every id it
+        will render, then channel()/channel_for_user() are dict lookups.
+        """
+        layer = self.request_layer()
+        wanted = [('channel', i) for i in channel_ids] + [('user', i) for i in user_ids]
+        missing = [key for key in wanted if key not in layer]
+        if not missing:
+            return layer
+        now = time.time()
+        with self.lock:
+            for key in missing:
+                entry = self.entries.get(key)
+                if entry and now - entry[1] <= self.ttl:
+                    self.entries.move_to_end(key)
+                    layer[key] = entry[0]
+        missing = [key for key in missing if key not in layer]
+        if missing:
+            by_channel = {i for kind, i in missing if kind == 'channel'}
+            by_user = {i for kind, i in missing if kind == 'user'}
+            rows = (db.session.query(Channel.id, Channel.name, Channel.icon, Channel.user_id)
+                    .filter(or_(Channel.id.in_(by_channel), Channel.user_id.in_(by_user))).all())
+            with self.lock:
+                for row in rows:
+                    info = ChannelInfo(*row)
+                    for key in (('channel', info.id), ('user', info.user_id)):
+                        self.entries[key] = (info, now)
+                        self.entries.move_to_end(key)
+                        layer[key] = info
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            for key in missing:
+                layer.setdefault(key, None)
+        return layer
+
+    def invalidate(self, channel_id=None, user_id=None):
+        # After a channel is created, renamed or given a new icon
+        layer = self.request_layer()
+        with self.lock:
+            for key in (('channel', channel_id), ('user', user_id)):
+                self.entries.pop(key, None)
+                layer.pop(key, None)
+
+directory = Directory()
+
 def user_channel_name(user_id):
-    user = User.query.get(user_id)
-    if not user:
+    info = directory.channel_for_user(user_id)
+    if info:
+        return info.name
+    user = db.session.get(User, user_id)
+    return user.email if user else None
+
+def channel_reaction_counts(video_ids):
+    # One grouped query for the like/dislike totals of a page of videos
+    if not video_ids:
+        return {}, {}
+    rows = (db.session.query(LikeDislike.video_id, LikeDislike.value, func.count())
+            .filter(LikeDislike.video_id.in_(video_ids))
+            .group_by(LikeDislike.video_id, LikeDislike.value)
+            .all())
+    likes, dislikes = {}, {}
+    for video_id, value, count in rows:
+        if value == 1:
+            likes[video_id] = count
+        elif value == -1:
+            dislikes[video_id] = count
+    return likes, dislikes
+
+def comments_with_authors():
+    # Comments joined with their author's email and channel name
+    return (db.session.query(Comment, User.email, Channel.name)
+            .outerjoin(User, User.id == Comment.user_id)
+            .outerjoin(Channel, Channel.user_id == Comment.user_id))
+
+def author_display_name(email, channel_name):
+    return channel_name or email or "Unknown"
+
+def channel_comments(video_ids, limit):
+    # The first `limit` comments (oldest first) of every video on the page,
+    # fetched in one query. Each video gets its own index range scan with a
+    # LIMIT, so the cost does not depend on how many comments a video has.
+    # One extra row per video is fetched to tell whether there are more.
+    if not video_ids:
+        return {}, set()
+    per_video = []
+    for video_id in video_ids:
+        first = (select(Comment.id)
+                 .where(Comment.video_id == video_id)
+                 .order_by(Comment.created_at.asc(), Comment.id.asc())
+                 .limit(limit + 1)
+                 .subquery())
+        per_video.append(select(first.c.id))
+    rows = (comments_with_authors()
+            .filter(Comment.id.in_(union_all(*per_video)))
+            .all())
+    # Sorted here rather than with ORDER BY, which would make SQLite walk
+    # the whole (video_id, created_at) index instead of looking up the ids
+    rows.sort(key=lambda row: (row[0].video_id, row[0].created_at, row[0].id))
+    by_video = {}
+    for com, email, channel_name in rows:
+        by_video.setdefault(com.video_id, []).append((com, author_display_name(email, channel_name)))
+    has_more = set()
+    for video_id, comments in by_video.items():
+        if len(comments) > limit:
+            del comments[limit:]
+            has_more.add(video_id)
+    return by_video, has_more
+
+# --- Keyset pagination ---
+# Pages are addressed by the (timestamp, id) of the last row shown instead of
+# an OFFSET, so fetching a page costs the same however deep the user scrolls.
+def encode_cursor(ts, row_id):
+    return f"{ts.strftime('%Y%m%d%H%M%S%f')}-{row_id}"
+
+def decode_cursor(cursor):
+    try:
+        ts, row_id = cursor.split('-')
+        return datetime.datetime.strptime(ts, '%Y%m%d%H%M%S%f'), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+def keyset_page(query, ts_col, id_col, cursor, size, descending=True, key=None):
+    """Return (rows, next_cursor) for one page of `query` ordered by (ts_col, id_col).
+
+    `key` extracts the (timestamp, id) pair from a result row; by default the
+    row itself is used as the model instance.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        if descending:
+            query = query.filter(tuple_(ts_col, id_col) < position)
+        else:
+            query = query.filter(tuple_(ts_col, id_col) > position)
+    if descending:
+        query = query.order_by(ts_col.desc(), id_col.desc())
+    else:
+        query = query.order_by(ts_col.asc(), id_col.asc())
+    rows = query.limit(size + 1).all()
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        ts, row_id = key(rows[-1]) if key else (getattr(rows[-1], ts_col.key), rows[-1].id)
+        next_cursor = encode_cursor(ts, row_id)
+    return rows, next_cursor
+
+def next_page_link(endpoint, param, cursor, label="Next page →", **values):
+    if not cursor:
+        return ""
+    values[param] = cursor
+    return f"<p><a class='btn' href='{url_for(endpoint, **values)}'>{label}</a></p>"
+
+def render_comment(com, author_name, user_id):
+    edited = f" (edited {com.updated_at.strftime('%Y-%m-%d %H:%M:%S')})" if com.updated_at else ""
+    parts = ["<div style='border-top:1px solid var(--muted); padding-top:6px; margin-top:6px;'>",
+             f"<b>{author_name}</b> <small style='color:var(--muted)'>{com.created_at.strftime('%Y-%m-%d %H:%M:%S')}{edited}</small>",
+             f"<p>{com.content}</p>"]
+
+    # edit/delete buttons if current user is comment owner
+    if user_id and com.user_id == user_id:
+        parts.append(f"""
+        <form style='display:inline' method='get' action='/comment/{com.id}/edit'>
+          <button class='btn' type='submit'>Edit</button>
+        </form>
+        <form style='display:inline' method='post' action='/comment/{com.id}/delete' onsubmit="return confirm('Delete comment?');">
+          <button class='btn' type='submit'>Delete</button>
+        </form>
+        """)
+    parts.append("</div>")
+    return "".join(parts)
+
+# === Page cache ===
+# Rendered pages are cached under (path, theme, viewer) and tagged with the
+# entities they show ('feed', 'channels', 'channel:<id>', 'video:<id>',
+# 'user:<id>'). Every tag has a version number; a write bumps the versions
+# of the tags it touches, and an entry is only served while all of its tags
+# still have the versions that were current when rendering started. That
+# invalidates exactly the pages showing the changed entity, and with a
+# shared backend it works across workers too.
+class MemoryCacheBackend:
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tag_versions = {}
+        # Versions restart at 0 with the process; the epoch tells them apart
+        self.epoch = time.time()
+
+    def versions(self, tags):
+        with self.lock:
+            return {tag: self.tag_versions.get(tag, (0, 0.0))[0] for tag in tags}
+
+    def stamps(self, tags):
+        with self.lock:
+            return {tag: self.tag_versions.get(tag, (0, 0.0)) for tag in tags}
+
+    def bump(self, tags):
+        now = time.time()
+        with self.lock:
+            for tag in tags:
+                self.tag_versions[tag] = (self.tag_versions.get(tag, (0, 0.0))[0] + 1, now)
+
+    def load(self, key):
         return None
-    if user.channel:
-        return user.channel.name
-    return user.email
 
-# --- Theme route ---
-@app.route('/set_theme/<name>')
-def set_theme(name):
-    if name not in THEME_CSS:
-        name = 'light'
-    session['theme'] = name
-    # return to previous page if possible
-    ref = request.referrer or url_for('index')
-    return redirect(ref)
+    def store(self, key, entry):
+        pass
+
+    def delete(self, key):
+        pass
+
+class SQLiteCacheBackend:
+    """Entries and tag versions in a local SQLite file shared by all workers."""
+
+    shared = True
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.stores = 0
+        self._epoch = None
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            self.conn()
+        return self._epoch
+
+    def setup(self, conn):
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS page_cache_entry (
+                key TEXT PRIMARY KEY, body TEXT NOT NULL, versions TEXT NOT NULL,
+                expires REAL NOT NULL, stored REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_page_cache_entry_stored ON page_cache_entry (stored);
+            CREATE TABLE IF NOT EXISTS page_cache_version (
+                tag TEXT PRIMARY KEY, version INTEGER NOT NULL, updated REAL NOT NULL);
+        ''')
+        # The epoch row records when this file started counting versions
+        conn.execute("INSERT OR IGNORE INTO page_cache_version (tag, version, updated) VALUES ('', 0, ?)",
+                     (time.time(),))
+        self._epoch = conn.execute("SELECT updated FROM page_cache_version WHERE tag = ''").fetchone()[0]
+
+    def conn(self):
+        # Opened on first use, so building the app (in the gunicorn master,
+        # before init-db has made the folder) leaves no file open to fork
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            if self._epoch is None:
+                self.setup(conn)
+            self.local.conn = conn
+        return conn
+
+    def versions(self, tags):
+        tags = list(tags)
+        found = dict(self.conn().execute(
+            f"SELECT tag, version FROM page_cache_version WHERE tag IN ({','.join('?' * len(tags))})", tags))
+        return {tag: found.get(tag, 0) for tag in tags}
+
+    def stamps(self, tags):
+        tags = list(tags)
+        found = {tag: (version, updated) for tag, version, updated in self.conn().execute(
+            f"SELECT tag, version, updated FROM page_cache_version WHERE tag IN ({','.join('?' * len(tags))})",
+            tags)}
+        return {tag: found.get(tag, (0, 0.0)) for tag in tags}
+
+    def bump(self, tags):
+        now = time.time()
+        self.conn().executemany(
+            "INSERT INTO page_cache_version (tag, version, updated) VALUES (?, 1, ?) "
+            "ON CONFLICT(tag) DO UPDATE SET version = version + 1, updated = excluded.updated",
+            [(tag, now) for tag in tags])
+
+    def load(self, key):
+        row = self.conn().execute(
+            "SELECT body, versions, expires FROM page_cache_entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def store(self, key, entry):
+        body, versions, expires = entry
+        conn = self.conn()
+        conn.execute("INSERT OR REPLACE INTO page_cache_entry (key, body, versions, expires, stored) "
+                     "VALUES (?, ?, ?, ?, ?)", (key, body, json.dumps(versions), expires, time.time()))
+        self.stores += 1
+        if self.stores % 100 == 0:
+            # trim expired entries and anything past the size budget, oldest first
+            conn.execute("DELETE FROM page_cache_entry WHERE expires < ?", (time.time(),))
+            conn.execute("DELETE FROM page_cache_entry WHERE key IN (SELECT key FROM page_cache_entry "
+                         "ORDER BY stored DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def delete(self, key):
+        self.conn().execute("DELETE FROM page_cache_entry WHERE key = ?", (key,))
+
+class PageCache:
+    """Bounded LRU/TTL cache of rendered HTML in front of a version backend."""
+
+    def __init__(self, max_entries=0, ttl=0, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (body, versions, expires)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'expirations': 0}
+
+    def init_app(self, app):
+        self.max_entries = app.config['PAGE_CACHE_MAX_ENTRIES']
+        self.ttl = app.config['PAGE_CACHE_TTL']
+        self.backend = make_cache_backend(app.config)
+
+    def _stale(self, entry):
+        body, versions, expires = entry
+        if expires < time.time():
+            return 'expirations'
+        if self.backend.versions(versions) != versions:
+            return 'invalidations'
+        return None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and self.backend.shared:
+            entry = self.backend.load(key)
+        reason = self._stale(entry) if entry is not None else None
+        if reason:
+            self.discard(key)
+            entry = None
+        with self.lock:
+            if reason:
+                self.stats[reason] += 1
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self._put(key, entry)
+        return entry[0]
+
+    def snapshot(self, tags):
+        # Take the versions *before* rendering, so a write that lands while
+        # the page is being built leaves the stored entry already stale
+        return self.backend.versions(tags)
+
+    def set(self, key, body, versions):
+        entry = (body, versions, time.time() + self.ttl)
+        with self.lock:
+            self._put(key, entry)
+        self.backend.store(key, entry)
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        self.backend.delete(key)
+
+    def invalidate(self, *tags):
+        self.backend.bump(tags)
+
+    def validators(self, tags, key):
+        """Return (etag, last_modified) for a response built from `tags`.
+
+        The ETag changes whenever one of the tags is invalidated. The time
+        of the latest invalidation serves as Last-Modified (a Unix
+        timestamp), or None if that was less than a second ago and so
+        can't be told apart from a later change at HTTP-date resolution.
+        """
+        stamps = self.backend.stamps(tags)
+        versions = ",".join(f"{tag}={stamps[tag][0]}" for tag in sorted(stamps))
+        etag = hashlib.sha1(f"{self.backend.epoch}|{key}|{versions}".encode()).hexdigest()[:24]
+        updated = max([self.backend.epoch] + [u for _, u in stamps.values()])
+        return etag, (updated if time.time() - updated >= 1 else None)
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries),
+                        bytes=sum(len(e[0]) for e in self.entries.values()),
+                        backend='shared' if self.backend.shared else 'memory')
+
+def make_cache_backend(config):
+    backend = config['PAGE_CACHE_BACKEND']
+    if backend.startswith('sqlite:'):
+        return SQLiteCacheBackend(backend[len('sqlite:'):], config['PAGE_CACHE_MAX_ENTRIES'])
+    return MemoryCacheBackend()
+
+page_cache = PageCache()
+
+def invalidate_pages(*tags):
+    page_cache.invalidate(*tags)
+
+def cached_page(tags_for):
+    """Serve a GET route from the page cache.
+
+    `tags_for` gets the view arguments and returns the tags the page
+    depends on. Logged-in views are cached per user and also tagged
+    'user:<id>'; anonymous views share one entry.
+
+    The view is a generator of HTML chunks. On a miss the chunks are
+    streamed to the client as they are produced and the joined page is
+    stored once the generator finishes. Everything before the first yield
+    runs before the response starts, so lookups that 404 belong there.
+    Only a miss takes the endpoint's concurrency slot (see RateLimiter).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            user_id = session.get('user_id')
+            viewer = f'user:{user_id}' if user_id else 'anon'
+            key = f"{request.full_path}|{current_theme()}|{viewer}"
+            body = page_cache.get(key)
+            if body is not None:
+                return body
+            busy = take_admission_slot()
+            if busy is not None:
+                return busy
+            tags = list(tags_for(**kwargs))
+            if user_id:
+                tags.append(viewer)
+            versions = page_cache.snapshot(tags)
+            chunks = view(**kwargs)
+            first = next(chunks, "")
+
+            def stream():
+                parts = [first]
+                yield first
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield chunk
+                page_cache.set(key, "".join(parts), versions)
+            return Response(stream_with_context(stream()), mimetype='text/html')
+        wrapper.page_cached = True
+        return wrapper
+    return decorator
+
+def video_tag(v, width=480):
+    # Prefer the adaptive HLS playlist once it has been packaged; browsers
+    # without HLS support skip that source and play the original file.
+    # preload='none' keeps a listing from probing every video: until play
+    # is pressed the browser only fetches the poster.
+    sources = ""
+    if v.hls_status == 'ready':
+        sources += f"<source src='/hls/{media_key(v)}/master.m3u8?v={v.id}' type='application/vnd.apple.mpegurl'>"
+    sources += f"<source src='/videos/{v.filename}?v={v.id}' type='video/mp4'>"
+    poster = f" poster='/posters/{v.poster}'" if v.poster else ""
+    return (f"<video width='{width}' controls preload='none'{poster}>"
+            f"{sources}Your browser does not support the video tag.</video>")
+
+def format_duration(seconds):
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+def video_details(v, views=None):
+    # Upload time, plus duration and resolution once extract_media() ran,
+    # and (views, unique viewers) if given
+    details = [f"Uploaded: {v.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')}"]
+    if v.duration:
+        details.append(format_duration(v.duration))
+    if v.height:
+        details.append(f"{v.height}p")
+    if views:
+        details.append(format_views(*views))
+    return f"<small style='color:var(--muted)'>{' · '.join(details)}</small>"
+
+# === HLS packaging ===
+# Each upload is transcoded in the background into an adaptive-bitrate
+# ladder: one decode of the source, split and scaled to every rendition no
+# taller than the original, segmented into HLS_FOLDER/<media key>/<rendition>/.
+HLS_LADDER = [
+    # (name, height, video kbit/s, audio kbit/s)
+    ('1080p', 1080, 5000, 160),
+    ('720p', 720, 2800, 128),
+    ('480p', 480, 1400, 128),
+    ('360p', 360, 800, 96),
+]
+
+def media_key(v):
+    # Ladders and posters are made from the file, so videos stored as one
+    # blob share them: HLS_FOLDER/<key>/ and POSTER_FOLDER/<key>.<format>.
+    # Files from before blob storage have them per video.
+    return os.path.splitext(v.filename)[0] if is_blob_name(v.filename) else str(v.id)
+
+_media_locks = {}  # (kind, media key) -> [lock, users]
+_media_locks_lock = threading.Lock()
+
+@contextlib.contextmanager
+def media_lock(kind, key):
+    # One ffmpeg run per output in this worker, so identical uploads queued
+    # together are transcoded once and the later ones find the result
+    with _media_locks_lock:
+        entry = _media_locks.setdefault((kind, key), [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _media_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _media_locks[(kind, key)]
+
+def find_ffmpeg():
+    # A system ffmpeg if there is one, otherwise the binary bundled with
+    # imageio-ffmpeg (the imageio plugin package)
+    exe = shutil.which('ffmpeg')
+    if exe:
+        return exe
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        return None
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def probe_media(ffmpeg, path):
+    # `ffmpeg -i` with no output exits non-zero but prints the stream info
+    out = subprocess.run([ffmpeg, '-hide_banner', '-i', path],
+                         capture_output=True, text=True).stderr
+    info = {'width': None, 'height': None, 'video_codec': None, 'duration': None, 'bitrate': None,
+            'has_audio': ' Audio: ' in out}
+    m = re.search(r' Video: (\w+).*?, (\d{2,5})x(\d{2,5})', out)
+    if m:
+        info['video_codec'] = m.group(1)
+        info['width'], info['height'] = int(m.group(2)), int(m.group(3))
+    m = re.search(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)', out)
+    if m:
+        info['duration'] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    m = re.search(r'Duration: .*?, bitrate: (\d+) kb/s', out)
+    if m:
+        info['bitrate'] = int(m.group(1))
+    return info
+
+def hls_command(ffmpeg, src, out_dir, info, segment_seconds):
+    ladder = [r for r in HLS_LADDER if r[1] <= info['height']] or HLS_LADDER[-1:]
+    split = f"[0:v]split={len(ladder)}" + "".join(f"[v{i}]" for i in range(len(ladder)))
+    scales = [f"[v{i}]scale=-2:{height}[v{i}out]" for i, (_, height, _, _) in enumerate(ladder)]
+    cmd = [ffmpeg, '-y', '-hide_banner', '-loglevel', 'error', '-i', src,
+           '-filter_complex', ";".join([split] + scales)]
+    stream_map = []
+    for i, (name, height, video_kbps, audio_kbps) in enumerate(ladder):
+        cmd += ['-map', f'[v{i}out]',
+                f'-c:v:{i}', 'libx264', f'-b:v:{i}', f'{video_kbps}k',
+                f'-maxrate:v:{i}', f'{video_kbps * 107 // 100}k', f'-bufsize:v:{i}', f'{video_kbps * 3 // 2}k']
+        if info['has_audio']:
+            cmd += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', f'{audio_kbps}k']
+            stream_map.append(f'v:{i},a:{i},name:{name}')
+        else:
+            stream_map.append(f'v:{i},name:{name}')
+    if info['has_audio']:
+        cmd += ['-ac', '2']
+    cmd += ['-preset', 'veryfast', '-sc_threshold', '0',
+            # keyframe on every segment boundary so renditions switch cleanly
+            '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})',
+            '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(out_dir, '%v', 'seg_%05d.ts'),
+            '-master_pl_name', 'master.m3u8',
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(out_dir, '%v', 'index.m3u8')]
+    return cmd
+
+def package_hls(ffmpeg, src, out_dir, segment_seconds):
+    info = probe_media(ffmpeg, src)
+    if not info['height']:
+        raise ValueError(f"no video stream found in {src}")
+    # Build into a scratch directory and swap it in, so a half-written
+    # ladder is never served
+    tmp_dir = f"{out_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        subprocess.run(hls_command(ffmpeg, src, tmp_dir, info, segment_seconds),
+                       check=True, capture_output=True)
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        if not os.path.isfile(os.path.join(out_dir, 'master.m3u8')):
+            raise
+        # Another video stored as the same blob got there first
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+_ffmpeg_pools = {}
+_ffmpeg_pools_lock = threading.Lock()
+
+def ffmpeg_pool(name, workers_key):
+    # One pool per stage, so quick probes never wait behind transcodes.
+    # ffmpeg does the work in a subprocess, so threads are enough here.
+    with _ffmpeg_pools_lock:
+        if name not in _ffmpeg_pools:
+            _ffmpeg_pools[name] = ThreadPoolExecutor(max_workers=current_app.config[workers_key],
+                                                     thread_name_prefix=name)
+        return _ffmpeg_pools[name]
+
+def set_hls_status(video_id, status):
+    Video.query.filter_by(id=video_id).update({'hls_status': status})
+
+def package_video(app, video_id):
+    with app.app_context():
+        v = db.session.get(Video, video_id)
+        if v is None:
+            return
+        out_dir = os.path.join(current_app.config['HLS_FOLDER'], media_key(v))
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None and not os.path.isfile(os.path.join(out_dir, 'master.m3u8')):
+            current_app.logger.warning("HLS packaging skipped for video %s: ffmpeg not found", video_id)
+            run_write(set_hls_status, video_id, None)
+            return
+        src = os.path.join(current_app.config['VIDEO_FOLDER'], v.filename)
+        try:
+            with media_lock('hls', out_dir):
+                if not os.path.isfile(os.path.join(out_dir, 'master.m3u8')):
+                    package_hls(ffmpeg, src, out_dir, current_app.config['HLS_SEGMENT_SECONDS'])
+            status = 'ready'
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            current_app.logger.error("HLS packaging failed for video %s: %s", video_id, e)
+            status = 'failed'
+        run_write(set_hls_status, video_id, status)
+        invalidate_pages('feed', f'channel:{v.channel_id}')
+
+def queue_hls_packaging(video_id):
+    return ffmpeg_pool('hls', 'HLS_WORKERS').submit(package_video, current_app._get_current_object(), video_id)
+
+@bp.cli.command('package-hls')
+def package_hls_command():
+    """Package every video that has no HLS ladder yet."""
+    ids = [vid for (vid,) in db.session.query(Video.id)
+           .filter(or_(Video.hls_status.is_(None), Video.hls_status != 'ready'))]
+    print(f"Packaging {len(ids)} videos")
+    for future in [queue_hls_packaging(vid) for vid in ids]:
+        future.result()
+
+# === Media metadata and posters ===
+# A quick pass over each upload, separate from HLS packaging: one probe for
+# duration, resolution, codec and bitrate, and one decoded frame saved as
+# a small poster so listings can show it instead of loading the video.
+# Video columns filled from probe_media()
+MEDIA_INFO_FIELDS = ('duration', 'width', 'height', 'video_codec', 'bitrate')
+
+POSTER_FORMATS = {
+    # format: ffmpeg encoder options
+    'jpg': ['-c:v', 'mjpeg', '-q:v', '4'],
+    'webp': ['-c:v', 'libwebp', '-quality', '75'],
+}
+
+def extract_poster(ffmpeg, src, dest, info, height, fmt):
+    # A frame a little way in, since the first one is often black
+    at = min(info['duration'] * 0.1, 5.0) if info['duration'] else 0.0
+    tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        subprocess.run([ffmpeg, '-y', '-hide_banner', '-loglevel', 'error', '-ss', f'{at:.2f}', '-i', src,
+                        '-frames:v', '1', '-vf', f"scale=-2:{min(height, info['height'])}",
+                        *POSTER_FORMATS[fmt], '-f', 'image2', tmp],
+                       check=True, capture_output=True)
+        if not os.path.getsize(tmp):
+            raise ValueError(f"no frame decoded from {src}")
+        os.replace(tmp, dest)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+def set_media_info(video_id, fields):
+    Video.query.filter_by(id=video_id).update(fields)
+
+def extract_media(app, video_id):
+    with app.app_context():
+        v = db.session.get(Video, video_id)
+        if v is None:
+            return
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            current_app.logger.warning("Media extraction skipped for video %s: ffmpeg not found", video_id)
+            run_write(set_media_info, video_id, {'media_status': None})
+            return
+        src = os.path.join(current_app.config['VIDEO_FOLDER'], v.filename)
+        fmt = current_app.config['POSTER_FORMAT']
+        poster = f'{media_key(v)}.{fmt}'
+        dest = os.path.join(current_app.config['POSTER_FOLDER'], poster)
+        info = probe_media(ffmpeg, src)
+        fields = {key: info[key] for key in MEDIA_INFO_FIELDS}
+        try:
+            if not info['height']:
+                raise ValueError(f"no video stream found in {src}")
+            with media_lock('poster', dest):
+                if not os.path.isfile(dest):
+                    extract_poster(ffmpeg, src, dest, info, current_app.config['POSTER_HEIGHT'], fmt)
+            fields.update(poster=poster, media_status='ready')
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            current_app.logger.error("Media extraction failed for video %s: %s", video_id, e)
+            fields.update(poster=None, media_status='failed')
+        run_write(set_media_info, video_id, fields)
+        invalidate_pages('feed', f'channel:{v.channel_id}')
+        if (v.poster and v.poster != fields['poster'] and not db.session.query(Video.id)
+                .filter(Video.poster == v.poster, Video.id != video_id).first()):
+            # Left over from an earlier run with another POSTER_FORMAT
+            try:
+                os.remove(os.path.join(current_app.config['POSTER_FOLDER'], v.poster))
+            except OSError:
+                pass
+
+def queue_media_extraction(video_id):
+    return ffmpeg_pool('probe', 'MEDIA_PROBE_WORKERS').submit(extract_media, current_app._get_current_object(),
+                                                              video_id)
+
+def queue_video_processing(video_id):
+    # Everything a new upload goes through; the Video row must say
+    # media_status='pending' and hls_status='pending'
+    queue_media_extraction(video_id)
+    queue_hls_packaging(video_id)
+
+@bp.cli.command('extract-media')
+def extract_media_command():
+    """Extract metadata and a poster for every video that has none yet."""
+    ids = [vid for (vid,) in db.session.query(Video.id)
+           .filter(or_(Video.media_status.is_(None), Video.media_status != 'ready'))]
+    print(f"Extracting {len(ids)} videos")
+    for future in [queue_media_extraction(vid) for vid in ids]:
+        future.result()
+
+# === Bulk ingest and export ===
+# `flask ingest` brings in a back catalogue without the upload form:
+# hashing, copying and probing run in a process pool and Video rows are
+# inserted INGEST_BATCH at a time. `flask export` streams channels and
+# videos out as JSON lines, which `flask ingest` reads back as a manifest.
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi')
+
+def ingest_file(src, video_folder, partial_folder, ffmpeg):
+    # Runs in the ingest process pool, so it only takes plain arguments.
+    # Files not yet in blob storage are copied to a scratch file, which
+    # insert_videos() moves into place.
+    sha256 = file_sha256(src)
+    filename = blob_name(sha256, src)
+    tmp = None
+    if not os.path.exists(os.path.join(video_folder, filename)):
+        tmp = os.path.join(partial_folder, f'ingest-{uuid.uuid4().hex}')
+        shutil.copyfile(src, tmp)  # copy_file_range/sendfile where the OS has them
+    info = probe_media(ffmpeg, tmp or os.path.join(video_folder, filename)) if ffmpeg else {}
+    st = os.stat(src)
+    return dict({key: info.get(key) for key in MEDIA_INFO_FIELDS},
+                filename=filename, sha256=sha256, size=st.st_size, mtime=st.st_mtime, tmp=tmp)
+
+def title_from_filename(name):
+    return re.sub(r'[_\s]+', ' ', os.path.splitext(name)[0]).strip() or name
+
+def scan_ingest_source(source, channel):
+    # Returns (channel names, videos), each video a dict of path, title,
+    # channel name and upload time (None for the file's mtime). A directory
+    # is walked for video files, one channel per top-level folder unless
+    # `channel` is given; anything else is read as a JSON-lines manifest.
+    videos = []
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            top = os.path.relpath(root, source).split(os.sep)[0]
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS:
+                    videos.append({'path': os.path.abspath(os.path.join(root, name)),
+                                   'title': title_from_filename(name),
+                                   'channel': channel or (None if top == '.' else top), 'uploaded_at': None})
+        channels = set()
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        channels = {channel} if channel else set()
+        with open(source, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('type') == 'channel':
+                    channels.add(entry['name'])
+                elif entry.get('type', 'video') == 'video':
+                    if 'path' not in entry:
+                        raise click.UsageError(f"{source}:{line_no}: video has no path")
+                    uploaded_at = entry.get('uploaded_at')
+                    videos.append({'path': os.path.join(base, entry['path']),
+                                   'title': entry.get('title') or title_from_filename(os.path.basename(entry['path'])),
+                                   'channel': channel or entry.get('channel'),
+                                   'uploaded_at': datetime.datetime.fromisoformat(uploaded_at) if uploaded_at else None})
+    orphans = [v['path'] for v in videos if not v['channel']]
+    if orphans:
+        raise click.UsageError(f"{len(orphans)} videos have no channel (e.g. {orphans[0]}); pass --channel")
+    return channels | {v['channel'] for v in videos}, videos
+
+def ingest_channels(names):
+    # Channel id for each name; missing channels are created without an owner
+    ids = dict(db.session.query(Channel.name, func.min(Channel.id))
+               .filter(Channel.name.in_(names)).group_by(Channel.name))
+    for name in sorted(set(names) - ids.keys()):
+        ids[name] = insert_row(Channel(name=name))
+    return ids
+
+def insert_videos(rows, files):
+    # Bulk insert for ingest, after storing `files`: (blob name, size,
+    # scratch copy or None, source path) tuples. A (channel, file) pair
+    # that already has a row, e.g. from a run stopped before it wrote its
+    # journal, is not inserted again. Returns the video id of every row.
+    touch_blobs('VIDEO_FOLDER', [(name, size) for name, size, _, _ in files])
+    for name, _, tmp, src in files:
+        if tmp:
+            place_blob('VIDEO_FOLDER', name, tmp)
+        else:
+            # Stored when the pool looked; copied again if it has been deleted since
+            place_blob('VIDEO_FOLDER', name, src, move=False)
+    ids = {(channel_id, filename): video_id for video_id, channel_id, filename in
+           db.session.query(Video.id, Video.channel_id, Video.filename)
+           .filter(Video.filename.in_({row['filename'] for row in rows}))}
+    new = {}
+    for row in rows:
+        key = (row['channel_id'], row['filename'])
+        if key not in ids:
+            new.setdefault(key, row)
+    if new:
+        stmt = insert(Video).returning(Video.id, sort_by_parameter_order=True)
+        ids.update(zip(new, db.session.scalars(stmt, list(new.values()))))
+    return [ids[row['channel_id'], row['filename']] for row in rows]
+
+def ingest_journal_path(source):
+    name = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:16]
+    return os.path.join(current_app.config['INGEST_JOURNAL_FOLDER'], f'{name}.jsonl')
+
+def read_ingest_journal(path):
+    # (path, channel) of every video a previous run committed; a torn last
+    # line from a crash is ignored
+    done = set()
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                done.add((entry['path'], entry['channel']))
+    return done
+
+@bp.cli.command('ingest')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--channel', help='Channel for every video (default: one per top-level folder, '
+                                'or the manifest\'s "channel").')
+@click.option('--workers', type=int, help='Processes hashing, copying and probing (default: INGEST_WORKERS).')
+@click.option('--journal', type=click.Path(dir_okay=False), help='Resume journal (default: one per SOURCE).')
+@click.option('--no-probe', is_flag=True, help='Leave metadata to `flask extract-media`.')
+def ingest_command(source, channel, workers, journal, no_probe):
+    """Ingest a folder of videos or a JSON-lines manifest.
+
+    Manifest lines are {"path", "channel", "title", "uploaded_at"} objects
+    (relative paths are relative to the manifest), as `flask export`
+    writes them. An interrupted run picks up where it stopped.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    channels, videos = scan_ingest_source(source, channel)
+    journal = journal or ingest_journal_path(source)
+    done = read_ingest_journal(journal)
+    todo = [v for v in videos if (v['path'], v['channel']) not in done]
+    print(f"{len(videos)} videos in {source}, {len(videos) - len(todo)} already ingested")
+    channel_ids = run_write(ingest_channels, channels)
+    ffmpeg = None if no_probe else find_ffmpeg()
+    workers = workers or current_app.config['INGEST_WORKERS'] or os.cpu_count() or 1
+    batch_size = current_app.config['INGEST_BATCH']
+    args = (current_app.config['VIDEO_FOLDER'], current_app.config['PARTIAL_UPLOAD_FOLDER'], ffmpeg)
+    os.makedirs(os.path.dirname(os.path.abspath(journal)), exist_ok=True)
+    for key in ('VIDEO_FOLDER', 'PARTIAL_UPLOAD_FOLDER'):
+        os.makedirs(current_app.config[key], exist_ok=True)
+
+    started = time.perf_counter()
+    stats = {'ingested': 0, 'failed': 0, 'bytes': 0}
+    batch = []
+
+    def modified_at(mtime):
+        # Naive UTC, like the other timestamp columns
+        return datetime.datetime.fromtimestamp(mtime, datetime.timezone.utc).replace(tzinfo=None)
+
+    def flush(log):
+        rows = [dict({key: result[key] for key in MEDIA_INFO_FIELDS},
+                     title=video['title'], filename=result['filename'], channel_id=channel_ids[video['channel']],
+                     uploaded_at=video['uploaded_at'] or modified_at(result['mtime']),
+                     hls_status='pending', media_status='pending')
+                for video, result in batch]
+        files = [(result['filename'], result['size'], result['tmp'], video['path']) for video, result in batch]
+        video_ids = run_write(insert_videos, rows, files)
+        # Written after the commit; insert_videos() covers a crash in between
+        for (video, result), video_id in zip(batch, video_ids):
+            log.write(json.dumps({'path': video['path'], 'channel': video['channel'],
+                                  'video_id': video_id, 'sha256': result['sha256']}) + '\n')
+        log.flush()
+        stats['ingested'] += len(batch)
+        stats['bytes'] += sum(result['size'] for _, result in batch)
+        batch.clear()
+        elapsed = time.perf_counter() - started
+        print(f"{stats['ingested'] + stats['failed']}/{len(todo)} files, {stats['failed']} failed, "
+              f"{stats['bytes'] / 1024 ** 2:.0f} MiB, {stats['ingested'] / elapsed:.1f} files/s, "
+              f"{stats['bytes'] / 1024 ** 2 / elapsed:.1f} MiB/s", flush=True)
+
+    remaining = iter(todo)
+    pending = {}
+    # A fork server starts the processes: the db writer thread is already
+    # running, and a fork could copy a lock it holds (see icon_pool())
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    with pool, open(journal, 'a', encoding='utf-8') as log:
+        while True:
+            # A few files per process in flight, so huge sources are
+            # never queued in the pool all at once
+            for video in itertools.islice(remaining, workers * 4 - len(pending)):
+                pending[pool.submit(ingest_file, video['path'], *args)] = video
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                video = pending.pop(future)
+                try:
+                    batch.append((video, future.result()))
+                except OSError as e:
+                    stats['failed'] += 1
+                    print(f"Failed {video['path']}: {e}", flush=True)
+            if len(batch) >= batch_size:
+                flush(log)
+        if batch:
+            flush(log)
+    invalidate_pages('feed', 'channels', *(f'channel:{cid}' for cid in channel_ids.values()))
+    print(f"Ingested {stats['ingested']} videos ({stats['failed']} failed) in "
+          f"{time.perf_counter() - started:.1f}s. Run `flask extract-media` and `flask package-hls` "
+          f"for posters and HLS.")
+
+@bp.cli.command('export')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--channel', 'channel_ids', type=int, multiple=True, help='Only this channel id (repeatable).')
+def export_command(output, channel_ids):
+    """Write channels and videos as JSON lines (to stdout by default).
+
+    Rows are streamed from the database, so memory use does not grow with
+    the catalogue. Video paths are absolute, so the output can be ingested
+    into another instance as is.
+    """
+    started = time.perf_counter()
+    video_folder = os.path.abspath(current_app.config['VIDEO_FOLDER'])
+    channels = (select(Channel.id, Channel.name, Channel.icon, User.email)
+                .outerjoin(User, User.id == Channel.user_id).order_by(Channel.id))
+    videos = (select(Video.id, Video.channel_id, Channel.name.label('channel'), Video.title, Video.filename,
+                     Video.uploaded_at, *(getattr(Video, key) for key in MEDIA_INFO_FIELDS))
+              .join(Channel, Channel.id == Video.channel_id).order_by(Video.id))
+    if channel_ids:
+        channels = channels.where(Channel.id.in_(channel_ids))
+        videos = videos.where(Video.channel_id.in_(channel_ids))
+    count = 0
+    for row in db.session.execute(channels.execution_options(yield_per=1000)):
+        output.write(json.dumps({'type': 'channel', 'id': row.id, 'name': row.name, 'icon': row.icon,
+                                 'owner': row.email}) + '\n')
+    for row in db.session.execute(videos.execution_options(yield_per=1000)):
+        entry = {'type': 'video', 'id': row.id, 'channel_id': row.channel_id, 'channel': row.channel,
+                 'title': row.title, 'path': os.path.join(video_folder, row.filename),
+                 'uploaded_at': row.uploaded_at.isoformat() if row.uploaded_at else None}
+        entry.update({key: getattr(row, key) for key in MEDIA_INFO_FIELDS})
+        output.write(json.dumps(entry) + '\n')
+        count += 1
+    elapsed = time.perf_counter() - started
+    print(f"Exported {count} videos in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} videos/s)", file=sys.stderr)
+
+# === Channel icons ===
+# Pages never load the original upload; they ask /icon/<size>/<fmt>/<name>
+# for the pixel size they draw (plus a 2x variant through srcset).
+ICON_FORMATS = {
+    # url format: (PIL format, mimetype, save options)
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+def icon_variant_name(filename, size, fmt):
+    return f"{filename}.{size}.{fmt}"
+
+def render_icon(src_path, dest_path, size, fmt):
+    pil_format, _, options = ICON_FORMATS[fmt]
+    from PIL import Image, ImageOps
+    with Image.open(src_path) as img:
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        # icons are drawn square, so crop to the centre rather than squash
+        thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        thumb.save(tmp_path, pil_format, **options)
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+def render_icon_variants(src_path, dest_dir, filename, sizes):
+    # Runs in the icon process pool, so it only takes plain arguments
+    for size in sizes:
+        for fmt in ICON_FORMATS:
+            render_icon(src_path, os.path.join(dest_dir, icon_variant_name(filename, size, fmt)), size, fmt)
+
+_icon_pool = None
+_icon_pool_lock = threading.Lock()
+
+def icon_pool():
+    global _icon_pool
+    with _icon_pool_lock:
+        if _icon_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            # Resizing and encoding are CPU-bound, so use processes. They are
+            # started by a fork server: forking this multi-threaded worker
+            # could copy a lock another thread holds (logging, the pool, the
+            # db writer) into a child that then waits on it forever.
+            _icon_pool = ProcessPoolExecutor(max_workers=current_app.config['ICON_WORKERS'],
+                                             mp_context=multiprocessing.get_context('forkserver'))
+        return _icon_pool
+
+def queue_icon_variants(filename):
+    src_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    return icon_pool().submit(render_icon_variants, src_path, current_app.config['ICON_FOLDER'],
+                              filename, current_app.config['ICON_SIZES'])
+
+class IconCache:
+    """On-disk LRU for icon sizes rendered on demand.
+
+    A file's mtime is its last use: hits touch the file, and when the folder
+    grows past max_bytes the least recently used files are removed until it
+    is back under 90% of the budget. The size total is tracked per worker
+    and recomputed from the folder whenever an eviction runs.
+    """
+
+    def __init__(self, folder=None, max_bytes=0):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total = None
+
+    def init_app(self, app):
+        self.folder = app.config['ICON_CACHE_FOLDER']
+        self.max_bytes = app.config['ICON_CACHE_MAX_BYTES']
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def get(self, name):
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def added(self, name):
+        size = os.path.getsize(self.path(name))
+        with self.lock:
+            if self.total is None:
+                self.total = self.scan()[1]
+            else:
+                self.total += size
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries, sum(e[1] for e in entries)
+
+    def evict(self):
+        entries, total = self.scan()
+        entries.sort()
+        target = self.max_bytes * 9 // 10
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+icon_cache = IconCache()
+
+def icon_url(filename, size, fmt):
+    return url_for('.channel_icon', size=size, fmt=fmt, filename=filename)
+
+def icon_img(filename, size):
+    # <picture> so browsers that take WebP get it, with a 2x srcset for
+    # high-density screens and JPEG as the fallback
+    webp = f"{icon_url(filename, size, 'webp')} 1x, {icon_url(filename, size * 2, 'webp')} 2x"
+    jpg = f"{icon_url(filename, size, 'jpg')} 1x, {icon_url(filename, size * 2, 'jpg')} 2x"
+    return (f"<picture><source type='image/webp' srcset='{webp}'>"
+            f"<img src='{icon_url(filename, size, 'jpg')}' srcset='{jpg}' width='{size}' height='{size}' "
+            f"loading='lazy' alt=''></picture>")
+
+# --- Theme route ---
+@bp.route('/set_theme/<name>')
+def set_theme(name):
+    if name not in THEME_CSS:
+        name = 'light'
+    session['theme'] = name
+    # return to previous page if possible
+    ref = request.referrer or url_for('.index')
+    return redirect(ref)
+
+@bp.route('/theme/<name>.<fingerprint>.css')
+def theme_stylesheet(name, fingerprint):
+    if name not in THEME_STYLESHEETS:
+        abort(404)
+    css, current, _ = THEME_STYLESHEETS[name]
+    resp = make_response(css)
+    resp.mimetype = 'text/css'
+    if fingerprint == current:
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # an old fingerprint from a cached page: serve the current CSS briefly
+        resp.headers['Cache-Control'] = 'public, max-age=300'
+    resp.set_etag(current)
+    return resp.make_conditional(request)
+
+# === Trending feed ===
+# A video's trending score is E * 2^(-age / half-life), E being its weighted
+# engagement. As time passes every score shrinks by the same factor, so the
+# order only changes when some video's own counts change. The stored score
+# is therefore the time-independent log2(E) + uploaded_hours / half-life:
+# a full refresh computes it for every video, and the periodic refresh only
+# for the videos the triggers below marked dirty.
+TRENDING_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS {table}_trending_{event.lower()} AFTER {event}{columns} ON {table} BEGIN "
+    f"INSERT OR IGNORE INTO trending_dirty(video_id) VALUES ({row}.video_id); END"
+    for table, event, columns, row in [
+        ('like_dislike', 'INSERT', '', 'new'), ('like_dislike', 'DELETE', '', 'old'),
+        ('like_dislike', 'UPDATE', ' OF value', 'new'),
+        ('comment', 'INSERT', '', 'new'), ('comment', 'DELETE', '', 'old'),
+    ]
+]
+# Hours are counted from here (2024-01-01) to keep the stored scores small
+TRENDING_EPOCH_JULIANDAY = 2460310.5
+
+def select_for_videos(conn, sql, column, video_ids):
+    # Runs `sql` (with a {where} slot) for every video, or in chunks for
+    # just `video_ids`. Uses the DBAPI cursor: NumPy converts its plain
+    # tuples far faster than SQLAlchemy rows.
+    cursor = conn.connection.cursor()
+    try:
+        if video_ids is None:
+            return cursor.execute(sql.format(where='')).fetchall()
+        rows = []
+        for i in range(0, len(video_ids), 500):
+            chunk = tuple(video_ids[i:i + 500])
+            where = f"WHERE {column} IN ({','.join('?' * len(chunk))})"
+            rows += cursor.execute(sql.format(where=where), chunk).fetchall()
+        return rows
+    finally:
+        cursor.close()
+
+def trending_scores(conn, video_ids=None):
+    """Return (ids, scores) arrays for every video, or only `video_ids`.
+
+    Counts come from three grouped index scans; scoring happens on whole
+    NumPy arrays. Videos without positive engagement get a score of -inf.
+    """
+    import numpy as np
+    videos = np.array(select_for_videos(conn, "SELECT id, julianday(uploaded_at) FROM video {where}",
+                                        'id', video_ids), dtype=np.float64).reshape(-1, 2)
+    reacts = np.array(select_for_videos(conn, "SELECT video_id, value, count(*) FROM like_dislike {where} "
+                                              "GROUP BY video_id, value", 'video_id', video_ids),
+                      dtype=np.int64).reshape(-1, 3)
+    comments = np.array(select_for_videos(conn, "SELECT video_id, count(*) FROM comment {where} "
+                                                "GROUP BY video_id", 'video_id', video_ids),
+                        dtype=np.int64).reshape(-1, 2)
+    ids = videos[:, 0].astype(np.int64)
+    size = int(max(ids.max(initial=0), reacts[:, 0].max(initial=0), comments[:, 0].max(initial=0))) + 1
+    weights = current_app.config['TRENDING_WEIGHTS']
+    # Per-video engagement, indexed by video id
+    engagement = np.bincount(reacts[:, 0], minlength=size,
+                             weights=reacts[:, 2] * np.where(reacts[:, 1] > 0, weights['like'], weights['dislike']))
+    engagement += np.bincount(comments[:, 0], weights=comments[:, 1] * weights['comment'], minlength=size)
+    engagement = engagement[ids]
+    hours = (videos[:, 1] - TRENDING_EPOCH_JULIANDAY) * 24
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(engagement > 0, np.log2(engagement), -np.inf)
+    return ids, scores + hours / current_app.config['TRENDING_HALF_LIFE_HOURS']
+
+def take_trending_dirty(full):
+    conn = db.session.connection()
+    ids = [] if full else [vid for (vid,) in conn.exec_driver_sql("SELECT video_id FROM trending_dirty")]
+    conn.exec_driver_sql("DELETE FROM trending_dirty")
+    return ids
+
+def store_trending(video_ids, rows):
+    # Replace the rows of `video_ids` (every row if None) with `rows`
+    conn = db.session.connection()
+    if video_ids is None:
+        conn.exec_driver_sql("DELETE FROM trending_score")
+    elif video_ids:
+        conn.exec_driver_sql("DELETE FROM trending_score WHERE video_id = ?", [(vid,) for vid in video_ids])
+    if rows:
+        conn.exec_driver_sql("INSERT INTO trending_score (video_id, score) VALUES (?, ?)", rows)
+
+def refresh_trending(full=False):
+    """Rescore the videos marked dirty, or every video if `full`.
+
+    Returns how many videos were rescored. Changes made while this runs
+    are marked dirty again by the triggers and picked up next time.
+    """
+    import numpy as np
+    dirty = run_write(take_trending_dirty, full)
+    if not full and not dirty:
+        return 0
+    with db.engine.connect() as conn:
+        ids, scores = trending_scores(conn, None if full else dirty)
+    keep = np.isfinite(scores)
+    # In video id order, so the inserts append to the table's b-tree
+    order = np.argsort(ids[keep], kind='stable')
+    rows = list(zip(ids[keep][order].tolist(), scores[keep][order].tolist()))
+    run_write(store_trending, None if full else dirty, rows)
+    invalidate_pages('trending')
+    return len(ids)
+
+def trending_refresher(app):
+    while True:
+        time.sleep(app.config['TRENDING_REFRESH_INTERVAL'])
+        try:
+            with app.app_context():
+                refresh_trending()
+        except Exception:
+            app.logger.exception("Trending refresh failed")
+
+trending_thread = None
+
+@bp.before_app_request
+def start_trending_refresher():
+    # Like the metrics writer, started in the worker on its first request
+    global trending_thread
+    if current_app.config['TRENDING_REFRESH_INTERVAL'] is None:
+        return
+    if trending_thread is None or not trending_thread.is_alive():
+        trending_thread = threading.Thread(target=trending_refresher, args=(current_app._get_current_object(),),
+                                           name='trending-refresh', daemon=True)
+        trending_thread.start()
+
+@bp.cli.command('refresh-trending')
+@click.option('--full', is_flag=True, help='Rescore every video, not just the changed ones.')
+def refresh_trending_command(full):
+    """Rescore the trending feed."""
+    start = time.perf_counter()
+    count = refresh_trending(full)
+    print(f"Rescored {count} videos in {time.perf_counter() - start:.2f}s")
+
+def trending_videos(limit, offset=0):
+    # [(video, channel name)] in trending order, straight off the score index
+    return (db.session.query(Video, Channel.name)
+            .join(TrendingScore, TrendingScore.video_id == Video.id)
+            .join(Channel, Channel.id == Video.channel_id)
+            .order_by(TrendingScore.score.desc())
+            .limit(limit).offset(offset).all())
+
+# === Media serving ===
+class RangeFile:
+    """The next `length` bytes of an open file.
+
+    read() stops at the end of the range, for servers that iterate the
+    body; fileno() lets gunicorn sendfile() the span instead, starting at
+    the file's current position and sending Content-Length bytes.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        data = self.f.read(self.remaining if size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class HotMediaCache:
+    """Memory maps of the most requested media files.
+
+    A file is mapped once it has been asked for `hits` times and is at
+    most `file_max` bytes; mapped files are evicted least recently used
+    first to keep the total under `max_bytes`. Responses copy slices of
+    the map, so a hot HLS segment costs no open() or read() calls. Only
+    used without sendfile, which already sends from the page cache and
+    beats it (WSGI servers want bytes, so a map can't be sent as is).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = OrderedDict()  # (path, size, mtime_ns) -> count
+        self.maps = OrderedDict()  # (path, size, mtime_ns) -> mmap
+        self.total = 0
+
+    def init_app(self, app):
+        self.threshold = app.config['MEDIA_HOT_HITS']
+        self.max_bytes = app.config['MEDIA_HOT_CACHE_BYTES']
+        self.file_max = app.config['MEDIA_HOT_FILE_MAX']
+
+    def get(self, path, st):
+        """The mmap of `path` if it is hot (counting this request), else None."""
+        key = (path, st.st_size, st.st_mtime_ns)
+        if not self.max_bytes or not 0 < st.st_size <= min(self.file_max, self.max_bytes):
+            return None
+        with self.lock:
+            mapped = self.maps.get(key)
+            if mapped is not None:
+                self.maps.move_to_end(key)
+                return mapped
+            count = self.hits.pop(key, 0) + 1
+            self.hits[key] = count
+            while len(self.hits) > 4096:
+                self.hits.popitem(last=False)
+            if count < self.threshold:
+                return None
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.lock:
+            if key not in self.maps:
+                self.maps[key] = mapped
+                self.total += st.st_size
+                self.hits.pop(key, None)
+            while self.total > self.max_bytes:
+                # Not closed: a response may still be sending from it, and
+                # the map goes away with its last slice
+                (_, size, _), _ = self.maps.popitem(last=False)
+                self.total -= size
+            return self.maps.get(key)
+
+hot_media = HotMediaCache()
+
+# Types the mimetypes module gets wrong or doesn't know (.ts is Qt Linguist)
+MEDIA_TYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+def mapped_chunks(view, chunk=256 * 1024):
+    for i in range(0, len(view), chunk):
+        yield bytes(view[i:i + chunk])
+
+def send_media(folder_key, filename, max_age, mimetype=None, immutable=False):
+    """Serve a file from the folder in config[folder_key], with ranges.
+
+    Strong ETags come from the file's size and mtime, so conditional and
+    If-Range requests are answered without reading it. The body is handed
+    to the proxy (MEDIA_OFFLOAD), sent as a file wrapper (sendfile under
+    gunicorn) or, without sendfile, sliced from the hot cache.
+    """
+    path = safe_join(current_app.config[folder_key], filename)
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None or not os.path.isfile(path):
+        abort(404)
+    size = st.st_size
+    etag = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+    headers = {'Accept-Ranges': 'bytes',
+               'Cache-Control': f"public, max-age={max_age}{', immutable' if immutable else ''}"}
+    mimetype = (mimetype or MEDIA_TYPES.get(os.path.splitext(filename)[1].lower())
+                or mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+    offload = current_app.config['MEDIA_OFFLOAD']
+    if offload:
+        # The proxy does ranges and conditional requests from here on
+        if offload == 'x-accel':
+            location = current_app.config['MEDIA_ACCEL_LOCATIONS'][folder_key]
+            headers['X-Accel-Redirect'] = f"{location}/{filename}"
+        else:
+            headers['X-Sendfile'] = os.path.abspath(path)
+        response = Response(status=200, mimetype=mimetype, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    response = Response(mimetype=mimetype, headers=headers, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = st.st_mtime
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    start, end = 0, size
+    if_range = request.if_range
+    if request.range and (if_range.etag or if_range.date) in (None, etag, response.last_modified):
+        span = request.range.range_for_length(size)
+        if span is None:
+            response = Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+            return response
+        start, end = span
+        response.status_code = 206
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    response.content_length = end - start
+    if request.method == 'HEAD':
+        return response
+    mapped = None if current_app.config['MEDIA_SENDFILE'] else hot_media.get(path, st)
+    if mapped is not None:
+        response.response = mapped_chunks(memoryview(mapped)[start:end])
+    else:
+        f = open(path, 'rb')
+        f.seek(start)
+        response.response = wrap_file(request.environ, RangeFile(f, end - start), 256 * 1024)
+    return response
 
 # === Routes ===
-@app.route('/')
+@bp.route('/')
+@cached_page(lambda: ['feed', 'channels', 'trending', 'views'])
 def index():
     # Homepage: show recent videos across channels (front page)
-    videos = Video.query.order_by(Video.uploaded_at.desc()).limit(50).all()
-    theme_block = theme_style_block()
     user_id = session.get('user_id')
-    topbar = f"""
+    yield theme_style_block() + f"""
       <div class='topbar'>
         <strong>H Kingdom</strong> |
         <a class='btn' href='/channels'>Channels</a>
-        {"<a class='btn' href='/upload_video'>Upload</a>" if user_id and User.query.get(user_id).channel else ""}
+        <a class='btn' href='/search'>Search</a>
+        {"<a class='btn' href='/upload_video'>Upload</a>" if user_id and directory.channel_for_user(user_id) else ""}
         {"<a class='btn' href='/logout'>Logout</a>" if user_id else "<a class='btn' href='/login'>Login</a> <a class='btn' href='/create_account'>Sign up</a>"}
         <div style='margin-left:auto'>Theme:
           <a class='btn' href='/set_theme/light'>Light</a>
@@ -155,60 +2880,57 @@ def index():
           <a class='btn' href='/set_theme/gold'>Gold</a>
           <a class='btn' href='/set_theme/cyan'>Cyan</a>
         </div>
-      </div>
-    """
+      </div>"""
 
-    html = theme_block + topbar + "<h1>Recent Videos</h1>"
+    if not request.args.get('before'):
+        trending = trending_videos(current_app.config['TRENDING_HOME_SIZE'])
+        if trending:
+            yield "<h1>Trending</h1><div class='panel' style='margin-bottom:12px;'>"
+            for v, channel_name in trending:
+                duration = f" · {format_duration(v.duration)}" if v.duration else ""
+                yield (f"<p><a href='/channel/{v.channel_id}'>{v.title}</a> "
+                       f"<small style='color:var(--muted)'>by {channel_name}{duration}</small></p>")
+            yield "</div>"
+    yield "<h1>Recent Videos</h1>"
+
+    videos, next_cursor = keyset_page(Video.query, Video.uploaded_at, Video.id,
+                                      request.args.get('before'), current_app.config['FEED_PAGE_SIZE'])
     if not videos:
-        html += "<p>No videos yet.</p>"
-    else:
-        for v in videos:
-            ch = Channel.query.get(v.channel_id)
-            html += "<div class='panel' style='margin-bottom:12px;'>"
-            html += f"<h3>{v.title} <small style='color:var(--muted)'>by <a href='/channel/{ch.id}'>{ch.name}</a></small></h3>"
-            html += f"<video width='480' controls><source src='/videos/{v.filename}' type='video/mp4'>Your browser does not support the video tag.</video><br>"
-            html += f"<small style='color:var(--muted)'>Uploaded: {v.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')}</small>"
-            html += "</div>"
-    return html
+        yield "<p>No videos yet.</p>"
+    views = view_counter.get_counts([v.id for v in videos])
+    directory.prefetch(channel_ids={v.channel_id for v in videos})
+    for v in videos:
+        ch = directory.channel(v.channel_id)
+        yield "".join([
+            "<div class='panel' style='margin-bottom:12px;'>",
+            f"<h3>{v.title} <small style='color:var(--muted)'>by <a href='/channel/{ch.id}'>{ch.name}</a></small></h3>",
+            video_tag(v), "<br>",
+            video_details(v, views[v.id]),
+            "</div>",
+        ])
+    yield next_page_link('.index', 'before', next_cursor)
 
 # --- Create Account ---
-@app.route('/create_account', methods=['GET', 'POST'])
+def create_user(email, password):
+    if User.query.filter_by(email=email).first():
+        return None
+    return insert_row(User(email=email, password=password))
+
+@bp.route('/create_account', methods=['GET', 'POST'])
 def create_account():
     theme_block = theme_style_block()
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        if User.query.filter_by(email=email).first():
+        user_id = run_write(create_user, email, password)
+        if user_id is None:
             return "Email already exists! <a href='/login'>Login here</a>"
-        user = User(email=email, password=password)
-        db.session.add(user)
-        db.session.commit()
-        session['user_id'] = user.id
-        return redirect(url_for('create_channel'))
-    return theme_block + render_template_string('''
-        <div class='topbar'>
-          <strong>H Kingdom</strong>
-          <div style='margin-left:auto'>
-            <a class='btn' href='/set_theme/light'>Light</a>
-            <a class='btn' href='/set_theme/dark'>Dark</a>
-            <a class='btn' href='/set_theme/gold'>Gold</a>
-            <a class='btn' href='/set_theme/cyan'>Cyan</a>
-          </div>
-        </div>
-        <div class='panel'>
-        <h2>Create Account</h2>
-        <form method="post">
-            Email: <input type="email" name="email" required><br><br>
-            Password: <input type="password" name="password" required><br><br>
-            <input class='btn' type="submit" value="Create Account">
-        </form>
-        <br>
-        Already have an account? <a href="/login">Login here</a>
-        </div>
-    ''')
+        session['user_id'] = user_id
+        return redirect(url_for('.create_channel'))
+    return theme_block + render_template('create_account.html')
 
 # --- Login ---
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     theme_block = theme_style_block()
     if request.method == 'POST':
@@ -217,49 +2939,37 @@ def login():
         user = User.query.filter_by(email=email, password=password).first()
         if user:
             session['user_id'] = user.id
-            if user.channel:
-                return redirect(url_for('channel_page', channel_id=user.channel.id))
-            return redirect(url_for('create_channel'))
+            channel = directory.channel_for_user(user.id)
+            if channel:
+                return redirect(url_for('.channel_page', channel_id=channel.id))
+            return redirect(url_for('.create_channel'))
         else:
             return "Invalid login! <a href='/login'>Try again</a>"
-    return theme_block + render_template_string('''
-        <div class='topbar'>
-          <strong>H Kingdom</strong>
-          <div style='margin-left:auto'>
-            <a class='btn' href='/set_theme/light'>Light</a>
-            <a class='btn' href='/set_theme/dark'>Dark</a>
-            <a class='btn' href='/set_theme/gold'>Gold</a>
-            <a class='btn' href='/set_theme/cyan'>Cyan</a>
-          </div>
-        </div>
-        <div class='panel'>
-        <h2>Login</h2>
-        <form method="post">
-            Email: <input type="email" name="email" required><br><br>
-            Password: <input type="password" name="password" required><br><br>
-            <input class='btn' type="submit" value="Login">
-        </form>
-        <br>
-        Don't have an account? <a href="/create_account">Create one here</a>
-        </div>
-    ''')
+    return theme_block + render_template('login.html')
 
 # --- Logout ---
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 # --- Create Channel ---
-@app.route('/create_channel', methods=['GET', 'POST'])
+def create_channel_row(user_id, name, icon):
+    # one channel per user, even if two requests race
+    existing = Channel.query.filter_by(user_id=user_id).first()
+    if existing:
+        return existing.id
+    return insert_row(Channel(name=name, icon=icon, user_id=user_id))
+
+@bp.route('/create_channel', methods=['GET', 'POST'])
 def create_channel():
     theme_block = theme_style_block()
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
-    user = User.query.get(user_id)
-    if user.channel:
-        return redirect(url_for('channel_page', channel_id=user.channel.id))
+        return redirect(url_for('.login'))
+    channel = directory.channel_for_user(user_id)
+    if channel:
+        return redirect(url_for('.channel_page', channel_id=channel.id))
 
     if request.method == 'POST':
         name = request.form['name']
@@ -267,82 +2977,141 @@ def create_channel():
         icon_filename = None
         if file and file.filename:
             filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            os.makedirs(current_app.config['PARTIAL_UPLOAD_FOLDER'], exist_ok=True)
+            # Saved with the upload's extension, which picks the format
+            file_path = os.path.join(current_app.config['PARTIAL_UPLOAD_FOLDER'],
+                                     uuid.uuid4().hex + os.path.splitext(filename)[1])
+            from PIL import Image
             img = Image.open(file)
             if img.mode in ('RGBA', 'P'):
                 img = img.convert('RGB')
             img.save(file_path)
-            icon_filename = filename
-        channel = Channel(name=name, icon=icon_filename, owner=user)
-        db.session.add(channel)
-        db.session.commit()
-        return redirect(url_for('channel_page', channel_id=channel.id))
+            icon_filename = store_blob('UPLOAD_FOLDER', file_path, filename)
+            queue_icon_variants(icon_filename)
+        channel_id = run_write(create_channel_row, user_id, name, icon_filename)
+        directory.invalidate(channel_id, user_id)
+        invalidate_pages('channels', f'user:{user_id}')
+        return redirect(url_for('.channel_page', channel_id=channel_id))
 
-    return theme_block + render_template_string('''
-        <div class='topbar'>
-          <strong>H Kingdom</strong>
-          <div style='margin-left:auto'>
-            <a class='btn' href='/set_theme/light'>Light</a>
-            <a class='btn' href='/set_theme/dark'>Dark</a>
-            <a class='btn' href='/set_theme/gold'>Gold</a>
-            <a class='btn' href='/set_theme/cyan'>Cyan</a>
-          </div>
-        </div>
-        <div class='panel'>
-        <h2>Create Channel</h2>
-        <form method="post" enctype="multipart/form-data">
-            Channel Name: <input type="text" name="name" required><br><br>
-            Channel Icon: <input type="file" name="icon" accept=".png,.jpg,.jpeg,.bmp,.tiff,.gif"><br><br>
-            <input class='btn' type="submit" value="Create Channel">
-        </form>
-        </div>
-    ''')
+    return theme_block + render_template('create_channel.html')
 
 # --- List all channels ---
-@app.route("/channels")
+@bp.route("/channels")
+@cached_page(lambda: ['channels'])
 def list_channels():
-    theme_block = theme_style_block()
-    channels = Channel.query.all()
-    html = theme_block + """
-    <div class='topbar'>
-      <strong>H Kingdom</strong>
-      <div style='margin-left:auto'>
-        <a class='btn' href='/set_theme/light'>Light</a>
-        <a class='btn' href='/set_theme/dark'>Dark</a>
-        <a class='btn' href='/set_theme/gold'>Gold</a>
-        <a class='btn' href='/set_theme/cyan'>Cyan</a>
-      </div>
-    </div>
-    <h1>All Channels</h1><ul>
-    """
+    yield theme_style_block() + render_template('topbar.html') + "<h1>All Channels</h1><ul>"
+    query = Channel.query
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.filter(Channel.id > after)
+    size = current_app.config['CHANNELS_PAGE_SIZE']
+    channels = query.order_by(Channel.id.asc()).limit(size + 1).all()
+    next_after = None
+    if len(channels) > size:
+        channels = channels[:size]
+        next_after = channels[-1].id
     for c in channels:
-        html += f"""
+        yield f"""
         <li style='margin-bottom:20px;' class='panel'>
             <a href='/channel/{c.id}' style='font-size:20px;'>{c.name}</a><br>
-            {"<img src='/uploads/" + c.icon + "' width='100' height='100'>" if c.icon else ""}
+            {icon_img(c.icon, 100) if c.icon else ""}
         </li>
         """
-    html += "</ul>"
-    return html
+    yield "</ul>" + next_page_link('.list_channels', 'after', next_after)
 
 # --- Serve uploads & videos ---
-@app.route('/uploads/<filename>')
+def file_max_age(filename, default):
+    # Blob names never change content, so they are cached as immutable
+    return current_app.config['BLOB_MAX_AGE'] if is_blob_name(filename) else default
+
+@bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_media('UPLOAD_FOLDER', filename, file_max_age(filename, 0),
+                      immutable=is_blob_name(filename))
+
+@bp.route('/icon/<int:size>/<fmt>/<path:filename>')
+def channel_icon(size, fmt, filename):
+    if fmt not in ICON_FORMATS or not 16 <= size <= current_app.config['ICON_MAX_SIZE']:
+        abort(404)
+    if not is_blob_name(filename):
+        filename = secure_filename(filename)
+    mimetype = ICON_FORMATS[fmt][1]
+    max_age = file_max_age(filename, 86400)
+    name = icon_variant_name(filename, size, fmt)
+    if os.path.exists(os.path.join(current_app.config['ICON_FOLDER'], name)):
+        resp = send_from_directory(current_app.config['ICON_FOLDER'], name, mimetype=mimetype, max_age=max_age)
+    else:
+        # The on-demand cache is one flat folder; blob names are unique without their shard folders
+        name = os.path.basename(name)
+        path = icon_cache.get(name)
+        if path is None:
+            src_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+            if not os.path.isfile(src_path):
+                abort(404)
+            render_icon(src_path, icon_cache.path(name), size, fmt)
+            icon_cache.added(name)
+        resp = send_from_directory(current_app.config['ICON_CACHE_FOLDER'], name, mimetype=mimetype,
+                                   max_age=max_age)
+    resp.cache_control.immutable = is_blob_name(filename)
+    return resp
 
-@app.route('/videos/<filename>')
+# Folders that live inside VIDEO_FOLDER by default: half-written uploads
+# and media served by routes of their own, none of it through /videos/
+VIDEO_SUBFOLDERS = ('PARTIAL_UPLOAD_FOLDER', 'HLS_FOLDER', 'POSTER_FOLDER')
+
+def in_video_subfolder(filename):
+    path = os.path.realpath(os.path.join(current_app.config['VIDEO_FOLDER'], filename))
+    for key in VIDEO_SUBFOLDERS:
+        folder = os.path.realpath(current_app.config[key])
+        if os.path.commonpath([path, folder]) == folder:
+            return True
+    return False
+
+@bp.route('/videos/<path:filename>')
 def uploaded_video(filename):
-    return send_from_directory(app.config['VIDEO_FOLDER'], filename)
+    if in_video_subfolder(filename):
+        abort(404)
+    response = send_media('VIDEO_FOLDER', filename, file_max_age(filename, current_app.config['VIDEO_MAX_AGE']),
+                          immutable=is_blob_name(filename))
+    # A player fetches a file in many ranges; only the first one is a view.
+    # Identical uploads share a file, so pages say which video it is (?v=);
+    # that is only trusted for a video actually stored in this file.
+    if (request.method == 'GET' and response.status_code in (200, 206, 304)
+            and request.headers.get('Range', 'bytes=0-').startswith('bytes=0-')):
+        query = db.session.query(Video.id).filter_by(filename=filename)
+        video_id = request.args.get('v', type=int)
+        row = (query.filter_by(id=video_id) if video_id is not None else query).first()
+        if row:
+            count_view(row[0])
+    return response
+
+@bp.route('/posters/<path:filename>')
+def video_poster(filename):
+    return send_media('POSTER_FOLDER', filename, 86400)
+
+@bp.route('/hls/<path:filename>')
+def hls_file(filename):
+    # Packaged ladders are written once and never change. Fetching a master
+    # playlist is a view, once it was served, of the video named by ?v=
+    # (a per-video ladder's key is the video id) if that video uses it.
+    response = send_media('HLS_FOLDER', filename, 31536000)
+    key, _, name = filename.rpartition('/')
+    if name == 'master.m3u8' and request.method == 'GET' and response.status_code in (200, 304):
+        video_id = request.args.get('v', type=int, default=int(key) if key.isdigit() else None)
+        v = db.session.get(Video, video_id) if video_id is not None else None
+        if v is not None and media_key(v) == key:
+            count_view(v.id)
+    return response
 
 # --- Upload Video (only to your own channel) ---
-@app.route('/upload_video', methods=['GET', 'POST'])
+@bp.route('/upload_video', methods=['GET', 'POST'])
 def upload_video():
     theme_block = theme_style_block()
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
-    user = User.query.get(user_id)
-    if not user.channel:
+        return redirect(url_for('.login'))
+    channel = directory.channel_for_user(user_id)
+    if not channel:
         return "You must create a channel first! <a href='/create_channel'>Make one here</a>"
 
     if request.method == 'POST':
@@ -350,130 +3119,924 @@ def upload_video():
         file = request.files.get('video')
         if not file or not file.filename:
             return "No video file uploaded!"
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['VIDEO_FOLDER'], filename)
-        file.save(file_path)
-        video = Video(title=title, filename=filename, channel=user.channel)
-        db.session.add(video)
-        db.session.commit()
-        return redirect(url_for('channel_page', channel_id=user.channel.id))
-
-    return theme_block + render_template_string('''
-        <div class='topbar'>
-          <strong>H Kingdom</strong>
-          <div style='margin-left:auto'>
-            <a class='btn' href='/set_theme/light'>Light</a>
-            <a class='btn' href='/set_theme/dark'>Dark</a>
-            <a class='btn' href='/set_theme/gold'>Gold</a>
-            <a class='btn' href='/set_theme/cyan'>Cyan</a>
-          </div>
-        </div>
-        <div class='panel'>
-        <h2>Upload Video to Your Channel</h2>
-        <form method="post" enctype="multipart/form-data">
-            Title: <input type="text" name="title" required><br><br>
-            Video File: <input type="file" name="video" accept="video/*" required><br><br>
-            <input class='btn' type="submit" value="Upload Video">
-        </form>
-        </div>
-    ''')
+        os.makedirs(current_app.config['PARTIAL_UPLOAD_FOLDER'], exist_ok=True)
+        file_path, sha256 = spool_stream(file.stream, current_app.config['PARTIAL_UPLOAD_FOLDER'])
+        filename = store_blob('VIDEO_FOLDER', file_path, secure_filename(file.filename), sha256)
+        video_id = run_write(insert_row, Video(title=title, filename=filename,
+                                               channel_id=channel.id, hls_status='pending',
+                                               media_status='pending'))
+        invalidate_pages('feed', f'channel:{channel.id}')
+        queue_video_processing(video_id)
+        return redirect(url_for('.channel_page', channel_id=channel.id))
+
+    return theme_block + render_template('upload_video.html')
+
+# --- Resumable uploads (tus-style) ---
+# POST creates an upload and returns its URL in Location, HEAD reports how
+# many bytes are stored, and each PATCH appends one chunk at Upload-Offset.
+# Chunks are streamed straight into the partial file, so memory use per
+# upload stays flat, and the Video row is created after the final chunk.
+TUS_VERSION = '1.0.0'
+TUS_CHECKSUMS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256, 'md5': hashlib.md5}
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Running sha256 of each upload in this worker, keyed by upload id and
+# valid up to the stored offset. Rebuilt from the partial file if the
+# upload resumes on another worker or after a restart. Appends to one
+# upload are serialized across workers by a flock() on its partial file.
+_upload_digests = OrderedDict()  # upload id -> (offset, digest, last used)
+_upload_digests_lock = threading.Lock()
+
+def partial_path(upload_id):
+    return os.path.join(current_app.config['PARTIAL_UPLOAD_FOLDER'], upload_id)
+
+def upload_digest(upload):
+    with _upload_digests_lock:
+        cached = _upload_digests.get(upload.id)
+    if cached and cached[0] == upload.received:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(partial_path(upload.id), 'rb') as f:
+        remaining = upload.received
+        while remaining:
+            block = f.read(min(COPY_BUFFER_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+def remember_digest(upload_id, offset, digest):
+    # Uploads abandoned for RESUMABLE_EXPIRY seconds are dropped, oldest first
+    now = time.time()
+    cutoff = now - current_app.config['RESUMABLE_EXPIRY']
+    with _upload_digests_lock:
+        _upload_digests[upload_id] = (offset, digest, now)
+        _upload_digests.move_to_end(upload_id)
+        while _upload_digests and next(iter(_upload_digests.values()))[2] < cutoff:
+            _upload_digests.popitem(last=False)
+
+def forget_digest(upload_id):
+    with _upload_digests_lock:
+        _upload_digests.pop(upload_id, None)
+
+def tus_response(body='', status=204, **headers):
+    resp = make_response(body, status)
+    resp.headers['Tus-Resumable'] = TUS_VERSION
+    resp.headers['Cache-Control'] = 'no-store'
+    for name, value in headers.items():
+        resp.headers[name.replace('_', '-')] = str(value)
+    return resp
+
+def parse_upload_metadata(header):
+    meta = {}
+    for pair in filter(None, (p.strip() for p in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            meta[key] = base64.b64decode(value).decode('utf-8') if value else ''
+        except ValueError:
+            abort(400)
+    return meta
+
+def owned_upload(upload_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        abort(401)
+    upload = UploadSession.query.get_or_404(upload_id)
+    if upload.user_id != user_id:
+        abort(404)
+    return upload
+
+@bp.route('/upload_video/resumable', methods=['POST'])
+def create_resumable_upload():
+    user_id = session.get('user_id')
+    if not user_id:
+        return tus_response("Login required", 401)
+    if not directory.channel_for_user(user_id):
+        return tus_response("You must create a channel first!", 403)
+    length = request.headers.get('Upload-Length', type=int)
+    if length is None or length <= 0:
+        return tus_response("Upload-Length required", 400)
+    if length > current_app.config['RESUMABLE_MAX_SIZE']:
+        return tus_response("Upload too large", 413, Tus_Max_Size=current_app.config['RESUMABLE_MAX_SIZE'])
+    meta = parse_upload_metadata(request.headers.get('Upload-Metadata'))
+    filename = secure_filename(meta.get('filename', ''))
+    title = meta.get('title', '').strip()
+    if not filename or not title:
+        return tus_response("filename and title metadata required", 400)
+
+    upload = UploadSession(id=uuid.uuid4().hex, user_id=user_id, title=title,
+                           filename=filename, length=length, received=0)
+    open(partial_path(upload.id), 'wb').close()
+    upload_id = run_write(insert_row, upload)
+    return tus_response(status=201, Location=url_for('.resumable_upload', upload_id=upload_id),
+                        Upload_Offset=0)
+
+@bp.route('/upload_video/resumable/<upload_id>', methods=['HEAD'])
+def resumable_upload(upload_id):
+    upload = owned_upload(upload_id)
+    return tus_response(status=200, Upload_Offset=upload.received, Upload_Length=upload.length)
+
+@bp.route('/upload_video/resumable/<upload_id>', methods=['PATCH'])
+def append_resumable_upload(upload_id):
+    upload = owned_upload(upload_id)
+    if request.mimetype != 'application/offset+octet-stream':
+        return tus_response("Content-Type must be application/offset+octet-stream", 415)
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset != upload.received:
+        return tus_response("Upload-Offset does not match", 409, Upload_Offset=upload.received)
+
+    checksum = None
+    if request.headers.get('Upload-Checksum'):
+        algo, _, expected = request.headers['Upload-Checksum'].partition(' ')
+        if algo not in TUS_CHECKSUMS:
+            return tus_response("Unsupported checksum algorithm", 400)
+        checksum = TUS_CHECKSUMS[algo]()
+
+    limit = min(upload.length - offset, current_app.config['RESUMABLE_MAX_CHUNK'])
+    try:
+        f = open(partial_path(upload.id), 'r+b')
+    except FileNotFoundError:
+        abort(404)
+    with f:
+        # Held until the new offset is committed and, for the last chunk,
+        # the video created, so a PATCH landing on another worker can't
+        # write at the same offset. Clients retry a locked upload.
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return tus_response("Upload is locked by another request", 423)
+        db.session.refresh(upload)
+        if offset != upload.received:
+            return tus_response("Upload-Offset does not match", 409, Upload_Offset=upload.received)
+        digest = upload_digest(upload).copy()
+        written = 0
+        disconnected = False
+        f.seek(offset)
+        while True:
+            try:
+                block = request.stream.read(COPY_BUFFER_SIZE)
+            except ClientDisconnected:
+                # Keep what arrived; the client resumes from the new offset
+                disconnected = True
+                break
+            if not block:
+                break
+            if written + len(block) > limit:
+                f.truncate(offset)
+                return tus_response("Chunk exceeds Upload-Length or maximum chunk size", 413)
+            f.write(block)
+            digest.update(block)
+            if checksum:
+                checksum.update(block)
+            written += len(block)
+        if checksum and (disconnected or base64.b64encode(checksum.digest()).decode() != expected):
+            # Drop the chunk; the client resends it from the same offset
+            f.truncate(offset)
+            return tus_response("Checksum mismatch", 460, Upload_Offset=offset)
+        f.truncate(offset + written)
+        f.flush()
+
+        moved = run_write(advance_upload, upload.id, offset, offset + written)
+        if not moved:
+            return tus_response("Upload-Offset does not match", 409)
+        received = offset + written
+        remember_digest(upload.id, received, digest)
+
+        if received < upload.length:
+            return tus_response(Upload_Offset=received)
+        return finish_resumable_upload(upload, digest.hexdigest())
+
+def advance_upload(upload_id, offset, new_offset):
+    # Advance the offset only if no other worker moved it meanwhile
+    return (UploadSession.query
+            .filter_by(id=upload_id, received=offset)
+            .update({'received': new_offset}))
+
+def complete_upload(upload_id, video):
+    UploadSession.query.filter_by(id=upload_id).delete()
+    return insert_row(video)
+
+def delete_uploads(upload_ids):
+    UploadSession.query.filter(UploadSession.id.in_(upload_ids)).delete()
+
+def finish_resumable_upload(upload, sha256):
+    channel = directory.channel_for_user(upload.user_id)
+    filename = store_blob('VIDEO_FOLDER', partial_path(upload.id), upload.filename, sha256)
+    video_id = run_write(complete_upload, upload.id,
+                         Video(title=upload.title, filename=filename,
+                               channel_id=channel.id, hls_status='pending', media_status='pending'))
+    forget_digest(upload.id)
+    invalidate_pages('feed', f'channel:{channel.id}')
+    queue_video_processing(video_id)
+    return tus_response(Upload_Offset=upload.length, Upload_SHA256=sha256,
+                        Content_Location=url_for('.channel_page', channel_id=channel.id))
+
+@bp.route('/upload_video/resumable/<upload_id>', methods=['DELETE'])
+def cancel_resumable_upload(upload_id):
+    upload = owned_upload(upload_id)
+    run_write(delete_uploads, [upload.id])
+    forget_digest(upload.id)
+    if os.path.exists(partial_path(upload.id)):
+        os.remove(partial_path(upload.id))
+    return tus_response()
+
+@bp.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Delete resumable uploads that have not finished within RESUMABLE_EXPIRY."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['RESUMABLE_EXPIRY'])
+    stale = UploadSession.query.filter(UploadSession.created_at < cutoff).all()
+    for upload in stale:
+        if os.path.exists(partial_path(upload.id)):
+            os.remove(partial_path(upload.id))
+    run_write(delete_uploads, [upload.id for upload in stale])
+    print(f"Removed {len(stale)} stale uploads")
+
+def video_changed(video_id):
+    # After a reaction or comment: drop the cached pages showing the video
+    # and send the user back to its channel
+    channel_id = Video.query.get(video_id).channel_id
+    invalidate_pages(f'channel:{channel_id}', f'video:{video_id}')
+    return redirect(url_for('.channel_page', channel_id=channel_id))
+
+# === Reaction buffer ===
+def apply_reactions(rows):
+    # Batched upsert of (user_id, video_id, value, reacted_at) rows. A row
+    # already holding a newer reaction (from another worker) is kept.
+    params = [{'u': u, 'v': v, 'val': val, 'at': at} for u, v, val, at in rows]
+    db.session.execute(text("UPDATE like_dislike SET value = :val, reacted_at = :at "
+                            "WHERE user_id = :u AND video_id = :v AND coalesce(reacted_at, 0) <= :at"), params)
+    db.session.execute(text("INSERT INTO like_dislike (user_id, video_id, value, reacted_at) SELECT :u, :v, :val, :at "
+                            "WHERE NOT EXISTS (SELECT 1 FROM like_dislike WHERE user_id = :u AND video_id = :v)"),
+                       params)
+
+class ReactionBuffer:
+    """Write-behind buffer for likes and dislikes.
+
+    A reaction is appended to this worker's log file and recorded in memory,
+    and the request returns without touching like_dislike. Repeated toggles
+    by one user on one video collapse to the last value, which is written
+    even if it is where they started: another worker may have stored a
+    different one meanwhile, and the reaction times decide. Every
+    `flush_interval` seconds a background thread writes what is pending as
+    one batched upsert through the write queue.
+
+    Crash safety: the log is rotated to `.flushing` before each flush and
+    deleted once the batch commits. When the flush thread starts (with the
+    worker, see gunicorn.conf.py), logs left behind by workers that are no
+    longer running are claimed (renamed, so only one starting worker gets
+    each) and replayed in timestamp order. Every write carries
+    the reaction's time, so replaying one that already reached the database,
+    or that another worker has since superseded, changes nothing.
+
+    Per-video like/dislike counts are kept in memory, adjusted as reactions
+    arrive and reloaded from the database (plus whatever is still pending)
+    once they are older than `max_staleness`, which picks up other workers'
+    reactions.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # (user_id, video_id) -> (value in the database, new value, reacted at)
+        self.counts = OrderedDict()  # video_id -> [likes, dislikes, loaded_at]
+        self.log = None
+        self.thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.log_folder = app.config['REACTION_LOG_FOLDER']
+        self.flush_interval = app.config['REACTION_FLUSH_INTERVAL']
+        self.max_staleness = app.config['REACTION_MAX_STALENESS']
+        self.max_videos = app.config['REACTION_COUNTS_MAX']
+        self.fsync = app.config['REACTION_LOG_FSYNC']
+
+    def log_path(self):
+        return os.path.join(self.log_folder, f'reactions-{os.getpid()}.log')
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if self.log is None:
+                os.makedirs(self.log_folder, exist_ok=True)
+                # Logs under this pid are an earlier process's (pids get
+                # reused); set them aside for the flush thread to replay
+                for path in [self.log_path(), self.log_path() + '.flushing']:
+                    if os.path.exists(path):
+                        os.rename(path, f'{self.log_path()}.{uuid.uuid4().hex}.replay')
+                self.log = open(self.log_path(), 'a', buffering=1)
+                atexit.register(self.flush_at_exit)
+            self.thread = threading.Thread(target=self.run, name='reaction-flusher', daemon=True)
+            self.thread.start()
+
+    def replay_orphaned_logs(self):
+        # A dead worker's log is renamed to a name carrying this worker's
+        # pid before it is read: of two workers starting together only one
+        # wins the rename, and if this one dies before the replay commits,
+        # the next worker to start claims the file again.
+        entries, claimed = [], []
+        for path in glob.glob(os.path.join(self.log_folder, 'reactions-*.log*')):
+            pid = int(os.path.basename(path).split('-')[1].split('.')[0])
+            if pid == os.getpid() and self.log is not None and not path.endswith('.replay'):
+                continue  # this worker's own log
+            if pid != os.getpid() and pid_alive(pid):
+                continue
+            claim = os.path.join(self.log_folder, f'reactions-{os.getpid()}.log.{uuid.uuid4().hex}.replay')
+            try:
+                os.rename(path, claim)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            claimed.append(claim)
+            with open(claim) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 4:  # skip a torn last line
+                        entries.append((float(parts[0]), int(parts[1]), int(parts[2]), int(parts[3])))
+        if entries:
+            latest = {}
+            for at, user_id, video_id, value in sorted(entries):
+                latest[(user_id, video_id)] = (value, at)
+            run_write(apply_reactions, [(u, v, val, at) for (u, v), (val, at) in latest.items()])
+        for path in claimed:
+            os.remove(path)
+
+    def stored_value(self, user_id, video_id):
+        row = (db.session.query(LikeDislike.value)
+               .filter_by(user_id=user_id, video_id=video_id).first())
+        return row[0] if row else 0
+
+    def react(self, user_id, video_id, value):
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        key = (user_id, video_id)
+        with self.lock:
+            entry = self.pending.get(key)
+        base = entry[0] if entry else self.stored_value(user_id, video_id)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry:
+                base, previous, _ = entry
+            else:
+                previous = base
+            if previous == value:
+                return
+            now = time.time()
+            self.log.write(f"{now:.6f} {user_id} {video_id} {value}\n")
+            if self.fsync:
+                os.fsync(self.log.fileno())
+            self.pending[key] = (base, value, now)
+            counts = self.counts.get(video_id)
+            if counts:
+                self._shift(counts, previous, value)
+
+    @staticmethod
+    def _shift(counts, old, new):
+        if old == 1:
+            counts[0] -= 1
+        elif old == -1:
+            counts[1] -= 1
+        if new == 1:
+            counts[0] += 1
+        elif new == -1:
+            counts[1] += 1
+
+    def get_counts(self, video_ids):
+        """Return ({video_id: likes}, {video_id: dislikes}) for the given videos."""
+        now = time.time()
+        with self.lock:
+            stale = [v for v in video_ids
+                     if v not in self.counts or now - self.counts[v][2] > self.max_staleness]
+        if stale:
+            # Hold the flush lock so a batch can't land in the database
+            # between reading the counts and overlaying what is pending
+            with self.flush_lock:
+                likes, dislikes = channel_reaction_counts(stale)
+                with self.lock:
+                    for video_id in stale:
+                        self.counts[video_id] = [likes.get(video_id, 0), dislikes.get(video_id, 0), now]
+                    wanted = set(stale)
+                    for (_, video_id), (base, value, _) in self.pending.items():
+                        if video_id in wanted:
+                            self._shift(self.counts[video_id], base, value)
+        with self.lock:
+            likes, dislikes = {}, {}
+            for video_id in video_ids:
+                counts = self.counts[video_id]
+                self.counts.move_to_end(video_id)
+                likes[video_id], dislikes[video_id] = counts[0], counts[1]
+            while len(self.counts) > self.max_videos:
+                self.counts.popitem(last=False)
+        return likes, dislikes
+
+    def run(self):
+        try:
+            with self.app.app_context():
+                self.replay_orphaned_logs()
+        except Exception:
+            self.app.logger.exception("Replaying reaction logs failed")
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception("Flushing reactions failed; will retry")
+
+    def flush_at_exit(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            pass  # the log is replayed by the next worker to start
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending or self.log is None:
+                    return
+                batch = dict(self.pending)
+                self.log.close()
+                flushing = self.log_path() + '.flushing'
+                if os.path.exists(flushing):
+                    # a previous flush failed; keep its entries in the new log
+                    with open(flushing) as old, open(self.log_path(), 'a') as cur:
+                        cur.write(old.read())
+                os.replace(self.log_path(), flushing)
+                self.log = open(self.log_path(), 'a', buffering=1)
+            run_write(apply_reactions, [(u, v, value, at) for (u, v), (_, value, at) in batch.items()])
+            with self.lock:
+                for key, (_, value, _) in batch.items():
+                    entry = self.pending.get(key)
+                    if entry is None:
+                        continue
+                    if entry[1] == value:
+                        del self.pending[key]
+                    else:
+                        # changed again while flushing; the stored value is now `value`
+                        self.pending[key] = (value, entry[1], entry[2])
+            os.remove(flushing)
+        # Pages re-rendered when the reaction came in may have read the
+        # counts before the batch landed
+        video_ids = {video_id for _, video_id in batch}
+        channel_ids = {channel_id for (channel_id,) in
+                       db.session.query(Video.channel_id).filter(Video.id.in_(video_ids)).distinct()}
+        invalidate_pages(*(f'channel:{channel_id}' for channel_id in channel_ids),
+                         *(f'video:{video_id}' for video_id in video_ids))
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+reactions = ReactionBuffer()
+
+# === View counting ===
+# --- HyperLogLog ---
+# A sketch is 2^p one-byte registers. A viewer's 64-bit hash picks a
+# register with its top p bits, which keeps the longest run of leading
+# zeros seen in the remaining bits. Sketches merge by taking the larger of
+# each register, so hourly rollups, workers and totals combine losslessly.
+HLL_POWERS = [2.0 ** -rank for rank in range(65)]
+
+def hll_add(registers, key, precision):
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+    index = h >> (64 - precision)
+    rank = 64 - precision - (h & ((1 << (64 - precision)) - 1)).bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+def hll_merge(a, b):
+    # Also registered as the SQL function hll_merge(blob, blob)
+    if a is None or len(a) != len(b):
+        return b
+    return bytes(map(max, a, b))
+
+def hll_estimate(registers):
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(map(HLL_POWERS.__getitem__, registers))
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        # small cardinalities: linear counting is more accurate
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+def apply_views(rows):
+    # Batched upsert of (video_id, hour, views, sketch) rows into the hourly
+    # rollups and the all-time totals; hll_merge combines the sketches
+    conn = db.session.connection()
+    conn.exec_driver_sql("INSERT INTO video_views (video_id, hour, views, viewers) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT (video_id, hour) DO UPDATE SET views = views + excluded.views, "
+                         "viewers = hll_merge(viewers, excluded.viewers)", rows)
+    conn.exec_driver_sql("INSERT INTO video_view_total (video_id, views, viewers) VALUES (?, ?, ?) "
+                         "ON CONFLICT (video_id) DO UPDATE SET views = views + excluded.views, "
+                         "viewers = hll_merge(viewers, excluded.viewers)",
+                         [(video_id, count, sketch) for video_id, _, count, sketch in rows])
+
+class ViewCounter:
+    """In-memory view counts, written to the database in batches.
+
+    record() only touches memory: each thread is given one of `shards`
+    dicts, each with its own lock, mapping (video_id, hour) to a view count
+    and a HyperLogLog sketch of the viewers. Every `flush_interval` seconds
+    a background thread swaps the shards out, merges them and upserts one
+    row per video and hour through the write queue, merging sketches in SQL
+    so every gunicorn worker adds to the same rows.
+
+    Views still in memory when a worker is killed are lost, at most
+    `flush_interval` seconds of them; a clean exit flushes them.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.shards = []
+        self.local = threading.local()
+        self.next_shard = itertools.count()
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.totals = OrderedDict()  # video_id -> (views, unique viewers, loaded_at)
+        self.totals_lock = threading.Lock()
+        self.unrefreshed = set()  # flushed video ids whose cached pages are still old
+        self.refreshed_at = float('-inf')
+        self.thread = None
+
+    def init_app(self, app):
+        self.app = app
+        self.shards = [[threading.Lock(), {}] for _ in range(app.config['VIEW_SHARDS'])]
+        self.precision = app.config['VIEW_HLL_PRECISION']
+        self.flush_interval = app.config['VIEW_FLUSH_INTERVAL']
+        self.max_staleness = app.config['VIEW_MAX_STALENESS']
+        self.page_refresh = app.config['VIEW_PAGE_REFRESH']
+        self.max_videos = app.config['VIEW_TOTALS_MAX']
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if self.thread is None:
+                atexit.register(self.flush_at_exit)
+            self.thread = threading.Thread(target=self.run, name='view-flusher', daemon=True)
+            self.thread.start()
+
+    def shard(self):
+        # [lock, counts]; read counts with the lock held, drain() swaps it
+        index = getattr(self.local, 'shard', None)
+        if index is None:
+            index = self.local.shard = next(self.next_shard) % len(self.shards)
+        return self.shards[index]
+
+    def record(self, video_id, viewer):
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        key = (video_id, int(time.time() // 3600))
+        shard = self.shard()
+        with shard[0]:
+            counts = shard[1]
+            entry = counts.get(key)
+            if entry is None:
+                entry = counts[key] = [0, bytearray(1 << self.precision)]
+            entry[0] += 1
+            hll_add(entry[1], viewer, self.precision)
+
+    def drain(self):
+        # Swap out every shard and merge them into one batch
+        batch = {}
+        for shard in self.shards:
+            with shard[0]:
+                counts, shard[1] = shard[1], {}
+            for key, (views, sketch) in counts.items():
+                entry = batch.get(key)
+                if entry is None:
+                    batch[key] = [views, sketch]
+                else:
+                    entry[0] += views
+                    entry[1] = bytearray(hll_merge(entry[1], sketch))
+        return batch
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception("Flushing view counts failed; will retry")
+
+    def flush_at_exit(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            pass
+
+    def flush(self):
+        with self.flush_lock:
+            batch = self.drain()
+            if batch:
+                try:
+                    run_write(apply_views, [(video_id, hour, views, bytes(sketch))
+                                            for (video_id, hour), (views, sketch) in batch.items()])
+                except Exception:
+                    # Put the batch back so the next flush retries it
+                    shard = self.shards[0]
+                    with shard[0]:
+                        counts = shard[1]
+                        for key, (views, sketch) in batch.items():
+                            entry = counts.setdefault(key, [0, bytearray(len(sketch))])
+                            entry[0] += views
+                            entry[1] = bytearray(hll_merge(entry[1], sketch))
+                    raise
+        video_ids = {video_id for video_id, _ in batch}
+        with self.totals_lock:
+            for video_id in video_ids:
+                self.totals.pop(video_id, None)
+        self.refresh_pages(video_ids)
+
+    def refresh_pages(self, video_ids):
+        # Invalidate the cached pages showing these videos' counts, or
+        # remember them until `page_refresh` seconds have passed since the
+        # last time
+        with self.totals_lock:
+            self.unrefreshed |= video_ids
+            now = time.monotonic()
+            if not self.unrefreshed or now - self.refreshed_at < self.page_refresh:
+                return
+            video_ids, self.unrefreshed, self.refreshed_at = self.unrefreshed, set(), now
+        channel_ids = {channel_id for (channel_id,) in
+                       db.session.query(Video.channel_id).filter(Video.id.in_(video_ids)).distinct()}
+        invalidate_pages('views', *(f'channel:{channel_id}' for channel_id in channel_ids))
+
+    def get_counts(self, video_ids):
+        """Return {video_id: (views, estimated unique viewers)} for the given videos."""
+        now = time.time()
+        with self.totals_lock:
+            stale = [v for v in video_ids
+                     if v not in self.totals or now - self.totals[v][2] > self.max_staleness]
+        if stale:
+            rows = dict((video_id, (views, hll_estimate(sketch))) for video_id, views, sketch in
+                        db.session.query(VideoViewTotal.video_id, VideoViewTotal.views, VideoViewTotal.viewers)
+                        .filter(VideoViewTotal.video_id.in_(stale)))
+            with self.totals_lock:
+                for video_id in stale:
+                    self.totals[video_id] = rows.get(video_id, (0, 0)) + (now,)
+        with self.totals_lock:
+            result = {}
+            for video_id in video_ids:
+                entry = self.totals.get(video_id) or (0, 0, now)
+                if video_id in self.totals:
+                    self.totals.move_to_end(video_id)
+                result[video_id] = entry[:2]
+            while len(self.totals) > self.max_videos:
+                self.totals.popitem(last=False)
+        return result
+
+view_counter = ViewCounter()
+
+def viewer_key():
+    # Logged-in users are counted once however they connect; anyone else
+    # by address and browser
+    user_id = session.get('user_id')
+    if user_id:
+        return f"user:{user_id}"
+    return f"anon:{request.remote_addr}|{request.headers.get('User-Agent', '')}"
+
+def count_view(video_id):
+    view_counter.record(video_id, viewer_key())
+
+def format_views(views, viewers):
+    return f"{views:,} view{'s' if views != 1 else ''} · ~{viewers:,} unique"
 
 # --- Like/Dislike ---
-@app.route("/video/<int:video_id>/like")
+@bp.route("/video/<int:video_id>/like")
 def like_video(video_id):
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
-    existing = LikeDislike.query.filter_by(user_id=user_id, video_id=video_id).first()
-    if existing:
-        existing.value = 1
-    else:
-        db.session.add(LikeDislike(user_id=user_id, video_id=video_id, value=1))
-    db.session.commit()
-    return redirect(url_for('channel_page', channel_id=Video.query.get(video_id).channel_id))
+        return redirect(url_for('.login'))
+    reactions.react(user_id, video_id, 1)
+    return video_changed(video_id)
 
-@app.route("/video/<int:video_id>/dislike")
+@bp.route("/video/<int:video_id>/dislike")
 def dislike_video(video_id):
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
-    existing = LikeDislike.query.filter_by(user_id=user_id, video_id=video_id).first()
-    if existing:
-        existing.value = -1
-    else:
-        db.session.add(LikeDislike(user_id=user_id, video_id=video_id, value=-1))
-    db.session.commit()
-    return redirect(url_for('channel_page', channel_id=Video.query.get(video_id).channel_id))
+        return redirect(url_for('.login'))
+    reactions.react(user_id, video_id, -1)
+    return video_changed(video_id)
+
+@bp.route("/api/video/<int:video_id>/reaction", methods=["POST"])
+def react_api(video_id):
+    # Record a like (1) or dislike (-1) and return the new counts, without
+    # a redirect or a synchronous database write
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify(error="login required"), 401
+    value = request.values.get('value', type=int)
+    if value not in (1, -1):
+        return jsonify(error="value must be 1 or -1"), 400
+    v = db.session.get(Video, video_id)
+    if v is None:
+        abort(404)
+    reactions.react(user_id, video_id, value)
+    invalidate_pages(f'channel:{v.channel_id}', f'video:{video_id}')
+    likes, dislikes = reactions.get_counts([video_id])
+    return jsonify(video_id=video_id, value=value, likes=likes[video_id], dislikes=dislikes[video_id])
 
 # --- Comments: add, edit, delete ---
-@app.route("/video/<int:video_id>/comment", methods=["POST"])
+def update_comment(comment_id, content):
+    Comment.query.filter_by(id=comment_id).update(
+        {'content': content, 'updated_at': datetime.datetime.utcnow()})
+
+def delete_comment_row(comment_id):
+    Comment.query.filter_by(id=comment_id).delete()
+
+@bp.route("/video/<int:video_id>/comment", methods=["POST"])
 def comment_video(video_id):
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     content = request.form.get('content','').strip()
     if content:
-        db.session.add(Comment(content=content, user_id=user_id, video_id=video_id))
-        db.session.commit()
-    return redirect(url_for('channel_page', channel_id=Video.query.get(video_id).channel_id))
+        run_write(insert_row, Comment(content=content, user_id=user_id, video_id=video_id))
+    return video_changed(video_id)
 
-@app.route("/comment/<int:comment_id>/edit", methods=["GET", "POST"])
+@bp.route("/comment/<int:comment_id>/edit", methods=["GET", "POST"])
 def edit_comment(comment_id):
     c = Comment.query.get_or_404(comment_id)
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     if c.user_id != user_id:
         return "You are not allowed to edit this comment.", 403
 
     if request.method == 'POST':
         content = request.form.get('content','').strip()
         if content:
-            c.content = content
-            c.updated_at = datetime.datetime.utcnow()
-            db.session.commit()
-        return redirect(url_for('channel_page', channel_id=Video.query.get(c.video_id).channel_id))
+            run_write(update_comment, c.id, content)
+        return video_changed(c.video_id)
 
     # GET => show edit form
     theme_block = theme_style_block()
-    return theme_block + render_template_string('''
-        <div class='topbar'>
-          <strong>H Kingdom</strong>
-          <div style='margin-left:auto'>
-            <a class='btn' href='/set_theme/light'>Light</a>
-            <a class='btn' href='/set_theme/dark'>Dark</a>
-            <a class='btn' href='/set_theme/gold'>Gold</a>
-            <a class='btn' href='/set_theme/cyan'>Cyan</a>
-          </div>
-        </div>
-        <div class='panel'>
-          <h3>Edit Comment</h3>
-          <form method="post">
-            <textarea name="content" rows="4" required>{{content}}</textarea><br>
-            <input class='btn' type="submit" value="Save">
-          </form>
-        </div>
-    ''', content=c.content)
+    return theme_block + render_template('edit_comment.html', content=c.content)
 
-@app.route("/comment/<int:comment_id>/delete", methods=["POST"])
+@bp.route("/comment/<int:comment_id>/delete", methods=["POST"])
 def delete_comment(comment_id):
     c = Comment.query.get_or_404(comment_id)
     user_id = session.get('user_id')
     if not user_id:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     if c.user_id != user_id:
         return "You are not allowed to delete this comment.", 403
-    vid_channel = Video.query.get(c.video_id).channel_id
-    db.session.delete(c)
-    db.session.commit()
-    return redirect(url_for('channel_page', channel_id=vid_channel))
+    run_write(delete_comment_row, c.id)
+    return video_changed(c.video_id)
+
+# --- All comments on one video, oldest first ---
+@bp.route("/video/<int:video_id>/comments")
+@cached_page(lambda video_id: [f'video:{video_id}', 'channels'])
+def video_comments(video_id):
+    v = Video.query.get_or_404(video_id)
+    yield theme_style_block() + f"""
+      <div class='topbar'>
+        <strong>H Kingdom</strong>
+        <a class='btn' href='/channel/{v.channel_id}'>Back to Channel</a>
+        <div style='margin-left:auto'>
+          <a class='btn' href='/set_theme/light'>Light</a>
+          <a class='btn' href='/set_theme/dark'>Dark</a>
+          <a class='btn' href='/set_theme/gold'>Gold</a>
+          <a class='btn' href='/set_theme/cyan'>Cyan</a>
+        </div>
+      </div>
+      <h1>Comments on {v.title}</h1>
+    """
+    comments, next_cursor = keyset_page(comments_with_authors().filter(Comment.video_id == video_id),
+                                        Comment.created_at, Comment.id, request.args.get('after'),
+                                        current_app.config['COMMENTS_PAGE_SIZE'], descending=False,
+                                        key=lambda row: (row[0].created_at, row[0].id))
+    user_id = session.get('user_id')
+    parts = ["<div class='panel'>"]
+    if not comments:
+        parts.append("<p>No comments yet!</p>")
+    for com, email, channel_name in comments:
+        parts.append(render_comment(com, author_display_name(email, channel_name), user_id))
+    parts.append("</div>")
+    parts.append(next_page_link('.video_comments', 'after', next_cursor, video_id=video_id))
+    yield "".join(parts)
+
+# --- Search ---
+# `rank` is bm25() for an FTS5 table; ordering by it lets FTS5 rank the
+# matches itself. \x02/\x03 mark the matched terms in snippets so they
+# survive HTML escaping.
+def ranked_match(fts, window):
+    # Every hit, or with a SEARCH_RANK_WINDOW only the newest ones: ranking
+    # has to score every row it is given, and a walk down the rowids is cheap
+    if window is None:
+        return f"{fts} MATCH :match"
+    return (f"{fts} MATCH :match AND {fts}.rowid >= (SELECT coalesce(min(rowid), 0) FROM "
+            f"(SELECT rowid FROM {fts} WHERE {fts} MATCH :match ORDER BY rowid DESC LIMIT :window))")
+
+# kind -> (FTS table, query with {match} for its ranked_match())
+SEARCH_SQL = {
+    'videos': ('video_fts', '''SELECT video.id, video.channel_id, channel.name AS channel_name,
+                                     snippet(video_fts, 0, char(2), char(3), '…', 12) AS snippet
+                              FROM video_fts JOIN video ON video.id = video_fts.rowid
+                              LEFT JOIN channel ON channel.id = video.channel_id
+                              WHERE {match} ORDER BY rank LIMIT :limit OFFSET :offset'''),
+    'channels': ('channel_fts', '''SELECT channel.id, snippet(channel_fts, 0, char(2), char(3), '…', 12) AS snippet
+                                  FROM channel_fts JOIN channel ON channel.id = channel_fts.rowid
+                                  WHERE {match} ORDER BY rank LIMIT :limit OFFSET :offset'''),
+    'comments': ('comment_fts', '''SELECT comment.id, comment.video_id, video.title AS video_title,
+                                         snippet(comment_fts, 0, char(2), char(3), '…', 16) AS snippet
+                                  FROM comment_fts JOIN comment ON comment.id = comment_fts.rowid
+                                  LEFT JOIN video ON video.id = comment.video_id
+                                  WHERE {match} ORDER BY rank LIMIT :limit OFFSET :offset'''),
+}
+
+def fts_query(q):
+    # Every word has to match. Words are quoted so FTS5 operators in the
+    # input are taken literally, and the last one matches as a prefix so
+    # results show up while the user is still typing it.
+    terms = [f'"{term}"' for term in re.findall(r'\w+', q)]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return " ".join(terms)
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_rows(kind, match, limit, offset):
+    # Returns (rows, has_more)
+    fts, sql = SEARCH_SQL[kind]
+    window = current_app.config['SEARCH_RANK_WINDOW']
+    rows = db.session.execute(text(sql.format(match=ranked_match(fts, window))),
+                              {'match': match, 'limit': limit + 1, 'offset': offset,
+                               'window': window}).mappings().all()
+    rows = [dict(row, snippet=highlight(row['snippet'])) for row in rows]
+    return rows[:limit], len(rows) > limit
+
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('type')
+    kinds = [kind] if kind in SEARCH_SQL else list(SEARCH_SQL)
+    page = min(max(request.args.get('page', 1, type=int), 1), current_app.config['SEARCH_MAX_PAGE'])
+    size = current_app.config['SEARCH_PAGE_SIZE']
+    match = fts_query(q)
+    results = {}
+    if match:
+        for k in kinds:
+            rows, more = search_rows(k, match, size, (page - 1) * size)
+            results[k] = (rows, more and page < current_app.config['SEARCH_MAX_PAGE'])
+    return theme_style_block() + render_template('search.html', q=q, results=results, page=page)
+
+@bp.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild and optimize the full-text search index."""
+    create_search_index(rebuild=True)
+    with db.engine.begin() as conn:
+        for fts in SEARCH_INDEXES:
+            conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('optimize')"))
+    for fts, (table, _) in SEARCH_INDEXES.items():
+        count = db.session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+        print(f"{fts}: {count} rows indexed")
+
+# --- Page cache statistics ---
+@bp.route('/cache/stats')
+def cache_stats():
+    return jsonify(page_cache.info())
+
+# Likes and dislikes go through the JSON reaction API and update the
+# counts in place; without JS the links still work
+REACTION_SCRIPT = """
+<script>
+document.addEventListener('click', async function (e) {
+  var link = e.target.closest('a[data-video]');
+  if (!link || !window.fetch) return;
+  e.preventDefault();
+  var body = new URLSearchParams({value: link.dataset.value});
+  var resp = await fetch('/api/video/' + link.dataset.video + '/reaction', {method: 'POST', body: body});
+  if (!resp.ok) { window.location = link.href; return; }
+  var counts = await resp.json();
+  var links = document.querySelectorAll('a[data-video="' + link.dataset.video + '"] span');
+  links[0].textContent = counts.likes;
+  links[1].textContent = counts.dislikes;
+});
+</script>
+"""
 
 # --- Channel Page (videos, likes, comments) ---
-@app.route("/channel/<int:channel_id>")
+@bp.route("/channel/<int:channel_id>")
+@cached_page(lambda channel_id: [f'channel:{channel_id}', 'channels'])
 def channel_page(channel_id):
-    theme_block = theme_style_block()
-    c = Channel.query.get_or_404(channel_id)
-    html = theme_block + """
+    c = directory.channel(channel_id)
+    if c is None:
+        abort(404)
+    yield theme_style_block() + """
       <div class='topbar'>
         <strong>H Kingdom</strong>
         <a class='btn' href='/channels'>Channels</a>
@@ -485,75 +4048,240 @@ def channel_page(channel_id):
         </div>
       </div>
       <h1>{name}</h1>
-    """.format(name=c.name)
+    """.format(name=c.name) + (icon_img(c.icon, 150) + "<br>" if c.icon else "") + "<h2>Videos</h2>"
 
-    if c.icon:
-        html += f"<img src='/uploads/{c.icon}' width='150' height='150'><br>"
-
-    html += "<h2>Videos</h2>"
-    if not c.videos:
-        html += "<p>No videos yet!</p>"
+    videos, next_cursor = keyset_page(Video.query.filter_by(channel_id=channel_id),
+                                      Video.uploaded_at, Video.id, request.args.get('before'),
+                                      current_app.config['CHANNEL_VIDEOS_PAGE_SIZE'])
+    user_id = session.get('user_id')
+    if not videos:
+        yield "<p>No videos yet!</p>"
     else:
-        for v in c.videos:
-            likes = LikeDislike.query.filter_by(video_id=v.id, value=1).count()
-            dislikes = LikeDislike.query.filter_by(video_id=v.id, value=-1).count()
-            comments = Comment.query.filter_by(video_id=v.id).order_by(Comment.created_at.asc()).all()
-
-            html += "<div class='panel' style='margin-bottom:18px;'>"
-            html += f"<h3>{v.title}</h3>"
-            html += f"<small style='color:var(--muted)'>Uploaded: {v.uploaded_at.strftime('%Y-%m-%d %H:%M:%S')}</small><br>"
-            html += f"<video width='480' controls><source src='/videos/{v.filename}' type='video/mp4'>Your browser does not support the video tag.</video><br>"
-            html += f"<a class='btn' href='/video/{v.id}/like'>👍 Like ({likes})</a> "
-            html += f"<a class='btn' href='/video/{v.id}/dislike'>👎 Dislike ({dislikes})</a>"
+        video_ids = [v.id for v in videos]
+        likes, dislikes = reactions.get_counts(video_ids)
+        views = view_counter.get_counts(video_ids)
+        comments_by_video, more_comments = channel_comments(video_ids, current_app.config['COMMENTS_PREVIEW_SIZE'])
+        for v in videos:
+            comments = comments_by_video.get(v.id, [])
+
+            parts = ["<div class='panel' style='margin-bottom:18px;'>",
+                     f"<h3>{v.title}</h3>",
+                     video_details(v, views[v.id]), "<br>",
+                     video_tag(v), "<br>",
+                     f"<a class='btn' data-video='{v.id}' data-value='1' href='/video/{v.id}/like'>👍 Like (<span>{likes.get(v.id, 0)}</span>)</a> ",
+                     f"<a class='btn' data-video='{v.id}' data-value='-1' href='/video/{v.id}/dislike'>👎 Dislike (<span>{dislikes.get(v.id, 0)}</span>)</a>",
+                     "<h4>Comments</h4>"]
 
             # Comment form (only logged-in users)
-            user_id = session.get('user_id')
-            html += "<h4>Comments</h4>"
             if user_id:
-                html += f"""
+                parts.append(f"""
                     <form method="post" action="/video/{v.id}/comment">
                         <textarea name="content" rows="2" required></textarea><br>
                         <input class='btn' type="submit" value="Add Comment">
                     </form>
-                """
+                """)
             else:
-                html += "<p><a href='/login'>Login</a> to comment.</p>"
+                parts.append("<p><a href='/login'>Login</a> to comment.</p>")
 
             if not comments:
-                html += "<p>No comments yet!</p>"
+                parts.append("<p>No comments yet!</p>")
             else:
-                for com in comments:
-                    author = User.query.get(com.user_id)
-                    author_name = author.channel.name if author and author.channel else (author.email if author else "Unknown")
-                    html += "<div style='border-top:1px solid var(--muted); padding-top:6px; margin-top:6px;'>"
-                    html += f"<b>{author_name}</b> <small style='color:var(--muted)'>{com.created_at.strftime('%Y-%m-%d %H:%M:%S')}{(' (edited '+com.updated_at.strftime('%Y-%m-%d %H:%M:%S')+')') if com.updated_at else ''}</small>"
-                    html += f"<p>{com.content}</p>"
-
-                    # edit/delete buttons if current user is comment owner
-                    if user_id and com.user_id == user_id:
-                        html += f"""
-                        <form style='display:inline' method='get' action='/comment/{com.id}/edit'>
-                          <button class='btn' type='submit'>Edit</button>
-                        </form>
-                        <form style='display:inline' method='post' action='/comment/{com.id}/delete' onsubmit="return confirm('Delete comment?');">
-                          <button class='btn' type='submit'>Delete</button>
-                        </form>
-                        """
-                    html += "</div>"
-
-            html += "</div>"
+                for com, author_name in comments:
+                    parts.append(render_comment(com, author_name, user_id))
+                if v.id in more_comments:
+                    parts.append(f"<p><a href='/video/{v.id}/comments'>More comments →</a></p>")
+
+            parts.append("</div>")
+            yield "".join(parts)
+        yield next_page_link('.channel_page', 'before', next_cursor, label="Older videos →", channel_id=channel_id)
 
     # If viewer is channel owner, show upload link
-    user_id = session.get('user_id')
+    if user_id and c.user_id == user_id:
+        yield "<br><a class='btn' href='/upload_video'>Upload a Video</a>"
+
+    yield " | <a class='btn' href='/channels'>Back to Channels</a>"
     if user_id:
-        user = User.query.get(user_id)
-        if user and user.channel and user.channel.id == channel_id:
-            html += "<br><a class='btn' href='/upload_video'>Upload a Video</a>"
+        yield REACTION_SCRIPT
+
+# === JSON read API ===
+# Validators come from the page cache tag versions, which only a shared
+# PAGE_CACHE_BACKEND keeps in step across workers: with 'memory', a client
+# revalidating against a worker that never saw the write would get 304
+# forever. So with 'memory' the API sends no validators at all.
+def conditional_api(tags_for):
+    """Answer If-None-Match / If-Modified-Since before running the view.
+
+    `tags_for` gets the view arguments and returns the tags the response
+    depends on (the same tags the HTML pages use). A 304 costs one tag
+    version lookup; the view runs only when something changed. Without a
+    shared cache backend every request runs the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if not page_cache.backend.shared:
+                resp = make_response(view(**kwargs))
+                resp.headers['Cache-Control'] = 'no-cache'
+                return resp
+            etag, updated = page_cache.validators(list(tags_for(**kwargs)), request.full_path)
+            last_modified = (datetime.datetime.fromtimestamp(int(updated), datetime.timezone.utc)
+                             if updated is not None else None)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                                and request.if_modified_since >= last_modified)
+            resp = Response(status=304) if not_modified else make_response(view(**kwargs))
+            resp.set_etag(etag, weak=True)
+            if last_modified is not None:
+                resp.last_modified = last_modified
+            resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+    return decorator
+
+def video_json(v):
+    return {
+        'id': v.id,
+        'title': v.title,
+        'channel_id': v.channel_id,
+        'uploaded_at': v.uploaded_at.isoformat(),
+        'url': f'/videos/{v.filename}?v={v.id}',
+        'hls': f'/hls/{media_key(v)}/master.m3u8?v={v.id}' if v.hls_status == 'ready' else None,
+        'poster': f'/posters/{v.poster}' if v.poster else None,
+        'duration': v.duration,
+        'width': v.width,
+        'height': v.height,
+        'video_codec': v.video_codec,
+        'bitrate': v.bitrate,
+    }
+
+@bp.route('/api/feed')
+@conditional_api(lambda: ['feed', 'channels'])
+def api_feed():
+    videos, next_cursor = keyset_page(Video.query, Video.uploaded_at, Video.id,
+                                      request.args.get('before'), current_app.config['FEED_PAGE_SIZE'])
+    names = dict(db.session.query(Channel.id, Channel.name)
+                 .filter(Channel.id.in_({v.channel_id for v in videos})))
+    return jsonify(videos=[dict(video_json(v), channel=names.get(v.channel_id)) for v in videos],
+                   next=next_cursor)
+
+@bp.route('/api/trending')
+# 'trending' moves on rescoring; 'feed' on changes to the videos themselves
+# (posters, HLS packaging)
+@conditional_api(lambda: ['trending', 'feed', 'channels'])
+def api_trending():
+    page = min(max(request.args.get('page', 1, type=int), 1), current_app.config['TRENDING_MAX_PAGE'])
+    size = current_app.config['TRENDING_PAGE_SIZE']
+    rows = trending_videos(size + 1, (page - 1) * size)
+    more = len(rows) > size and page < current_app.config['TRENDING_MAX_PAGE']
+    return jsonify(videos=[dict(video_json(v), channel=name) for v, name in rows[:size]],
+                   next=page + 1 if more else None)
+
+@bp.route('/api/channels')
+@conditional_api(lambda: ['channels'])
+def api_channels():
+    query = Channel.query
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.filter(Channel.id > after)
+    size = current_app.config['CHANNELS_PAGE_SIZE']
+    channels = query.order_by(Channel.id.asc()).limit(size + 1).all()
+    next_after = channels[size - 1].id if len(channels) > size else None
+    return jsonify(channels=[{'id': c.id, 'name': c.name,
+                              'icon': icon_url(c.icon, 100, 'jpg') if c.icon else None}
+                             for c in channels[:size]],
+                   next=next_after)
+
+@bp.route('/api/channel/<int:channel_id>/videos')
+@conditional_api(lambda channel_id: [f'channel:{channel_id}'])
+def api_channel_videos(channel_id):
+    c = directory.channel(channel_id)
+    if c is None:
+        abort(404)
+    videos, next_cursor = keyset_page(Video.query.filter_by(channel_id=c.id),
+                                      Video.uploaded_at, Video.id, request.args.get('before'),
+                                      current_app.config['CHANNEL_VIDEOS_PAGE_SIZE'])
+    likes, dislikes = reactions.get_counts([v.id for v in videos])
+    return jsonify(channel={'id': c.id, 'name': c.name},
+                   videos=[dict(video_json(v), likes=likes[v.id], dislikes=dislikes[v.id]) for v in videos],
+                   next=next_cursor)
+
+@bp.route('/api/video/<int:video_id>/stats')
+@conditional_api(lambda video_id: [f'video:{video_id}', 'views'])
+def api_video_stats(video_id):
+    v = Video.query.get_or_404(video_id)
+    likes, dislikes = reactions.get_counts([v.id])
+    views, viewers = view_counter.get_counts([v.id])[v.id]
+    comments = db.session.query(func.count(Comment.id)).filter(Comment.video_id == v.id).scalar()
+    return jsonify(video_id=v.id, likes=likes[v.id], dislikes=dislikes[v.id], comments=comments,
+                   views=views, unique_viewers=viewers)
+
+@bp.route('/api/video/<int:video_id>/comments')
+@conditional_api(lambda video_id: [f'video:{video_id}', 'channels'])
+def api_video_comments(video_id):
+    v = Video.query.get_or_404(video_id)
+    comments, next_cursor = keyset_page(comments_with_authors().filter(Comment.video_id == v.id),
+                                        Comment.created_at, Comment.id, request.args.get('after'),
+                                        current_app.config['COMMENTS_PAGE_SIZE'], descending=False,
+                                        key=lambda row: (row[0].created_at, row[0].id))
+    return jsonify(comments=[{
+        'id': com.id,
+        'user_id': com.user_id,
+        'author': author_display_name(email, channel_name),
+        'content': com.content,
+        'created_at': com.created_at.isoformat(),
+        'updated_at': com.updated_at.isoformat() if com.updated_at else None,
+    } for com, email, channel_name in comments], next=next_cursor)
+
+# === App factory ===
+def create_app(config=None):
+    """Build the app: Config defaults, then HKINGDOM_* environment
+    variables, then `config`.
+
+    Nothing here creates folders or touches the database schema; run
+    `flask --app streaming_service2 init-db` once per deployment (the
+    gunicorn config does it in the master before forking workers).
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.from_prefixed_env('HKINGDOM')
+    app.config.from_mapping(config or {})
+    for key, value in derived_folders(app).items():
+        if app.config.get(key) is None:
+            app.config[key] = value
+    if app.config['PAGE_CACHE_BACKEND'] == 'sqlite':
+        app.config['PAGE_CACHE_BACKEND'] = 'sqlite:' + os.path.join(app.instance_path, 'page_cache.db')
+
+    db.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, 'connect', sqlite_pragma_listener(app.config['SQLITE_PRAGMAS']))
+        event.listen(db.engine, 'connect', register_sqlite_functions)
+        event.listen(db.engine, 'handle_error', sql_failed)
+
+    # Load the templates once per worker instead of on first use, from the
+    # compiled copies `flask init-db` left in TEMPLATE_CACHE_FOLDER if it ran
+    app.jinja_loader = DictLoader(TEMPLATES)
+    if os.path.isdir(app.config['TEMPLATE_CACHE_FOLDER']):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_FOLDER'])
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
 
-    html += " | <a class='btn' href='/channels'>Back to Channels</a>"
-    return html
+    write_queue.init_app(app)
+    page_cache.init_app(app)
+    icon_cache.init_app(app)
+    reactions.init_app(app)
+    view_counter.init_app(app)
+    directory.init_app(app)
+    hot_media.init_app(app)
+    rate_limiter.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
 # --- Run App ---
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        init_db()
     app.run(debug=True)
 
@@ -0,0 +1,61 @@
+import pytest
+
+import streaming_service2 as hk
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # Caches, buffers and limiters keep state between requests, so every
+    # test gets its own instead of the module's
+    monkeypatch.setattr(hk, 'page_cache', hk.PageCache())
+    monkeypatch.setattr(hk, 'directory', hk.Directory())
+    monkeypatch.setattr(hk, 'hot_media', hk.HotMediaCache())
+    monkeypatch.setattr(hk, 'reactions', hk.ReactionBuffer())
+    monkeypatch.setattr(hk, 'view_counter', hk.ViewCounter())
+    monkeypatch.setattr(hk, 'rate_limiter', hk.RateLimiter())
+    instance = tmp_path / 'instance'
+    app = hk.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'VIDEO_FOLDER': str(tmp_path / 'videos'),
+        'REACTION_LOG_FOLDER': str(instance / 'reactions'),
+        'METRICS_FOLDER': str(instance / 'metrics'),
+        'PROFILE_FOLDER': str(instance / 'profiles'),
+        'TEMPLATE_CACHE_FOLDER': str(instance / 'templates'),
+        'INGEST_JOURNAL_FOLDER': str(instance / 'ingest'),
+        # Tests flush by hand
+        'REACTION_FLUSH_INTERVAL': 3600,
+        'VIEW_FLUSH_INTERVAL': 3600,
+        'RATE_LIMITS': {},
+        'CONCURRENCY_LIMITS_PER_WORKER': {},
+    })
+    with app.app_context():
+        hk.init_db()
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def channel(app):
+    # A user with one channel; returns the channel's id
+    user = hk.User(email='owner@example.com', password='x')
+    hk.db.session.add(user)
+    hk.db.session.commit()
+    channel = hk.Channel(name='Owner', user_id=user.id)
+    hk.db.session.add(channel)
+    hk.db.session.commit()
+    return channel.id
+
+
+@pytest.fixture
+def video(channel):
+    # A video on `channel`; returns its id
+    video = hk.Video(title='First', filename='first.mp4', channel_id=channel)
+    hk.db.session.add(video)
+    hk.db.session.commit()
+    return video.id
@@ -0,0 +1,90 @@
+import pytest
+
+import streaming_service2 as hk
+
+
+@pytest.fixture
+def limits(app):
+    # Apply RATE_LIMITS / CONCURRENCY_LIMITS_PER_WORKER overrides
+    def configure(**config):
+        app.config.update(config)
+        hk.rate_limiter.init_app(app)
+        return hk.rate_limiter
+    return configure
+
+
+def test_take_tokens_refills_continuously():
+    buckets = [('user:1', 2, 10)]  # 2 tokens, refilled at 0.2 per second
+    wait, state = hk.take_tokens({}, buckets, 0.0)
+    assert (wait, state) == (0.0, {'user:1': (1, 0.0)})
+    wait, state = hk.take_tokens(state, buckets, 0.0)
+    assert (wait, state) == (0.0, {'user:1': (0, 0.0)})
+
+    assert hk.take_tokens(state, buckets, 0.0) == (pytest.approx(5.0), {})
+    assert hk.take_tokens(state, buckets, 2.5) == (pytest.approx(2.5), {})
+    wait, state = hk.take_tokens(state, buckets, 5.0)
+    assert wait == 0.0 and state['user:1'] == (pytest.approx(0.0), 5.0)
+    # Never refills past capacity
+    assert hk.take_tokens(state, buckets, 1000.0) == (0.0, {'user:1': (1, 1000.0)})
+
+
+def test_take_tokens_takes_from_all_buckets_or_none():
+    buckets = [('user:1', 5, 60), ('ip:1.2.3.4', 1, 60)]
+    state = {'user:1': (5, 0.0), 'ip:1.2.3.4': (0, 0.0)}
+
+    wait, new_state = hk.take_tokens(state, buckets, 0.0)
+
+    assert wait == pytest.approx(60.0)
+    assert new_state == {}
+
+
+def test_memory_backend_drops_least_recently_used_buckets():
+    backend = hk.MemoryRateBackend(max_keys=2)
+    for key in ['a', 'b', 'a', 'c']:
+        assert backend.take([(key, 2, 3600)]) == 0.0
+
+    assert list(backend.buckets) == ['a', 'c']
+    assert backend.take([('a', 2, 3600)]) > 0
+    assert backend.take([('b', 2, 3600)]) == 0.0  # forgotten, so full again
+
+
+def test_rate_limited_requests_get_429(client, video, limits):
+    limits(RATE_LIMITS={'reactions': (('react_api',), {'ip': (2, 60)})})
+    with client.session_transaction() as s:
+        s['user_id'] = 1
+
+    for _ in range(2):
+        assert client.post(f'/api/video/{video}/reaction', data={'value': 1}).status_code == 200
+    response = client.post(f'/api/video/{video}/reaction', data={'value': -1})
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '30'
+    assert response.json == {'error': 'Too many requests.', 'retry_after': 30}
+    # Other endpoints don't draw from the bucket
+    assert client.get(f'/api/video/{video}/stats').status_code == 200
+
+
+def test_busy_endpoint_gets_503(client, limits):
+    slot = limits(CONCURRENCY_LIMITS_PER_WORKER={'search': 1}, CONCURRENCY_WAIT=0.01).slots['search']
+    slot.acquire()
+
+    response = client.get('/search?q=x')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+    slot.release()
+    client.get('/search?q=x').close()
+    # The request gave its slot back
+    assert slot.acquire(blocking=False)
+
+
+def test_cache_hits_are_served_while_slots_are_busy(client, channel, limits):
+    slot = limits(CONCURRENCY_LIMITS_PER_WORKER={'channel_page': 1}, CONCURRENCY_WAIT=0.01).slots['channel_page']
+    response = client.get(f'/channel/{channel}')
+    response.data  # read to the end, which caches the page
+    response.close()  # gives the slot back
+    assert slot.acquire(blocking=False)
+
+    assert client.get(f'/channel/{channel}').status_code == 200
+    # A miss still has to wait for a slot
+    assert client.get(f'/channel/{channel}?sort=old').status_code == 503
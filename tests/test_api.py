@@ -0,0 +1,70 @@
+import pytest
+from werkzeug.http import http_date
+
+import streaming_service2 as hk
+
+
+@pytest.fixture
+def shared_cache(app, tmp_path):
+    # ETags need a backend whose tag versions every worker sees
+    app.config['PAGE_CACHE_BACKEND'] = f"sqlite:{tmp_path / 'page_cache.db'}"
+    hk.page_cache.init_app(app)
+
+
+def test_unchanged_response_is_304(client, video, shared_cache):
+    first = client.get(f'/api/video/{video}/comments')
+    etag = first.headers['ETag']
+
+    response = client.get(f'/api/video/{video}/comments', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    # Another resource, or another page of it, has its own ETag
+    assert client.get('/api/feed').headers['ETag'] != etag
+    assert client.get('/api/feed?before=x').headers['ETag'] != client.get('/api/feed').headers['ETag']
+
+
+def test_write_changes_etag(client, video, shared_cache):
+    etag = client.get(f'/api/video/{video}/comments').headers['ETag']
+    with client.session_transaction() as s:
+        s['user_id'] = hk.User.query.one().id
+
+    client.post(f'/video/{video}/comment', data={'content': 'new'})
+
+    response = client.get(f'/api/video/{video}/comments', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [c['content'] for c in response.json['comments']] == ['new']
+
+
+def test_trending_follows_video_changes(client, shared_cache):
+    etag = client.get('/api/trending').headers['ETag']
+
+    hk.invalidate_pages('feed')  # e.g. a poster or HLS ladder became ready
+
+    assert client.get('/api/trending', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_if_modified_since(client, shared_cache, monkeypatch):
+    now = hk.page_cache.backend.epoch  # when the backend started counting
+    monkeypatch.setattr(hk.time, 'time', lambda: now + 5)
+    last_modified = client.get('/api/channels').headers['Last-Modified']
+
+    assert client.get('/api/channels', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    hk.invalidate_pages('channels')
+    # Changed this second: no Last-Modified, since it couldn't tell a later change apart
+    response = client.get('/api/channels', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200 and 'Last-Modified' not in response.headers
+
+    monkeypatch.setattr(hk.time, 'time', lambda: now + 10)
+    response = client.get('/api/channels', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] == http_date(int(now + 5))
+
+
+def test_no_etag_without_shared_backend(client):
+    response = client.get('/api/channels')
+
+    assert 'ETag' not in response.headers
+    assert response.headers['Cache-Control'] == 'no-cache'
@@ -0,0 +1,129 @@
+import os
+
+import streaming_service2 as hk
+
+
+def refs(name, folder='VIDEO_FOLDER'):
+    hk.db.session.expire_all()
+    blob = hk.db.session.get(hk.Blob, (folder, name))
+    return None if blob is None else blob.refs
+
+
+def store(tmp_path, content, filename='clip.mp4', folder='VIDEO_FOLDER'):
+    src = tmp_path / filename
+    src.write_bytes(content)
+    return hk.store_blob(folder, str(src), filename)
+
+
+def test_refs_follow_rows(app, tmp_path, channel):
+    first = store(tmp_path, b'first')
+    second = store(tmp_path, b'second')
+    assert (refs(first), refs(second)) == (0, 0)
+
+    videos = [hk.Video(title=str(i), filename=first, channel_id=channel) for i in range(2)]
+    hk.db.session.add_all(videos)
+    hk.db.session.commit()
+    assert refs(first) == 2
+
+    videos[0].filename = second
+    hk.db.session.commit()
+    assert (refs(first), refs(second)) == (1, 1)
+
+    hk.db.session.delete(videos[1])
+    hk.db.session.commit()
+    assert (refs(first), refs(second)) == (0, 1)
+
+    icon = store(tmp_path, b'png', 'icon.png', 'UPLOAD_FOLDER')
+    hk.db.session.get(hk.Channel, channel).icon = icon
+    hk.db.session.commit()
+    assert refs(icon, 'UPLOAD_FOLDER') == 1
+
+
+def test_identical_uploads_share_a_blob(app, tmp_path):
+    assert store(tmp_path, b'same', 'a.mp4') == store(tmp_path, b'same', 'b.mp4')
+    assert hk.Blob.query.count() == 1
+
+
+def test_gc_blobs_deletes_unreferenced_files(app, tmp_path, channel):
+    kept = store(tmp_path, b'kept')
+    dropped = store(tmp_path, b'dropped')
+    hk.db.session.add(hk.Video(title='t', filename=kept, channel_id=channel))
+    hk.db.session.commit()
+    folder = app.config['VIDEO_FOLDER']
+
+    result = app.test_cli_runner().invoke(args=['gc-blobs', '--grace', '0', '--dry-run'])
+    assert 'Would delete 1 blobs' in result.output
+    assert os.path.exists(os.path.join(folder, dropped))
+
+    result = app.test_cli_runner().invoke(args=['gc-blobs', '--grace', '0'])
+
+    assert 'Deleted 1 blobs' in result.output
+    assert os.path.exists(os.path.join(folder, kept))
+    assert not os.path.exists(os.path.join(folder, dropped))
+    assert (refs(kept), refs(dropped)) == (1, None)
+
+
+def test_gc_blobs_keeps_recent_blobs(app, tmp_path):
+    name = store(tmp_path, b'just uploaded')
+
+    result = app.test_cli_runner().invoke(args=['gc-blobs'])
+
+    assert 'Deleted 0 blobs' in result.output
+    assert os.path.exists(os.path.join(app.config['VIDEO_FOLDER'], name))
+
+
+def test_shared_file_counts_the_named_video(app, client, tmp_path, channel, monkeypatch):
+    name = store(tmp_path, b'video bytes')
+    videos = [hk.Video(title=str(i), filename=name, channel_id=channel) for i in range(2)]
+    other = hk.Video(title='other', filename='other.mp4', channel_id=channel)
+    hk.db.session.add_all(videos + [other])
+    hk.db.session.commit()
+    counted = []
+    monkeypatch.setattr(hk, 'count_view', counted.append)
+
+    assert client.get(f'/videos/{name}?v={videos[1].id}').status_code == 200
+    assert client.get(f'/videos/{name}?v={other.id}').status_code == 200
+    assert client.get(f'/videos/{name}', headers={'Range': 'bytes=5-'}).status_code == 206
+    assert client.get('/videos/other.mp4').status_code == 404
+
+    assert counted == [videos[1].id]
+
+
+def test_identical_uploads_share_derived_media(app, tmp_path, channel, monkeypatch):
+    name = store(tmp_path, b'video bytes')
+    videos = [hk.Video(title=str(i), filename=name, channel_id=channel, hls_status='pending') for i in range(2)]
+    hk.db.session.add_all(videos)
+    hk.db.session.commit()
+    key = hk.media_key(videos[0])
+    assert key == os.path.splitext(name)[0] == hk.media_key(videos[1])
+    packaged = []
+
+    def package_hls(ffmpeg, src, out_dir, segment_seconds):
+        packaged.append(out_dir)
+        os.makedirs(out_dir)
+        open(os.path.join(out_dir, 'master.m3u8'), 'w').close()
+    monkeypatch.setattr(hk, 'package_hls', package_hls)
+    monkeypatch.setattr(hk, 'find_ffmpeg', lambda: 'ffmpeg')
+
+    for v in videos:
+        hk.package_video(app, v.id)
+
+    assert packaged == [os.path.join(app.config['HLS_FOLDER'], key)]
+    hk.db.session.expire_all()
+    assert [v.hls_status for v in videos] == ['ready', 'ready']
+
+
+def test_gc_blobs_deletes_derived_media(app, tmp_path):
+    name = store(tmp_path, b'video bytes')
+    key = os.path.splitext(name)[0]
+    ladder = os.path.join(app.config['HLS_FOLDER'], key, '720p')
+    os.makedirs(ladder)
+    open(os.path.join(ladder, 'index.m3u8'), 'w').close()
+    poster = os.path.join(app.config['POSTER_FOLDER'], key + '.jpg')
+    os.makedirs(os.path.dirname(poster))
+    open(poster, 'w').close()
+
+    app.test_cli_runner().invoke(args=['gc-blobs', '--grace', '0'])
+
+    assert not os.path.exists(os.path.join(app.config['HLS_FOLDER'], key))
+    assert not os.path.exists(poster)
@@ -0,0 +1,80 @@
+import datetime
+import json
+import os
+
+import streaming_service2 as hk
+
+MTIME = 1600000000  # 2020-09-13 12:26:40 UTC
+
+
+def put(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, (MTIME, MTIME))
+
+
+def catalogue():
+    return sorted((v.channel.name, v.title, v.uploaded_at) for v in hk.Video.query)
+
+
+def ingest(app, *args):
+    result = app.test_cli_runner().invoke(args=['ingest', *args, '--no-probe', '--workers', '2'])
+    assert result.exception is None, result.output
+    return result.output
+
+
+def test_ingest_then_export_round_trip(app, tmp_path):
+    source = tmp_path / 'source'
+    put(source / 'alpha' / 'first_clip.mp4', b'one')
+    put(source / 'alpha' / 'nested' / 'second.mov', b'two')
+    put(source / 'alpha' / 'notes.txt', b'skipped')
+    put(source / 'beta' / 'copy.mp4', b'one')
+
+    output = ingest(app, str(source))
+
+    assert 'Ingested 3 videos (0 failed)' in output
+    uploaded = datetime.datetime(2020, 9, 13, 12, 26, 40)
+    expected = [('alpha', 'first clip', uploaded), ('alpha', 'second', uploaded), ('beta', 'copy', uploaded)]
+    assert catalogue() == expected
+    # Identical files share one blob
+    assert hk.Blob.query.count() == 2
+    assert len({v.filename for v in hk.Video.query}) == 2
+    # A second run finds everything in its journal
+    assert '3 already ingested' in ingest(app, str(source))
+    assert hk.Video.query.count() == 3
+
+    manifest = tmp_path / 'export.jsonl'
+    result = app.test_cli_runner().invoke(args=['export', str(manifest)])
+    assert result.exception is None, result.output
+    lines = [json.loads(line) for line in manifest.read_text().splitlines()]
+    assert [line['type'] for line in lines] == ['channel'] * 2 + ['video'] * 3
+
+    # ...and the export brings the catalogue into another instance
+    other = tmp_path / 'other'
+    other_app = hk.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{other / 'app.db'}",
+        'UPLOAD_FOLDER': str(other / 'uploads'),
+        'VIDEO_FOLDER': str(other / 'videos'),
+        'INGEST_JOURNAL_FOLDER': str(other / 'ingest'),
+        'TEMPLATE_CACHE_FOLDER': str(other / 'templates'),
+    })
+    with other_app.app_context():
+        hk.init_db()
+        assert 'Ingested 3 videos (0 failed)' in ingest(other_app, str(manifest))
+        assert catalogue() == expected
+        for v in hk.Video.query:
+            with open(os.path.join(other_app.config['VIDEO_FOLDER'], v.filename), 'rb') as f:
+                assert f.read() == (b'two' if v.title == 'second' else b'one')
+
+
+def test_ingest_reports_unreadable_files(app, tmp_path):
+    source = tmp_path / 'source'
+    put(source / 'ok.mp4', b'fine')
+    os.symlink(source / 'missing.mp4', source / 'broken.mp4')
+
+    output = ingest(app, str(source), '--channel', 'misc')
+
+    assert 'Ingested 1 videos (1 failed)' in output
+    assert catalogue() == [('misc', 'ok', datetime.datetime(2020, 9, 13, 12, 26, 40))]
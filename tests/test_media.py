@@ -0,0 +1,34 @@
+import os
+
+import streaming_service2 as hk
+
+
+def put(folder, name, content=b'0123456789'):
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def test_videos_are_served_in_ranges(app, client):
+    put(app.config['VIDEO_FOLDER'], 'clip.mp4')
+
+    response = client.get('/videos/clip.mp4', headers={'Range': 'bytes=2-5'})
+
+    assert response.status_code == 206
+    assert response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    etag = client.get('/videos/clip.mp4').headers['ETag']
+    assert client.get('/videos/clip.mp4', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_videos_route_hides_other_media_folders(app, client):
+    put(app.config['PARTIAL_UPLOAD_FOLDER'], 'upload-id')
+    put(app.config['HLS_FOLDER'], 'key/master.m3u8')
+    put(app.config['POSTER_FOLDER'], 'key.jpg')
+
+    for path in ['partial/upload-id', 'hls/key/master.m3u8', 'posters/key.jpg', 'hls//key/master.m3u8']:
+        assert client.get(f'/videos/{path}').status_code == 404, path
+    # Their own routes still serve them
+    assert client.get('/hls/key/master.m3u8').status_code == 200
+    assert client.get('/posters/key.jpg').status_code == 200
@@ -0,0 +1,90 @@
+import streaming_service2 as hk
+
+
+def page(client, url):
+    # Read to the end (which stores the page) and close
+    response = client.get(url)
+    text = response.text
+    response.close()
+    return text
+
+
+def login(client, user_id):
+    with client.session_transaction() as s:
+        s['user_id'] = user_id
+
+
+def test_workers_share_entries_and_invalidations(tmp_path):
+    backend = hk.SQLiteCacheBackend(str(tmp_path / 'page_cache.db'), 100)
+    first, second = hk.PageCache(10, 60, backend), hk.PageCache(10, 60, backend)
+
+    first.set('/channels', 'old', first.snapshot(['channels']))
+    assert second.get('/channels') == 'old'
+
+    second.invalidate('channels')
+
+    assert first.get('/channels') is None
+    assert first.stats['invalidations'] == 1
+    assert second.get('/channels') is None
+
+
+def test_write_during_render_leaves_entry_stale():
+    cache = hk.PageCache(10, 60, hk.MemoryCacheBackend())
+    versions = cache.snapshot(['feed', 'channel:1'])
+    cache.invalidate('channel:1')  # lands while the page renders
+
+    cache.set('/', 'rendered before the write', versions)
+
+    assert cache.get('/') is None
+    # Other tags' pages are untouched
+    cache.set('/channels', 'list', cache.snapshot(['channels']))
+    cache.invalidate('channel:2')
+    assert cache.get('/channels') == 'list'
+
+
+def test_entries_are_bounded_and_expire(monkeypatch):
+    cache = hk.PageCache(2, 60, hk.MemoryCacheBackend())
+    for key in ['a', 'b', 'c']:
+        cache.set(key, key, {})
+
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.stats['evictions'] == 1
+    now = hk.time.time()
+    monkeypatch.setattr(hk.time, 'time', lambda: now + 61)
+    assert cache.get('c') is None
+    assert cache.stats['expirations'] == 1
+
+
+def test_new_channel_shows_on_cached_list(app, client):
+    user = hk.User(email='new@example.com', password='x')
+    hk.db.session.add(user)
+    hk.db.session.commit()
+    page(client, '/channels')
+    hits = hk.page_cache.stats['hits']
+    page(client, '/channels')
+    assert hk.page_cache.stats['hits'] == hits + 1
+
+    login(client, user.id)
+    client.post('/create_channel', data={'name': 'Fresh'})
+    with client.session_transaction() as s:
+        s.clear()
+
+    # The anonymous page cached before the write
+    assert 'Fresh' in page(client, '/channels')
+
+
+def test_comment_refreshes_cached_channel_page(app, client, channel, video):
+    owner = hk.User.query.one().id
+    login(client, owner)
+    assert 'No comments yet!' in page(client, f'/channel/{channel}')
+    hits = hk.page_cache.stats['hits']
+    page(client, f'/channel/{channel}')
+    assert hk.page_cache.stats['hits'] == hits + 1
+
+    client.post(f'/video/{video}/comment', data={'content': 'first!'})
+    assert 'first!' in page(client, f'/channel/{channel}')
+    assert 'first!' in page(client, f'/video/{video}/comments')
+
+    comment = hk.Comment.query.one().id
+    client.post(f'/comment/{comment}/delete')
+    assert 'first!' not in page(client, f'/channel/{channel}')
@@ -0,0 +1,96 @@
+import datetime
+import html
+import re
+
+import streaming_service2 as hk
+
+T0 = datetime.datetime(2024, 1, 1)
+
+
+def add_videos(channel, count):
+    # Pairs of videos share an upload time, so the id has to break ties
+    videos = [hk.Video(title=f'vid{i:02}', filename=f'{i}.mp4', channel_id=channel,
+                       uploaded_at=T0 + datetime.timedelta(minutes=i // 2)) for i in range(count)]
+    hk.db.session.add_all(videos)
+    hk.db.session.commit()
+    return sorted(videos, key=lambda v: (v.uploaded_at, v.id), reverse=True)
+
+
+def walk(client, url, link, item):
+    # Follow `link` from page to page; returns the items of each page
+    pages = []
+    while url:
+        text = client.get(url).text
+        pages.append(re.findall(item, text))
+        match = re.search(link, text)
+        url = html.unescape(match.group(1)) if match else None
+    return pages
+
+
+def test_keyset_page_walks_ties_in_order(app, channel):
+    newest_first = add_videos(channel, 7)
+    seen, cursor = [], None
+    while True:
+        rows, cursor = hk.keyset_page(hk.Video.query, hk.Video.uploaded_at, hk.Video.id, cursor, 3)
+        seen.append([v.id for v in rows])
+        if cursor is None:
+            break
+
+    assert seen == [[v.id for v in newest_first[i:i + 3]] for i in (0, 3, 6)]
+
+
+def test_feed_pages(app, client, channel):
+    app.config['FEED_PAGE_SIZE'] = 2
+    newest_first = add_videos(channel, 5)
+
+    pages = walk(client, '/', r"href='(/\?before=[^']+)'", r"<h3>(vid\d+) ")
+
+    assert pages == [[v.title for v in newest_first[i:i + 2]] for i in (0, 2, 4)]
+    # A cursor that doesn't parse starts from the top
+    assert re.findall(r"<h3>(vid\d+) ", client.get('/?before=junk').text) == pages[0]
+
+
+def test_api_feed_pages(app, client, channel):
+    app.config['FEED_PAGE_SIZE'] = 3
+    newest_first = add_videos(channel, 4)
+
+    first = client.get('/api/feed').json
+    second = client.get(f"/api/feed?before={first['next']}").json
+
+    assert [v['id'] for v in first['videos'] + second['videos']] == [v.id for v in newest_first]
+    assert second['next'] is None
+
+
+def test_channel_videos_pages(app, client, channel):
+    app.config['CHANNEL_VIDEOS_PAGE_SIZE'] = 3
+    newest_first = add_videos(channel, 5)
+
+    pages = walk(client, f'/channel/{channel}', r"href='([^']*\?before=[^']+)'>Older videos", r"<h3>(vid\d+)</h3>")
+
+    assert pages == [[v.title for v in newest_first[:3]], [v.title for v in newest_first[3:]]]
+
+
+def test_channel_list_pages(app, client):
+    app.config['CHANNELS_PAGE_SIZE'] = 2
+    user = hk.User(email='owner@example.com', password='x')
+    hk.db.session.add(user)
+    hk.db.session.commit()
+    hk.db.session.add_all(hk.Channel(name=f'chan{i}', user_id=user.id) for i in range(5))
+    hk.db.session.commit()
+
+    pages = walk(client, '/channels', r"href='(/channels\?after=[^']+)'", r">(chan\d)</a>")
+
+    assert pages == [['chan0', 'chan1'], ['chan2', 'chan3'], ['chan4']]
+
+
+def test_comment_pages_oldest_first(app, client, video):
+    app.config['COMMENTS_PAGE_SIZE'] = 2
+    user_id = hk.User.query.one().id
+    comments = [hk.Comment(content=f'comment{i}', user_id=user_id, video_id=video,
+                           created_at=T0 + datetime.timedelta(minutes=i // 2)) for i in range(5)]
+    hk.db.session.add_all(comments)
+    hk.db.session.commit()
+
+    pages = walk(client, f'/video/{video}/comments', r"href='([^']*\?after=[^']+)'", r"<p>(comment\d)</p>")
+
+    assert pages == [['comment0', 'comment1'], ['comment2', 'comment3'], ['comment4']]
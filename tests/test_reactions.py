@@ -0,0 +1,121 @@
+import os
+import time
+
+import streaming_service2 as hk
+
+DEAD_PID = 999999999
+
+
+def stored_reactions():
+    return {(row.user_id, row.video_id): (row.value, row.reacted_at) for row in hk.LikeDislike.query}
+
+
+def write_log(app, pid, lines):
+    folder = app.config['REACTION_LOG_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'reactions-{pid}.log')
+    with open(path, 'w') as f:
+        f.writelines(f"{line}\n" for line in lines)
+    return path
+
+
+def test_flush_writes_last_reaction_per_user(app, video):
+    buffer = hk.reactions
+    buffer.react(1, video, 1)
+    buffer.react(1, video, -1)
+    buffer.react(2, video, 1)
+    assert set(buffer.pending) == {(1, video), (2, video)}
+
+    buffer.flush()
+
+    assert {key: value for key, (value, _) in stored_reactions().items()} == {(1, video): -1, (2, video): 1}
+    assert buffer.pending == {}
+    log = buffer.log_path()
+    assert os.path.getsize(log) == 0
+    assert not os.path.exists(log + '.flushing')
+    assert buffer.get_counts([video]) == ({video: 1}, {video: 1})
+
+
+def test_toggle_back_is_still_written(app, video):
+    hk.run_write(hk.apply_reactions, [(1, video, 1, 100.0)])
+    buffer = hk.reactions
+    buffer.react(1, video, -1)
+    between = time.time()
+    buffer.react(1, video, 1)  # back where it started
+    # Another worker stored a dislike in between
+    hk.run_write(hk.apply_reactions, [(1, video, -1, between)])
+
+    buffer.flush()
+
+    assert stored_reactions()[(1, video)][0] == 1
+
+
+def test_start_replays_orphaned_logs(app, video):
+    write_log(app, DEAD_PID, [f"100.000000 1 {video} 1"])
+    # Left by an earlier process that had this worker's pid
+    write_log(app, os.getpid(), [f"200.000000 2 {video} -1"])
+
+    hk.reactions.start()
+
+    deadline = time.time() + 5
+    while len(stored_reactions()) < 2 and time.time() < deadline:
+        hk.db.session.rollback()
+        time.sleep(0.01)
+    assert stored_reactions() == {(1, video): (1, 100.0), (2, video): (-1, 200.0)}
+    assert os.path.getsize(hk.reactions.log_path()) == 0
+
+
+def test_flush_invalidates_cached_pages(app, client, video, channel):
+    assert 'Like (<span>0</span>)' in client.get(f'/channel/{channel}').text
+    # Without the route's invalidation, as in a worker that did not take the reaction
+    hk.reactions.react(1, video, 1)
+    assert 'Like (<span>0</span>)' in client.get(f'/channel/{channel}').text
+
+    hk.reactions.flush()
+
+    assert 'Like (<span>1</span>)' in client.get(f'/channel/{channel}').text
+
+
+def test_replay_keeps_latest_entry_per_user(app, video):
+    path = write_log(app, DEAD_PID, [
+        f"100.000000 1 {video} 1",
+        f"300.000000 2 {video} -1",
+        f"200.000000 1 {video} -1",
+        f"400.000000 2 {video}",  # torn last line
+    ])
+
+    hk.reactions.replay_orphaned_logs()
+
+    assert stored_reactions() == {(1, video): (-1, 200.0), (2, video): (-1, 300.0)}
+    assert os.listdir(os.path.dirname(path)) == []
+
+
+def test_replay_skips_entries_older_than_the_database(app, video):
+    # Another worker stored a newer reaction after the dead worker logged its own
+    hk.run_write(hk.apply_reactions, [(1, video, 1, 500.0)])
+    write_log(app, DEAD_PID, [f"400.000000 1 {video} -1", f"450.000000 2 {video} -1"])
+
+    hk.reactions.replay_orphaned_logs()
+
+    assert stored_reactions() == {(1, video): (1, 500.0), (2, video): (-1, 450.0)}
+
+
+def test_replay_leaves_logs_of_live_workers(app, video):
+    path = write_log(app, os.getppid(), [f"100.000000 1 {video} 1"])
+
+    hk.reactions.replay_orphaned_logs()
+
+    assert stored_reactions() == {}
+    assert os.path.exists(path)
+
+
+def test_replay_skips_log_claimed_by_another_worker(app, video, monkeypatch):
+    write_log(app, DEAD_PID, [f"100.000000 1 {video} 1"])
+
+    def claimed_first(src, dst):
+        raise FileNotFoundError(src)
+    monkeypatch.setattr(hk.os, 'rename', claimed_first)
+
+    hk.reactions.replay_orphaned_logs()
+
+    assert stored_reactions() == {}
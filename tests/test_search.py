@@ -0,0 +1,36 @@
+import streaming_service2 as hk
+
+
+def add_comments(video, texts):
+    hk.db.session.add_all(hk.Comment(content=text, user_id=1, video_id=video) for text in texts)
+    hk.db.session.commit()
+
+
+def test_ranks_the_whole_match(app, video):
+    # The best match is the oldest one
+    add_comments(video, ['cats cats cats'] + [f'cats and {i} other things entirely' for i in range(30)])
+
+    rows, more = hk.search_rows('comments', hk.fts_query('cats'), 5, 0)
+
+    assert rows[0]['id'] == 1
+    assert more
+    rows, more = hk.search_rows('comments', hk.fts_query('cats'), 5, 30)
+    assert len(rows) == 1 and not more
+
+
+def test_rank_window_is_opt_in(app, video):
+    add_comments(video, ['cats cats cats'] + [f'cats and {i} other things entirely' for i in range(30)])
+    app.config['SEARCH_RANK_WINDOW'] = 10
+
+    rows, more = hk.search_rows('comments', hk.fts_query('cats'), 20, 0)
+
+    assert 1 not in [row['id'] for row in rows]
+    assert len(rows) == 10 and not more
+
+
+def test_prefix_match_and_highlight(client, video):
+    add_comments(video, ['a wonderful day'])
+
+    body = client.get('/search?q=wonder').text
+
+    assert '<mark>wonderful</mark>' in body
@@ -0,0 +1,108 @@
+import base64
+import fcntl
+import hashlib
+import os
+
+import pytest
+
+import streaming_service2 as hk
+
+CONTENT = b'0123456789'
+
+
+@pytest.fixture
+def owner(client, channel, monkeypatch):
+    # Log in as the channel's owner; returns the ids of videos queued for processing
+    with client.session_transaction() as s:
+        s['user_id'] = hk.User.query.one().id
+    queued = []
+    monkeypatch.setattr(hk, 'queue_video_processing', queued.append)
+    return queued
+
+
+def b64(value):
+    return base64.b64encode(value.encode()).decode()
+
+
+def create(client, length=len(CONTENT)):
+    response = client.post('/upload_video/resumable', headers={
+        'Tus-Resumable': '1.0.0', 'Upload-Length': str(length),
+        'Upload-Metadata': f"filename {b64('clip.mp4')},title {b64('Clip')}"})
+    assert response.status_code == 201
+    return response.headers['Location']
+
+
+def patch(client, url, offset, chunk, **headers):
+    return client.patch(url, data=chunk, headers={
+        'Tus-Resumable': '1.0.0', 'Content-Type': 'application/offset+octet-stream',
+        'Upload-Offset': str(offset), **headers})
+
+
+def partial(app, url):
+    return os.path.join(app.config['PARTIAL_UPLOAD_FOLDER'], url.rsplit('/', 1)[1])
+
+
+def test_chunks_resume_and_finish(app, client, owner):
+    url = create(client)
+
+    assert patch(client, url, 0, CONTENT[:4]).headers['Upload-Offset'] == '4'
+    # A resent chunk doesn't move the upload
+    response = patch(client, url, 0, CONTENT[:4])
+    assert (response.status_code, response.headers['Upload-Offset']) == (409, '4')
+    # Resuming elsewhere starts from HEAD's offset, with no running digest
+    hk._upload_digests.clear()
+    assert client.head(url).headers['Upload-Offset'] == '4'
+    sha1 = base64.b64encode(hashlib.sha1(CONTENT[4:]).digest()).decode()
+    response = patch(client, url, 4, CONTENT[4:], **{'Upload-Checksum': f'sha1 {sha1}'})
+
+    assert response.status_code == 204
+    assert response.headers['Upload-SHA256'] == hashlib.sha256(CONTENT).hexdigest()
+    video = hk.Video.query.one()
+    assert (video.title, owner) == ('Clip', [video.id])
+    with open(os.path.join(app.config['VIDEO_FOLDER'], video.filename), 'rb') as f:
+        assert f.read() == CONTENT
+    assert hk.UploadSession.query.count() == 0
+    assert not os.path.exists(partial(app, url))
+
+
+def test_bad_chunks_are_dropped(app, client, owner):
+    url = create(client)
+    patch(client, url, 0, CONTENT[:2])
+
+    response = patch(client, url, 2, CONTENT[2:4], **{'Upload-Checksum': 'sha1 AAAA'})
+    assert (response.status_code, response.headers['Upload-Offset']) == (460, '2')
+    assert patch(client, url, 2, CONTENT[2:] + b'extra').status_code == 413
+
+    assert client.head(url).headers['Upload-Offset'] == '2'
+    assert os.path.getsize(partial(app, url)) == 2
+    assert hk.Video.query.count() == 0
+
+
+def test_locked_upload_gets_423(app, client, owner):
+    url = create(client)
+    with open(partial(app, url), 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        assert patch(client, url, 0, CONTENT).status_code == 423
+
+    assert patch(client, url, 0, CONTENT).status_code == 204
+
+
+def test_uploads_belong_to_their_user(app, client, owner):
+    url = create(client)
+    with client.session_transaction() as s:
+        s['user_id'] = 999
+    assert client.head(url).status_code == 404
+    with client.session_transaction() as s:
+        del s['user_id']
+    assert client.head(url).status_code == 401
+
+
+def test_cancel_removes_partial_file(app, client, owner):
+    url = create(client)
+    patch(client, url, 0, CONTENT[:4])
+
+    assert client.delete(url).status_code == 204
+
+    assert not os.path.exists(partial(app, url))
+    assert client.head(url).status_code == 404
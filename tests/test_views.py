@@ -0,0 +1,83 @@
+from sqlalchemy import func
+
+import streaming_service2 as hk
+
+PRECISION = 10
+
+
+def sketch(keys, precision=PRECISION):
+    registers = bytearray(1 << precision)
+    for key in keys:
+        hk.hll_add(registers, key, precision)
+    return bytes(registers)
+
+
+def stored_totals(video_id):
+    row = hk.db.session.get(hk.VideoViewTotal, video_id)
+    return row.views, hk.hll_estimate(row.viewers)
+
+
+def test_hll_merge_is_sketch_of_union():
+    a = sketch(f'viewer{i}' for i in range(0, 3000))
+    b = sketch(f'viewer{i}' for i in range(2000, 5000))
+
+    assert hk.hll_merge(a, b) == sketch(f'viewer{i}' for i in range(5000))
+    assert hk.hll_merge(None, b) == b
+
+
+def test_hll_estimate_is_close():
+    assert hk.hll_estimate(sketch([])) == 0
+    assert hk.hll_estimate(sketch(f'viewer{i}' for i in range(20))) == 20
+    assert abs(hk.hll_estimate(sketch(f'viewer{i}' for i in range(50000))) - 50000) < 50000 * 0.1
+
+
+def test_flush_adds_to_stored_totals(app, video):
+    counter = hk.view_counter
+    for viewer in ['a', 'a', 'a', 'b']:
+        counter.record(video, viewer)
+    assert counter.get_counts([video]) == {video: (0, 0)}
+
+    counter.flush()
+
+    assert stored_totals(video) == (4, 2)
+    # This worker's cached totals are dropped, not left stale
+    assert counter.get_counts([video]) == {video: (4, 2)}
+
+    # Another worker's batch merges into the same rows
+    other = hk.ViewCounter()
+    other.init_app(app)
+    other.record(video, 'b')
+    other.record(video, 'c')
+    other.flush()
+
+    assert stored_totals(video) == (6, 3)
+    assert hk.db.session.query(func.sum(hk.VideoViews.views)).scalar() == 6
+
+
+def test_flush_invalidates_cached_pages(app, client, video, channel):
+    assert '0 views' in client.get(f'/channel/{channel}').text
+    assert '0 views' in client.get('/').text
+    hk.view_counter.record(video, 'a')
+    hk.view_counter.record(video, 'b')
+
+    hk.view_counter.flush()
+
+    assert '2 views' in client.get(f'/channel/{channel}').text
+    assert '2 views' in client.get('/').text
+
+
+def test_flush_refreshes_pages_at_most_every_interval(app, client, video, channel):
+    hk.view_counter.record(video, 'a')
+    hk.view_counter.flush()
+    assert '1 view ' in client.get(f'/channel/{channel}').text
+
+    hk.view_counter.record(video, 'b')
+    hk.view_counter.flush()
+    # Written, but the cached page stays until VIEW_PAGE_REFRESH has passed
+    assert stored_totals(video) == (2, 2)
+    assert '1 view ' in client.get(f'/channel/{channel}').text
+
+    hk.view_counter.refreshed_at -= app.config['VIEW_PAGE_REFRESH']
+    hk.view_counter.flush()  # nothing new to write
+
+    assert '2 views' in client.get(f'/channel/{channel}').text